@@ -0,0 +1,600 @@
+from opentrons import protocol_api
+from opentrons.types import Point
+import math
+import json
+import os
+import tempfile
+import time
+
+# metadata
+metadata = {
+    "protocolName": "BOTany5-MagBead-Flex",
+    "description": """Protocol for binding, washing, and elution steps using Zymo Zyppy-96 Plasmid MagBead Kit, on a Flex with the gripper moving the collection plate""",
+    "author": "Voiniciuc Lab & Parrish Payne<protocols@opentrons.com>"
+    }
+
+# requirements
+requirements = {"robotType": "Flex", "apiLevel": "2.20"}
+
+def add_parameters(parameters):
+    parameters.add_int(
+        variable_name="num_samp",
+        display_name="Number of samples",
+        description="Number of samples in 96-well plate.",
+        default=48,
+        minimum=1,
+        maximum=96,
+        unit="qty",
+    )
+    parameters.add_int(
+        variable_name="starting_col",
+        display_name="Sample Starting Column",
+        description="Starting column in 96-well plate",
+        choices=[
+            {"display_name": "1st", "value": 0},
+            {"display_name": "2nd", "value": 1},
+            {"display_name": "3rd", "value": 2},
+            {"display_name": "4th", "value": 3},
+            {"display_name": "5th", "value": 4},
+            {"display_name": "6th", "value": 5},
+            {"display_name": "7th", "value": 6},
+            {"display_name": "8th", "value": 7},
+            {"display_name": "9th", "value": 8},
+            {"display_name": "10th", "value": 9},
+            {"display_name": "11th", "value": 10},
+            {"display_name": "12th", "value": 11},
+        ],
+        default=0,
+    )
+    parameters.add_str(
+        variable_name = "elution_plate_type", display_name = "Elution Plate", default = "zymoelution_96_wellplate_90ul", choices = [
+            {"display_name": "Opentrons Tough PCR Plate, 200", "value": "opentrons_96_wellplate_200ul_pcr_full_skirt"},
+            {"display_name": "NEST 96-well PCR Plate, 100 µL", "value": "nest_96_wellplate_100ul_pcr_full_skirt"},
+            {"display_name": "ZymoElution 96-Well, 90 µL", "value": "zymoelution_96_wellplate_90ul"}
+        ]
+    )
+    parameters.add_str(
+        variable_name = "collection_plate_type", display_name = "Collection Plate", default = "zymocollection_96_wellplate_1200ul", choices = [
+            {"display_name": "ZymoCollection 96-well, 1.2mL", "value": "zymocollection_96_wellplate_1200ul"}
+        ]
+    )
+    parameters.add_bool(
+        variable_name="dry_run",
+        display_name="Dry Run",
+        description=(
+            "Skips duplicate steps and shortens incubations."
+        ),
+        default=False
+    )
+    #Parameter added to control location of pipette
+    parameters.add_str(
+        variable_name = "pipette_side",
+        display_name = "8-channel P1000 Location",
+        default = "left",
+        choices = [{"display_name": "Left", "value": "left"},
+        {"display_name": "Right", "value": "right"}]
+    )
+
+    #Allows user to keep the HEPA module prompts around the dry, the only pauses left in this protocol
+    parameters.add_bool(
+        variable_name="hepa_pauses",
+        display_name="HEPA Module Pauses",
+        description="On = pause to turn the HEPA module on before the dry and off after it, Off = no pauses",
+        default=False
+    )
+
+    #Allows user to record every command of the run (phase, CSV row, timing, volume, tip, well) to a JSON-lines file
+    parameters.add_bool(
+        variable_name="event_trace",
+        display_name="Event Trace",
+        description="On = write a JSON-lines trace of every command to the robot's user storage",
+        default=False
+    )
+
+#Tips left in a set of 96 tip racks, shared by every pipette (single or 8-channel) that picks up from them. Each tip is
+#one byte of a bytearray (free, used or reserved) in the racks' column order, and the free tips and full free columns
+#are counted as tips get used, so remaining() is O(1). Reserved tips, ex. columns kept for parking, are never handed
+#out and stay as they are on refill(). state() gives a JSON-friendly copy of the tracker that restore() reads back.
+class TipTracker:
+    __slots__ = ("racks", "_wells", "_state", "_column_free", "_free", "_free_columns")
+    FREE, USED, RESERVED = 0, 1, 2
+
+    def __init__(self, racks):
+        self.racks = list(racks)
+        #Every tip, A1, B1 ... H1, A2 ... of the first rack, then the next rack
+        self._wells = [well for rack in self.racks for well in rack.wells()]
+        self._state = bytearray(len(self._wells))
+        self._recount()
+
+    #Position of a tip well in the tracker
+    def _index(self, well):
+        rack_number = next((number for number, rack in enumerate(self.racks) if rack is well.parent), None)
+        if rack_number is None:
+            raise RuntimeError(f'{well} is not in the tip racks {", ".join(str(rack) for rack in self.racks)}')
+        return rack_number * 96 + (int(well.well_name[1:]) - 1) * 8 + ord(well.well_name[0]) - ord("A")
+
+    def _mark(self, index, tip_state):
+        if self._state[index] == self.FREE:
+            self._free -= 1
+            column = index // 8
+            if self._column_free[column] == 8:
+                self._free_columns -= 1
+            self._column_free[column] -= 1
+        self._state[index] = tip_state
+
+    def _recount(self):
+        self._column_free = bytearray(self._state[start:start + 8].count(self.FREE) for start in range(0, len(self._state), 8))
+        self._free = self._state.count(self.FREE)
+        self._free_columns = self._column_free.count(8)
+
+    #Keep tips out of the pick ups, with channels=8 each well reserves itself and the 7 wells below it
+    def reserve(self, wells, channels=1):
+        for well in wells:
+            first = self._index(well)
+            for index in range(first, first + channels):
+                self._mark(index, self.RESERVED)
+
+    #Start picking up at this tip, every free tip before it counts as used (like the pipette's starting_tip)
+    def skipTo(self, well):
+        for index in range(self._index(well)):
+            if self._state[index] == self.FREE:
+                self._mark(index, self.USED)
+
+    #Free tips, or full free columns for an 8-channel
+    def remaining(self, channels=1):
+        return self._free if channels == 1 else self._free_columns
+
+    #Tips (or columns) the racks without reserved tips hold when full, what refill() gives back
+    def refillable(self, channels=1):
+        racks = sum(1 for number in range(len(self.racks)) if self.RESERVED not in self._state[number * 96:(number + 1) * 96])
+        return racks * (96 if channels == 1 else 12)
+
+    #Next tip (or the top of the next full column for an 8-channel), marked as used, None if there is none left
+    def next(self, channels=1):
+        if self.remaining(channels) == 0:
+            return None
+        if channels == 1:
+            first = self._state.find(self.FREE)
+        else:
+            first = self._column_free.find(8) * 8
+        for index in range(first, first + channels):
+            self._mark(index, self.USED)
+        return self._wells[first]
+
+    #Pick up the next tip with the pipette, returns the tip well
+    def pickUp(self, pipette):
+        well = self.next(pipette.channels)
+        if well is None:
+            raise RuntimeError(f'Out of tips for the {pipette.name}, add more tip racks')
+        pipette.pick_up_tip(well)
+        return well
+
+    #The operator swapped the racks without reserved tips for full ones
+    def refill(self):
+        for number in range(len(self.racks)):
+            if self.RESERVED not in self._state[number * 96:(number + 1) * 96]:
+                self._state[number * 96:(number + 1) * 96] = bytes(96)
+        self._recount()
+
+    def state(self):
+        return {"racks": [f"{rack.load_name} in slot {rack.parent}" for rack in self.racks], "tips": self._state.hex()}
+
+    def restore(self, state):
+        if state["racks"] != self.state()["racks"]:
+            raise RuntimeError('The saved tip state is for other tip racks: ' + ", ".join(state["racks"]))
+        self._state = bytearray.fromhex(state["tips"])
+        self._recount()
+
+
+#Opt-in trace of the run: every pipette, module, delay and pause command is written to a JSON-lines file with
+#the phase (from the "~~~Phase~~~" comments), the CSV row being executed, its monotonic start/end time, the volume,
+#the tip on the pipette and the labware/well. Set row before the commands of each CSV row (an int, or a list of
+#rows for a multi-dispense). When disabled every method does nothing, so the protocol can always call it.
+class EventTrace:
+    def __init__(self, protocol, enabled, name="run"):
+        self.row = None
+        self.phase = "Setup"
+        #Loaded labware keyed by their CSV names, set it once the labware is loaded so events use the table's names
+        self.labware_dict = {}
+        self.path = None
+        self._file = None
+        self._stack = []
+        self._tips = {}
+        self._count = 0
+        if not enabled:
+            return
+        #On the robot traces go to the user storage, kept between runs. Simulations (and the App analysis) use a temp folder
+        folder = os.path.join(tempfile.gettempdir(), "botany_traces") if protocol.is_simulating() else "/data/user_storage/botany_traces"
+        self.path = os.path.join(folder, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.jsonl')
+        try:
+            os.makedirs(folder, exist_ok=True)
+            #Line buffered, so the trace is complete up to the last command even if the run is cancelled
+            self._file = open(self.path, "w", buffering=1)
+        except OSError as error:
+            protocol.comment(f'Event trace disabled, cannot write {self.path}: {error}')
+            return
+        self._unsubscribe = protocol.broker.subscribe("command", self._onMessage)
+        protocol.comment(f'Event trace: {self.path}')
+
+    #CSV name (or load name) and deck slot of a labware, labware on a module takes the module's slot
+    def _labware(self, labware):
+        labware_name = next((name for name, loaded in self.labware_dict.items() if loaded is labware), labware.load_name)
+        slot = labware.parent if isinstance(labware.parent, str) else getattr(labware.parent, "parent", None)
+        return labware_name, slot
+
+    #Labware name, slot and well of a command location (a Well, a Location or a disposal location like the trash)
+    def _place(self, location):
+        if location is None:
+            return None, None, None
+        labware_like = getattr(location, "labware", None)
+        well = labware_like.as_well() if labware_like is not None and labware_like.is_well else location
+        if hasattr(well, "well_name"):
+            return self._labware(well.parent) + (well.well_name,)
+        if labware_like is not None and labware_like.is_labware:
+            return self._labware(labware_like.object) + (None,)
+        return type(location).__name__, None, None
+
+    def _onMessage(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][2] = True
+            self._stack.append([message, time.monotonic(), False])
+            return
+        before, start, has_children = self._stack.pop()
+        name = before["name"].replace("command.", "")
+        payload = before["payload"]
+        text = payload.get("text", "")
+        if name == "COMMENT":
+            if text.strip().startswith("~") and text.strip().endswith("~"):
+                self.phase = text.strip().strip("~").strip()
+            return
+        #Commands made of other commands (transfer, distribute, mix...) are traced through their parts
+        if has_children:
+            return
+        instrument = payload.get("instrument")
+        mount = instrument.mount if instrument is not None else None
+        labware, slot, well = self._place(payload.get("location"))
+        if name == "PICK_UP_TIP":
+            self._tips[mount] = f"{slot}/{well}"
+        event = {"seq": self._count, "command": name, "phase": self.phase, "row": self.row,
+                 "start": round(start, 4), "end": round(time.monotonic(), 4),
+                 "volume": payload.get("volume"), "pipette": mount, "tip": self._tips.get(mount),
+                 "labware": labware, "slot": slot, "well": well, "text": text}
+        if message.get("error") is not None:
+            event["error"] = str(message["error"])
+        if name in ("DROP_TIP", "DROP_TIP_IN_DISPOSAL_LOCATION", "RETURN_TIP"):
+            self._tips.pop(mount, None)
+        self._file.write(json.dumps(event) + "\n")
+        self._count += 1
+
+    #Stop tracing and close the file, call at the end of the run
+    def close(self):
+        if self._file is not None:
+            self._unsubscribe()
+            self._file.close()
+            self._file = None
+
+# protocol run function
+def run(ctx: protocol_api.ProtocolContext):
+
+    #Opt-in JSON-lines trace of every command of the run (see EventTrace)
+    event_trace = EventTrace(ctx, ctx.params.event_trace, name=metadata["protocolName"])
+
+    # run time parameters
+    num_samp = ctx.params.num_samp
+    starting_col = ctx.params.starting_col
+    settling_time = 1 # bead settling time on the magnetic block
+    elution_plate_type = ctx.params.elution_plate_type
+    collection_plate_type = ctx.params.collection_plate_type
+    dry_run = ctx.params.dry_run     ## ctx.params.dry_run skips steps & shorthens incubations for quicker run-time/testing
+    pipette_location = ctx.params.pipette_side
+    hepa_pauses = ctx.params.hepa_pauses
+
+    # variables
+    m1000_mount = str(pipette_location)
+
+    if (num_samp < 1) or (num_samp > (96 - starting_col * 8)):
+        raise Exception('\n\n~~~~~~~Parameters Out of Bounds~~~~~~~~\n')
+
+    num_cols = math.ceil(num_samp/8)
+    adj_col = num_cols+starting_col
+
+    # Deck Setup
+    # the collection plate starts on the heater-shaker (D1), the gripper takes it to the magnetic block (C1) and back
+    hs_mod = ctx.load_module('heaterShakerModuleV1', location='D1')
+    hs_mod.close_labware_latch()
+    # the samples sit on the heater-shaker for the bead binding, make sure it isn't still warm from a previous run
+    hs_mod.deactivate_heater()
+    mag_block = ctx.load_module('magneticBlockV1', location='C1')
+    ctx.load_trash_bin('A3')
+
+    # labware
+    elution_plate = ctx.load_labware(elution_plate_type, location='D3', label="Elution Plate")
+    collection_plate = hs_mod.load_labware(collection_plate_type, label="Collection Plate")
+    dw_plate = ctx.load_labware("nest_96_wellplate_2ml_deep", location='C2', label="NEST 2 mL Deepwell Plate")
+    reservoir = ctx.load_labware("nest_12_reservoir_15ml", location='D2', label="NEST 12-well Reservoir")
+    waste_reservoir = ctx.load_labware('nest_1_reservoir_195ml', location='B2', label="NEST 1-well Reservoir")  # empty (trash)
+    # 200 µL tips for the 30-40 µL bead, elution buffer and eluate transfers, 1000 µL tips for the washes and the
+    # supernatant so every transfer is a single trip
+    tips200 = [ctx.load_labware("opentrons_flex_96_tiprack_200ul", location=slot, label="200 µL Tiprack")
+               for slot in ['C3', 'A2']]
+    tips1000 = [ctx.load_labware("opentrons_flex_96_tiprack_1000ul", location='B3', label="1000 µL Tiprack")]
+    parkingrack = ctx.load_labware('opentrons_flex_96_tiprack_1000ul', 'B1', 'tiprack for parking')
+    parking_spots = parkingrack.rows()[0][starting_col:adj_col]
+
+    # pipettes
+    m1000 = ctx.load_instrument('flex_8channel_1000', m1000_mount, tip_racks=tips200 + tips1000)
+
+    m1000.flow_rate.aspirate = 50
+    m1000.flow_rate.dispense = 150
+    m1000.flow_rate.blow_out = 300
+
+    # the 1000 µL tips hold one trip of liquid plus the 20 µL air gap
+    trip_max = 1000 - 20
+
+    # mapping
+    binding_buffer = dw_plate.rows()[0][0]          # Binding bead buffer in column 1 (400uL in each well)
+    elution_buffer = dw_plate.rows()[0][1]          # Elution buffer in column 2 (560uL in each well)
+    endo_wash = reservoir.rows()[0][:2]             # Endo wash buffer in columns 1-2 (12mL in each well)
+    zyppy_wash = reservoir.rows()[0][2:8]           # Zyppy wash buffer in columns 3-8 (12mL in each well)
+    collection_wells = collection_plate.rows()[0][starting_col:adj_col]   # Zymo collection plate (650uL clear lysate loaded in each well)
+    elution_wells = elution_plate.rows()[0][:num_cols]
+    waste = waste_reservoir.wells()[0].top()
+
+    # LOADING LIQUID
+    binding_buffer_color = ctx.define_liquid(
+    name="Binding Bead Buffer",
+    description="µL per sample",
+    display_color="#008000", # Green
+    )
+    binding_buffer_vol = 30 # µL per sample
+
+    elution_buffer_color = ctx.define_liquid(
+    name="Elution Buffer",
+    description="µL per wash",
+    display_color="#FFFF00", # Yellow
+    )
+    elution_buffer_vol = 40 # µL per sample
+
+    endo_wash_color = ctx.define_liquid(
+    name="Endo Wash Buffer",
+    description="µL per well",
+    display_color="#0000FF", # Blue
+    )
+    endo_wash_vol = 200
+
+    zyppy_wash_color = ctx.define_liquid(
+    name="Zyppy Wash Buffer",
+    description="µL per well",
+    display_color="#FFA500", # Orange
+    )
+
+    sample_color = ctx.define_liquid(
+    name="Samples",
+    description="µL per well",
+    display_color="#FF0000", # Red
+    )
+    sample_vol = 50 # 50 µL of sample
+
+    for well in dw_plate.columns()[0]:
+        well.load_liquid(liquid=binding_buffer_color, volume=binding_buffer_vol)
+    for well in dw_plate.columns()[1]:
+        well.load_liquid(liquid=elution_buffer_color, volume=elution_buffer_vol)
+
+    for well in reservoir.rows()[0][:2]:
+        well.load_liquid(liquid=endo_wash_color, volume=endo_wash_vol)
+    for well in reservoir.rows()[0][2:8]:
+        well.load_liquid(liquid=zyppy_wash_color, volume=endo_wash_vol)
+
+    adj_well = starting_col*8
+    for well in collection_plate.wells()[adj_well:num_samp+adj_well]:
+        well.load_liquid(liquid=sample_color, volume=sample_vol)
+
+    # the supernatant of a full plate (139 mL) always fits in the waste reservoir, there is no pause to empty it
+    removals = [650, 200, 300] + ([300] if not dry_run else [])
+    ctx.comment(f"Liquid waste: {sum(removals) * 8 * num_cols / 1000:.1f} mL expected, "
+                f"{waste_reservoir.wells()[0].max_volume / 1000:.1f} mL reservoir")
+
+    # helper functions
+    # fresh 1000 µL tips come from their rack, then from the columns of the parking rack the samples don't park in
+    tips_small = TipTracker(tips200)
+    tips_large = TipTracker(tips1000 + [parkingrack])
+    tips_large.reserve(parking_spots, channels=8)
+    ctx.comment(f'{tips_small.remaining(8)} columns of fresh 200 µL tips, {tips_large.remaining(8)} columns of fresh 1000 µL tips')
+
+    def _move_plate(destination):
+        # the gripper moves the collection plate, the heater-shaker latch has to be open to take it or give it back
+        hs_mod.open_labware_latch()
+        ctx.move_labware(labware=collection_plate, new_location=destination, use_gripper=True)
+        if destination is hs_mod:
+            hs_mod.close_labware_latch()
+
+    def _settle():
+        ctx.delay(minutes=settling_time if not dry_run else 0.1, msg='\n\n~~~~~Incubating on magnetic block for ' + str(settling_time) + ' minutes~~~~~~\n')
+
+    def _hepa(msg):
+        if hepa_pauses:
+            ctx.pause(msg)
+
+    def remove_supernatant(vol, park):
+        """
+        `remove_supernatant` will transfer supernatant from the deepwell
+        extraction plate to the liquid waste reservoir.
+        :param vol (float): The amount of volume to aspirate from all deepwell
+                            sample wells and dispense in the liquid waste.
+        :param park (boolean): Whether to pick up sample-corresponding tips
+                               in the 'parking rack' or to pick up new tips.
+        """
+        m1000.flow_rate.aspirate = 30
+        num_trans = math.ceil(vol/trip_max)
+        vol_per_trans = vol/num_trans
+        for i, (m, spot) in enumerate(zip(collection_wells, parking_spots)):
+            if park:
+                m1000.pick_up_tip(spot)
+            else:
+                tips_large.pickUp(m1000)
+            side = -1 if i % 2 == 0 else 1
+            loc = m.bottom(z=4).move(Point(x=side*1.3))
+            for _ in range(num_trans):
+                if m1000.current_volume > 0:
+                    # void air gap if necessary
+                    m1000.dispense(m1000.current_volume, m.top())
+                    m1000.blow_out()
+                m1000.move_to(m.center())
+                m1000.transfer(vol_per_trans, loc, waste, new_tip='never',
+                               air_gap=20)
+                m1000.blow_out(waste)
+                m1000.air_gap(20)
+            if park:
+                m1000.drop_tip(spot)
+            else:
+                m1000.drop_tip()
+        m1000.flow_rate.aspirate = 150
+
+    def mix_bind(vol, mix_reps):
+        """
+        `mix_bind` will mix each channel of binding beads then transfer binding buffer.
+        :param vol (float): The amount of volume to aspirate from the elution
+                            buffer source and dispense to each well containing
+                            beads.
+        :param mix_reps (int): The number of repititions to mix the beads before transfer.
+        """
+        tips_small.pickUp(m1000)
+        for m in collection_wells:
+            for _ in range(mix_reps):
+                m1000.aspirate(vol, binding_buffer.bottom(1))
+                m1000.dispense(vol, binding_buffer.bottom(5))
+            m1000.transfer(vol, binding_buffer, m.top(), air_gap=20,
+                           new_tip='never')
+            m1000.blow_out(m.top(-2))
+            m1000.air_gap(20)
+        m1000.drop_tip()
+
+    def wash(vol, source):
+        """
+        `wash` will perform bead washing for the extraction protocol.
+        :param vol (float): The amount of volume to aspirate from each
+                            source and dispense to each well containing beads.
+        :param source (List[Well]): A list of wells from where liquid will be
+                                    aspirated. If the length of the source list
+                                    > 1, `wash` automatically calculates
+                                    the index of the source that should be
+                                    accessed.
+        """
+        num_trans = math.ceil(vol/trip_max)
+        vol_per_trans = vol/num_trans
+
+        tips_large.pickUp(m1000)
+        for i, m in enumerate(collection_wells):
+            src = source[i//(12//len(source))]
+            for n in range(num_trans):
+                if m1000.current_volume > 0:
+                    m1000.dispense(m1000.current_volume, src.top())
+                m1000.transfer(vol_per_trans, src, m.top(), air_gap=20,
+                               new_tip='never')
+                if n < num_trans - 1:  # only air_gap if going back to source
+                    m1000.air_gap(20)
+            m1000.blow_out(m.top())
+            m1000.air_gap(20)
+        m1000.drop_tip()
+
+    def custom_transfer(vol, source):
+        tips_small.pickUp(m1000)
+        for m in collection_wells:
+            m1000.transfer(vol, source, m.top(), air_gap=20, new_tip='never')
+            m1000.blow_out()
+        m1000.drop_tip()
+
+    def elute(vol):
+        """
+        `elute` will transfer eluate from the deepwell extraciton plate to the
+        final clean elutions PCR plate to complete the extraction protocol.
+        :param vol (float): The amount of volume to aspirate from the elution
+                            buffer source and dispense to each well containing
+                            beads.
+        """
+        m1000.flow_rate.aspirate = 47
+        for i, (m, e) in enumerate(zip(collection_wells, elution_wells)):
+            tips_small.pickUp(m1000)
+            side = -1 if i % 2 == 0 else 1
+            loc = m.bottom(z=2).move(Point(x=side*1.3))
+            m1000.transfer(vol, loc, e.bottom(3), air_gap=20, new_tip='never')
+            m1000.blow_out(e.top(-2))
+            m1000.air_gap(20)
+            m1000.drop_tip()
+        m1000.flow_rate.aspirate = 94
+
+    #### Protocol Steps Begin Here ####
+    # Same steps and volumes as BOTany5-MagBead, the plate moves between the heater-shaker and the magnet are done by
+    # the gripper instead of a manual pause
+
+    ctx.comment('\n\n~~~Mix & Transfer Binding Bead Buffer to Collection Plate~~~~\n')
+    mix_bind(30, mix_reps=5)
+
+    ctx.comment('\n\n~~~Shake 5 min @ 1000 RPM~~~~~\n')
+    hs_mod.set_and_wait_for_shake_speed(1000)
+    ctx.delay(minutes=5)
+    hs_mod.deactivate_shaker()
+
+    _move_plate(mag_block)
+    _settle()
+    ctx.comment('\n\n~~~~~~~~~~~~Remove Supernatant~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+    remove_supernatant(650, park=True)
+    _move_plate(hs_mod)
+
+    ctx.comment('\n\n~~~~~~Transfer Endo Wash Buffer to Collection Plate~~~~~~~~~~\n')
+    wash(200, endo_wash)
+    hs_mod.set_and_wait_for_shake_speed(1100)
+    ctx.delay(seconds=90)
+    hs_mod.deactivate_shaker()
+
+    _move_plate(mag_block)
+    _settle()
+    ctx.comment('\n\n~~~~~~~~~~~~Remove Supernatant~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+    remove_supernatant(200, park=True)
+    _move_plate(hs_mod)
+
+    # Zyppy washes, the 2nd one is skipped in a dry run
+    for wash_number in range(1 if dry_run else 2):
+        ctx.comment('\n\n~~~~~~' + ('1st' if wash_number == 0 else '2nd') + ' Wash with Zyppy Wash Buffer~~~~~~~~~~~~~~~~~~~~~~~~\n')
+        wash(300, zyppy_wash)
+        hs_mod.set_and_wait_for_shake_speed(1200)
+        ctx.delay(seconds=90)
+        hs_mod.deactivate_shaker()
+
+        _move_plate(mag_block)
+        # after the last wash the heater-shaker is empty until the dry: pre-heat it while the beads settle and the
+        # supernatant is removed
+        if wash_number == (0 if dry_run else 1):
+            hs_mod.set_target_temperature(75)
+        _settle()
+        ctx.comment('\n\n~~~~~~~~~~~~Remove Supernatant~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+        remove_supernatant(300, park=True)
+        _move_plate(hs_mod)
+
+    _hepa('\n\n~~~~~~~~~~~~Manually Turn On the HEPA Module~~~~~~~~~~~~~~~~~~~\n')
+    ctx.comment('\n\n~~~~~~~~~~Shake 10 Minutes @ 1800 RPM 75C~~~~~~~~~~~~~~~~~~~~~\n')
+    hs_mod.wait_for_temperature()
+    hs_mod.set_and_wait_for_shake_speed(1800)
+    ctx.delay(minutes=10 if not dry_run else 0.1)
+    hs_mod.deactivate_shaker()
+    hs_mod.deactivate_heater()
+    _hepa('\n\n~~~~~~~~~~~~Manually Turn Off the HEPA Module~~~~~~~~~~~~~~~~~~\n')
+
+    ctx.comment('\n\n~~~~~~~~~~Transfer Elution Buffer to Collection Plate~~~~~~~~\n')
+    custom_transfer(40, elution_buffer)
+    ctx.comment('\n\n~~~Shake 3 min @ 1000 RPM~~~~~\n')
+    hs_mod.set_and_wait_for_shake_speed(1000)
+    ctx.delay(minutes=3)
+    hs_mod.deactivate_shaker()
+
+    _move_plate(mag_block)
+    _settle()
+    ctx.comment('\n\n~~~~~~~~~~Transfer Eluate to Elution Plate~~~~~~~~~~~~~~~~~~~\n')
+    elute(30)
+    hs_mod.open_labware_latch()
+
+    ctx.comment('\n\n~~~~~~~~~~~~~~~~~~~Protocol Complete~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+
+    #Stop the event trace
+    event_trace.close()
@@ -3,6 +3,9 @@ from opentrons import protocol_api
 import csv
 import json
 import math
+import os
+import tempfile
+import time
 
 #-------(Modify) Change name and description to suit your needs (1)
 metadata = {
@@ -14,12 +17,428 @@ metadata = {
     }
 #-------End of modifications (1)
 
-#Function that gets labware object to use given the string name of variable
+#Function that gets labware object to use given the string name of variable, or None if there is no such labware
 def getLabwareObject(labware_dict, labware_name):
-    for key, value in labware_dict.items():
-        if str(key) == str(labware_name):
-            return value
-    return
+    return labware_dict.get(str(labware_name))
+
+#Dictionary of the loaded labware keyed by the names used in the CSV, that also remembers the wells of each labware.
+#The Opentrons API rebuilds its well lists every time labware[well_name], rows() or columns() is called,
+#so loops that visit many wells should look them up here instead.
+class LabwareRegistry(dict):
+    __slots__ = ("_wells", "_rows", "_columns")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wells = {}
+        self._rows = {}
+        self._columns = {}
+
+    def __setitem__(self, labware_name, labware):
+        super().__setitem__(labware_name, labware)
+        #Forget the wells of any labware that was previously loaded under this name
+        self._wells.pop(labware_name, None)
+        self._rows.pop(labware_name, None)
+        self._columns.pop(labware_name, None)
+
+    #Well name -> Well object for the given labware, ex. {"A1": Well, ...}
+    def wells_by_name(self, labware_name):
+        wells = self._wells.get(labware_name)
+        if wells is None:
+            wells = self._wells[labware_name] = self[labware_name].wells_by_name()
+        return wells
+
+    def well(self, labware_name, well_name):
+        return self.wells_by_name(labware_name)[well_name]
+
+    def rows(self, labware_name):
+        rows = self._rows.get(labware_name)
+        if rows is None:
+            rows = self._rows[labware_name] = self[labware_name].rows()
+        return rows
+
+    def columns(self, labware_name):
+        columns = self._columns.get(labware_name)
+        if columns is None:
+            columns = self._columns[labware_name] = self[labware_name].columns()
+        return columns
+
+#Compiled pipetting step, one per non-empty row of a "Pipetting Steps" table in the CSV.
+#Labware and well objects are resolved once, before any robot motion, so the transfer loop only issues pipette commands.
+class TransferStep:
+    __slots__ = ("row", "source_labware", "source_well", "source", "destination_labware", "destination_well",
+                 "destination", "volume", "new_tip", "pipette_choice")
+
+    def __init__(self, row, source_labware, source_well, source, destination_labware, destination_well,
+                 destination, volume, new_tip, pipette_choice=None):
+        self.row = row #Row number in the spreadsheet, for error messages
+        self.source_labware = source_labware
+        self.source_well = source_well
+        self.source = source #Resolved Well object
+        self.destination_labware = destination_labware
+        self.destination_well = destination_well
+        self.destination = destination #Resolved Well object
+        self.volume = volume
+        self.new_tip = new_tip #True if the "Pick_Up_Tip" cell is TRUE
+        self.pipette_choice = pipette_choice #"Left"/"Right", or None for tables without a Pipette_Choice column
+
+    def __repr__(self):
+        return (f'TransferStep(row {self.row}: {self.volume} uL {self.source_labware} {self.source_well} -> '
+                f'{self.destination_labware} {self.destination_well}, new_tip={self.new_tip})')
+
+#Function that gets the Well object for a labware/well name pair, stopping the protocol with the CSV row number if either is wrong
+def resolveWell(labware_dict, labware_name, well_name, row):
+    if getLabwareObject(labware_dict, labware_name) is None:
+        raise RuntimeError(f'CSV row {row}: unknown labware "{labware_name}"')
+    try:
+        return labware_dict.well(labware_name, well_name)
+    except KeyError:
+        raise RuntimeError(f'CSV row {row}: "{well_name}" is not a well of "{labware_name}"')
+
+#Function that compiles one "Pipetting Steps" table of the CSV into a list of TransferSteps.
+#first_col is the index of the Source_Labware column, the table continues with Source_Well, Destination_Labware,
+#Destination_Well, Transfer_Volume, Pick_Up_Tip and (if has_pipette_col) Pipette_Choice.
+def compileTransferPlan(protocol, csv_data_list, labware_dict, first_col, has_pipette_col=False):
+    num_cols = 7 if has_pipette_col else 6
+    plan = []
+
+    #Discard the first two rows of csv, since those are the titles of the tables and columns. Spreadsheet rows start at 1.
+    for row, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [str(cell).strip() for cell in csv_row[first_col:first_col + num_cols]]
+        #Check if the current row is empty, if it's empty then skip it
+        if len(cells) == 0 or cells[0] == "":
+            continue
+        if len(cells) < num_cols:
+            raise RuntimeError(f'CSV row {row}: expected {num_cols} pipetting columns, found {len(cells)}')
+
+        source_labware, source_well, destination_labware, destination_well, transfer_volume, pick_up_tip = cells[:6]
+        pipette_choice = cells[6] if has_pipette_col else None
+
+        if pick_up_tip not in ('TRUE', 'FALSE'):
+            protocol.comment('Please specify whether to use new or same tip')
+            continue
+        try:
+            volume = float(transfer_volume)
+        except ValueError:
+            raise RuntimeError(f'CSV row {row}: transfer volume "{transfer_volume}" is not a number')
+
+        plan.append(TransferStep(
+            row,
+            source_labware, source_well, resolveWell(labware_dict, source_labware, source_well, row),
+            destination_labware, destination_well, resolveWell(labware_dict, destination_labware, destination_well, row),
+            volume, pick_up_tip == 'TRUE', pipette_choice))
+
+    return plan
+
+#Seconds the robot needs to drop a tip in the trash and pick up the next one, used to estimate time saved
+TIP_CHANGE_SECONDS = 10
+
+#Function that counts the tips a plan picks up: the first step of each pipette, plus every step that asks for a new tip
+def countTips(plan):
+    pipettes_used = set()
+    tips = 0
+    for step in plan:
+        if step.new_tip == True or step.pipette_choice not in pipettes_used:
+            tips += 1
+            pipettes_used.add(step.pipette_choice)
+    return tips
+
+#Function that decides the Pick_Up_Tip of every step in place of the table, from what each tip has touched. A tip is kept
+#for the next step of its pipette only if that step aspirates from the same source and the tip has not been in any
+#other liquid: a dispense into a well touches its liquid unless it is at the top of the well (top_dispense), and a well
+#holding nothing but the source's liquid can't carry anything back into the source. initial_wells is the set of
+#(labware, well) names that hold liquid before the run starts. Returns (new_plan, tips_saved, seconds_saved) compared to
+#the Pick_Up_Tip column, tips_saved is below 0 when the table reused tips this rule would not.
+def planTipReuse(plan, initial_wells, top_dispense=False):
+    contents = {} #(labware, well) -> set of sources dispensed into it so far
+    tip_state = {} #pipette -> [(labware, well) of the source its tip aspirated from, tip touched no other liquid]
+    new_plan = []
+    for step in plan:
+        source_key = (step.source_labware, step.source_well)
+        destination_key = (step.destination_labware, step.destination_well)
+        state = tip_state.get(step.pipette_choice)
+        new_tip = not (state is not None and state[0] == source_key and state[1] == True)
+        if new_tip == True:
+            state = tip_state[step.pipette_choice] = [source_key, True]
+        well_contents = contents.setdefault(destination_key, set())
+        if top_dispense == False and (destination_key in initial_wells or len(well_contents - {source_key}) > 0):
+            state[1] = False
+        well_contents.add(source_key)
+        new_plan.append(TransferStep(
+            step.row, step.source_labware, step.source_well, step.source,
+            step.destination_labware, step.destination_well, step.destination,
+            step.volume, new_tip, step.pipette_choice))
+
+    tips_saved = countTips(plan) - countTips(new_plan)
+    return new_plan, tips_saved, tips_saved * TIP_CHANGE_SECONDS
+
+#Tips left in a set of 96 tip racks, shared by every pipette (single or 8-channel) that picks up from them. Each tip is
+#one byte of a bytearray (free, used or reserved) in the racks' column order, and the free tips and full free columns
+#are counted as tips get used, so remaining() is O(1). Reserved tips, ex. columns kept for parking, are never handed
+#out and stay as they are on refill(). state() gives a JSON-friendly copy of the tracker that restore() reads back.
+class TipTracker:
+    __slots__ = ("racks", "_wells", "_state", "_column_free", "_free", "_free_columns")
+    FREE, USED, RESERVED = 0, 1, 2
+
+    def __init__(self, racks):
+        self.racks = list(racks)
+        #Every tip, A1, B1 ... H1, A2 ... of the first rack, then the next rack
+        self._wells = [well for rack in self.racks for well in rack.wells()]
+        self._state = bytearray(len(self._wells))
+        self._recount()
+
+    #Position of a tip well in the tracker
+    def _index(self, well):
+        rack_number = next((number for number, rack in enumerate(self.racks) if rack is well.parent), None)
+        if rack_number is None:
+            raise RuntimeError(f'{well} is not in the tip racks {", ".join(str(rack) for rack in self.racks)}')
+        return rack_number * 96 + (int(well.well_name[1:]) - 1) * 8 + ord(well.well_name[0]) - ord("A")
+
+    def _mark(self, index, tip_state):
+        if self._state[index] == self.FREE:
+            self._free -= 1
+            column = index // 8
+            if self._column_free[column] == 8:
+                self._free_columns -= 1
+            self._column_free[column] -= 1
+        self._state[index] = tip_state
+
+    def _recount(self):
+        self._column_free = bytearray(self._state[start:start + 8].count(self.FREE) for start in range(0, len(self._state), 8))
+        self._free = self._state.count(self.FREE)
+        self._free_columns = self._column_free.count(8)
+
+    #Keep tips out of the pick ups, with channels=8 each well reserves itself and the 7 wells below it
+    def reserve(self, wells, channels=1):
+        for well in wells:
+            first = self._index(well)
+            for index in range(first, first + channels):
+                self._mark(index, self.RESERVED)
+
+    #Start picking up at this tip, every free tip before it counts as used (like the pipette's starting_tip)
+    def skipTo(self, well):
+        for index in range(self._index(well)):
+            if self._state[index] == self.FREE:
+                self._mark(index, self.USED)
+
+    #Free tips, or full free columns for an 8-channel
+    def remaining(self, channels=1):
+        return self._free if channels == 1 else self._free_columns
+
+    #Tips (or columns) the racks without reserved tips hold when full, what refill() gives back
+    def refillable(self, channels=1):
+        racks = sum(1 for number in range(len(self.racks)) if self.RESERVED not in self._state[number * 96:(number + 1) * 96])
+        return racks * (96 if channels == 1 else 12)
+
+    #Next tip (or the top of the next full column for an 8-channel), marked as used, None if there is none left
+    def next(self, channels=1):
+        if self.remaining(channels) == 0:
+            return None
+        if channels == 1:
+            first = self._state.find(self.FREE)
+        else:
+            first = self._column_free.find(8) * 8
+        for index in range(first, first + channels):
+            self._mark(index, self.USED)
+        return self._wells[first]
+
+    #Pick up the next tip with the pipette, returns the tip well
+    def pickUp(self, pipette):
+        well = self.next(pipette.channels)
+        if well is None:
+            raise RuntimeError(f'Out of tips for the {pipette.name}, add more tip racks')
+        pipette.pick_up_tip(well)
+        return well
+
+    #The operator swapped the racks without reserved tips for full ones
+    def refill(self):
+        for number in range(len(self.racks)):
+            if self.RESERVED not in self._state[number * 96:(number + 1) * 96]:
+                self._state[number * 96:(number + 1) * 96] = bytes(96)
+        self._recount()
+
+    def state(self):
+        return {"racks": [f"{rack.load_name} in slot {rack.parent}" for rack in self.racks], "tips": self._state.hex()}
+
+    def restore(self, state):
+        if state["racks"] != self.state()["racks"]:
+            raise RuntimeError('The saved tip state is for other tip racks: ' + ", ".join(state["racks"]))
+        self._state = bytearray.fromhex(state["tips"])
+        self._recount()
+
+#Function that picks up the next tip of the tracker, pausing for the operator to swap in full tip racks when the
+#loaded ones are used up. Returns the tip well
+def pickUpTip(protocol, pipette, tip_tracker):
+    if tip_tracker.remaining(pipette.channels) == 0:
+        slots = ', '.join(str(rack.parent) for rack in tip_tracker.racks)
+        protocol.pause(f'Replace the {pipette.max_volume:g} uL tip racks (slot {slots}) with full ones before resuming')
+        tip_tracker.refill()
+        pipette.reset_tipracks()
+    return tip_tracker.pickUp(pipette)
+
+#Deck slots of the primer tube rack pairs, (100uM screw caps, 10uM snap caps), 24 primers per pair.
+#Slots 2 (water) and 9 (first P300 tip rack) are fixed, more tip racks go in the slots no rack pair uses.
+RACK_PAIR_SLOTS = [(4, 5), (7, 8), (10, 11), (1, 3)]
+TIP_RACK_SLOTS = [6, 3, 1]
+
+#Function that lists the first num_samples wells of the given labware row by row (A1, A2, ... then B1, B2, ...),
+#rolling over to the next labware once one is full. This is the order the tubes of the racks are filled in.
+def wellsByRow(labware_dict, labware_names, num_samples):
+    wells = [well for labware_name in labware_names for row in labware_dict.rows(labware_name) for well in row]
+    if num_samples > len(wells):
+        raise RuntimeError(f'{num_samples} samples do not fit in the {len(wells)} wells of {", ".join(labware_names)}')
+    return wells[:num_samples]
+
+#Function that plans the water fill: picks the mounted single-channel pipette (with tips) that needs the fewest
+#aspirations to put volume into every destination, and splits the destinations into its trips. A trip with several
+#destinations aspirates them all plus a disposal volume (the pipette's minimum volume) and dispenses well by well.
+#Ties go to the first pipette of the list. Returns the pipette and the list of trips, each a list of wells.
+def planWaterFill(pipettes, volume, destinations):
+    best_pipette, best_per_trip = None, 0
+    for pipette in pipettes:
+        if pipette.channels != 1 or pipette.max_volume < volume:
+            continue
+        per_trip = max(1, int((pipette.max_volume - pipette.min_volume) // volume))
+        if best_pipette is None or math.ceil(len(destinations) / per_trip) < math.ceil(len(destinations) / best_per_trip):
+            best_pipette, best_per_trip = pipette, per_trip
+    if best_pipette is None:
+        raise RuntimeError(f'No mounted single-channel pipette can transfer {volume} uL of water')
+    trips = [destinations[i:i + best_per_trip] for i in range(0, len(destinations), best_per_trip)]
+    return best_pipette, trips
+
+#Volume ledger of the wells the protocol pipettes from and into, to aspirate just under the meniscus instead of near the
+#bottom. A well starts with its load_liquid volume (or empty), and every aspirate and dispense moves it. The height is
+#the volume over the well's cross-section from the labware definition: tubes and wells that narrow to the bottom hold
+#the liquid higher than that, so the estimate errs on the deep side. The tip goes immersion mm under the level left
+#once the aspiration is done, never lower than the pipette's bottom clearance. Wells the ledger knows nothing about
+#(never loaded or dispensed into) are aspirated at the well's default height, like every well when disabled, where the
+#ledger is still kept.
+class LiquidTracker:
+    __slots__ = ("enabled", "immersion", "_volumes")
+
+    def __init__(self, enabled, immersion=2):
+        self.enabled = enabled
+        self.immersion = immersion
+        self._volumes = dict()
+
+    def load(self, well, volume):
+        self._volumes[well] = self._volumes.get(well, 0) + volume
+
+    def volume(self, well):
+        return self._volumes.get(well, 0)
+
+    #Height in mm of a volume in the well, capped at the well depth
+    def height(self, well, volume):
+        if well.diameter:
+            area = math.pi * (well.diameter / 2) ** 2
+        else:
+            area = well.length * well.width
+        return min(max(volume, 0) / area, well.depth)
+
+    #Location to aspirate the volume from the well, and take it out of the ledger
+    def aspirateFrom(self, pipette, well, volume):
+        known = well in self._volumes
+        self._volumes[well] = self.volume(well) - volume
+        if not self.enabled or not known:
+            return well
+        return well.bottom(z=max(self.height(well, self._volumes[well]) - self.immersion, pipette.well_bottom_clearance.aspirate))
+
+    def dispenseInto(self, well, volume):
+        self._volumes[well] = self.volume(well) + volume
+        return well
+
+    #Liquid that was moved without this run pipetting it, ex. the rows a resumed run already did
+    def moved(self, source, destination, volume):
+        self._volumes[source] = self.volume(source) - volume
+        self._volumes[destination] = self.volume(destination) + volume
+
+
+#Opt-in trace of the run: every pipette, module, delay and pause command is written to a JSON-lines file with
+#the phase (from the "~~~Phase~~~" comments), the CSV row being executed, its monotonic start/end time, the volume,
+#the tip on the pipette and the labware/well. Set row before the commands of each CSV row (an int, or a list of
+#rows for a multi-dispense). When disabled every method does nothing, so the protocol can always call it.
+class EventTrace:
+    def __init__(self, protocol, enabled, name="run"):
+        self.row = None
+        self.phase = "Setup"
+        #Loaded labware keyed by their CSV names, set it once the labware is loaded so events use the table's names
+        self.labware_dict = {}
+        self.path = None
+        self._file = None
+        self._stack = []
+        self._tips = {}
+        self._count = 0
+        if not enabled:
+            return
+        #On the robot traces go to the user storage, kept between runs. Simulations (and the App analysis) use a temp folder
+        folder = os.path.join(tempfile.gettempdir(), "botany_traces") if protocol.is_simulating() else "/data/user_storage/botany_traces"
+        self.path = os.path.join(folder, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.jsonl')
+        try:
+            os.makedirs(folder, exist_ok=True)
+            #Line buffered, so the trace is complete up to the last command even if the run is cancelled
+            self._file = open(self.path, "w", buffering=1)
+        except OSError as error:
+            protocol.comment(f'Event trace disabled, cannot write {self.path}: {error}')
+            return
+        self._unsubscribe = protocol.broker.subscribe("command", self._onMessage)
+        protocol.comment(f'Event trace: {self.path}')
+
+    #CSV name (or load name) and deck slot of a labware, labware on a module takes the module's slot
+    def _labware(self, labware):
+        labware_name = next((name for name, loaded in self.labware_dict.items() if loaded is labware), labware.load_name)
+        slot = labware.parent if isinstance(labware.parent, str) else getattr(labware.parent, "parent", None)
+        return labware_name, slot
+
+    #Labware name, slot and well of a command location (a Well, a Location or a disposal location like the trash)
+    def _place(self, location):
+        if location is None:
+            return None, None, None
+        labware_like = getattr(location, "labware", None)
+        well = labware_like.as_well() if labware_like is not None and labware_like.is_well else location
+        if hasattr(well, "well_name"):
+            return self._labware(well.parent) + (well.well_name,)
+        if labware_like is not None and labware_like.is_labware:
+            return self._labware(labware_like.object) + (None,)
+        return type(location).__name__, None, None
+
+    def _onMessage(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][2] = True
+            self._stack.append([message, time.monotonic(), False])
+            return
+        before, start, has_children = self._stack.pop()
+        name = before["name"].replace("command.", "")
+        payload = before["payload"]
+        text = payload.get("text", "")
+        if name == "COMMENT":
+            if text.strip().startswith("~") and text.strip().endswith("~"):
+                self.phase = text.strip().strip("~").strip()
+            return
+        #Commands made of other commands (transfer, distribute, mix...) are traced through their parts
+        if has_children:
+            return
+        instrument = payload.get("instrument")
+        mount = instrument.mount if instrument is not None else None
+        labware, slot, well = self._place(payload.get("location"))
+        if name == "PICK_UP_TIP":
+            self._tips[mount] = f"{slot}/{well}"
+        event = {"seq": self._count, "command": name, "phase": self.phase, "row": self.row,
+                 "start": round(start, 4), "end": round(time.monotonic(), 4),
+                 "volume": payload.get("volume"), "pipette": mount, "tip": self._tips.get(mount),
+                 "labware": labware, "slot": slot, "well": well, "text": text}
+        if message.get("error") is not None:
+            event["error"] = str(message["error"])
+        if name in ("DROP_TIP", "DROP_TIP_IN_DISPOSAL_LOCATION", "RETURN_TIP"):
+            self._tips.pop(mount, None)
+        self._file.write(json.dumps(event) + "\n")
+        self._count += 1
+
+    #Stop tracing and close the file, call at the end of the run
+    def close(self):
+        if self._file is not None:
+            self._unsubscribe()
+            self._file.close()
+            self._file = None
 
 #Runtime parameter definitions
 def add_parameters(parameters):
@@ -28,13 +447,13 @@ def add_parameters(parameters):
                        description="Import the csv (.xslx) file for this protocol. Make sure to modify the values within first."
                        )
     
-    #Parameter for number of samples, 1-24
+    #Parameter for number of samples, 1-96, every 24 samples use another pair of tube racks
     parameters.add_int(
         variable_name="num_samples",
         display_name="Number of Samples",
-        description="Choose how many samples to run",
+        description="Choose how many samples to run, every 24 samples need another pair of tube racks",
         minimum=1,
-        maximum=24,
+        maximum=96,
         default=24
     )
     
@@ -94,7 +513,7 @@ def add_parameters(parameters):
     parameters.add_str(
         variable_name="pipette_ext_choice",
         display_name="Other Pipette Mounted",
-        description="If you attached another pipette on the robot, won't be used in protocol",
+        description="Other pipette: a P1000 does the water fill, an 8-channel P300 the plate format, others unused",
         choices=[
             {"display_name": "P20", "value": "p20_single_gen2"},
             {"display_name": "P1000", "value": "p1000_single_gen2"},
@@ -117,6 +536,49 @@ def add_parameters(parameters):
     default="left"
     )
 
+    #Allows user to put the stocks and working solutions in 96 deep-well plates, handled by the 8-channel P300
+    parameters.add_bool(
+        variable_name="plate_format",
+        display_name="Plate Format",
+        description="On = primers in 96 deep-well plates (slots 4, 5), water reservoir in slot 2, 8-channel P300",
+        default=False
+    )
+
+    #Allows user to aspirate just under the liquid level, tracked from the loaded volumes, instead of near the well bottom
+    parameters.add_bool(
+        variable_name="follow_liquid",
+        display_name="Follow Liquid Level",
+        description="On = aspirate just under the liquid surface, needs the loaded volumes to be right",
+        default=False
+    )
+
+    #Water the operator puts in the water tube (or the reservoir in plate format), Follow Liquid Level starts from it
+    parameters.add_int(
+        variable_name="water_volume",
+        display_name="Starting Water Volume",
+        description="Water in the Falcon tube (the reservoir in plate format), where Follow Liquid Level starts",
+        default=25,
+        minimum=1,
+        maximum=195,
+        unit="mL"
+    )
+
+    #Allows user to let the protocol decide when to change tips instead of the Pick_Up_Tip column
+    parameters.add_bool(
+        variable_name="auto_tips",
+        display_name="Automatic Tip Reuse",
+        description="On = ignore Pick_Up_Tip, keep a tip only for the same source while it touched no other liquid",
+        default=False
+    )
+
+    #Allows user to record every command of the run (phase, CSV row, timing, volume, tip, well) to a JSON-lines file
+    parameters.add_bool(
+        variable_name="event_trace",
+        display_name="Event Trace",
+        description="On = write a JSON-lines trace of every command to the robot's user storage",
+        default=False
+    )
+
 
 #Protocol context - https://docs.opentrons.com/v2/tutorial.html
 def run(protocol: protocol_api.ProtocolContext):
@@ -125,29 +587,107 @@ def run(protocol: protocol_api.ProtocolContext):
     #Each item in the child lists corresponds to a single cell within its row. Data is represented as string.
     csv_data_list = protocol.params.svt_csv.parse_as_csv()
 
-    #Loading tip rack, after the api name, put comma and then which slot it is in on the Opentron
-    tip_rack_300 = protocol.load_labware(load_name="opentrons_96_tiprack_300ul", location=9)
-    #Loading pipette, 20uL single tip
-    s_300_pip = protocol.load_instrument(instrument_name="p300_single_gen2", mount=protocol.params.pipette_loc, tip_racks=[tip_rack_300])
-
-    #Load the extraneous pipette
-    if protocol.params.pipette_ext_choice != "none":
-        #Load in the extraneous pipette, although it's not used.
-        protocol.load_instrument(instrument_name=protocol.params.pipette_ext_choice, mount=protocol.params.pipette_ext_loc)
+    #Opt-in JSON-lines trace of every command of the run (see EventTrace)
+    event_trace = EventTrace(protocol, protocol.params.event_trace, name=metadata["protocolName"])
 
+    #Plate format needs the 8-channel P300, it does the water fill and the dilution column by column
+    plate_format = protocol.params.plate_format
+    if plate_format == True and protocol.params.pipette_ext_choice != "p300_multi_gen2":
+        raise RuntimeError('Plate format needs the 8-channel P300 as the other pipette')
 
     #Load the labware with its api name, look it up in labware library - https://labware.opentrons.com/
     #Add labware to dictionary
-    labware_dict = dict([('Falcon_Water_Rack', protocol.load_labware("opentrons_10_tuberack_falcon_4x50ml_6x15ml_conical", 2)), 
-                         ('10uM_SnapCaps', protocol.load_labware("opentrons_24_tuberack_nest_1.5ml_snapcap", 5)),
-                         ('100uM_ScrewCaps', protocol.load_labware("opentrons_24_tuberack_generic_2ml_screwcap", 4))])
+    if plate_format == True:
+        #Stocks and working solutions in 96 deep-well plates, water in a single-well reservoir
+        labware_dict = LabwareRegistry([('Water_Reservoir', protocol.load_labware("nest_1_reservoir_195ml", 2)),
+                             ('10uM_Plate', protocol.load_labware("nest_96_wellplate_2ml_deep", 5)),
+                             ('100uM_Plate', protocol.load_labware("nest_96_wellplate_2ml_deep", 4))])
+        water_source = labware_dict.well('Water_Reservoir', 'A1')
+        working_labware, stock_labware = ['10uM_Plate'], ['100uM_Plate']
+        used_slots = [4, 5]
+    else:
+        #Number of primer tube rack pairs, a new pair every 24 samples
+        num_rack_pairs = math.ceil(protocol.params.num_samples / 24)
+
+        #The first rack pair has the plain names, the next ones are numbered (10uM_SnapCaps2, ...)
+        labware_dict = LabwareRegistry([('Falcon_Water_Rack', protocol.load_labware("opentrons_10_tuberack_falcon_4x50ml_6x15ml_conical", 2))])
+        water_source = labware_dict.well('Falcon_Water_Rack', 'A4')
+        working_labware = []
+        stock_labware = []
+        for pair, (screw_cap_slot, snap_cap_slot) in enumerate(RACK_PAIR_SLOTS[:num_rack_pairs], start=1):
+            suffix = str(pair) if pair > 1 else ""
+            labware_dict['10uM_SnapCaps' + suffix] = protocol.load_labware("opentrons_24_tuberack_nest_1.5ml_snapcap", snap_cap_slot)
+            labware_dict['100uM_ScrewCaps' + suffix] = protocol.load_labware("opentrons_24_tuberack_generic_2ml_screwcap", screw_cap_slot)
+            working_labware.append('10uM_SnapCaps' + suffix)
+            stock_labware.append('100uM_ScrewCaps' + suffix)
+        used_slots = [slot for pair in RACK_PAIR_SLOTS[:num_rack_pairs] for slot in pair]
+
+    #Slots still free for more tip racks
+    free_slots = [slot for slot in TIP_RACK_SLOTS if slot not in used_slots]
 
     #----------End of modifications (2)
 
-    #Code to read from csv to "define intial volumes"
-    #Discard the first row of csv, since that's all the titles of the columns.
-    csv_iv_data = csv_data_list[2:]
-    
+    event_trace.labware_dict = labware_dict
+
+    #Compile the pipetting steps table (Source_Labware is column 1 of the CSV) once, before any liquid handling
+    transfer_plan = compileTransferPlan(protocol, csv_data_list, labware_dict, first_col=1)
+
+    #Optionally decide the tip changes from what each tip touched, in place of the Pick_Up_Tip column. Step 2 dispenses
+    #at the top of the tubes, so its tips never touch the primers
+    if protocol.params.auto_tips == True:
+        transfer_plan, tips_saved, seconds_saved = planTipReuse(transfer_plan, set(), top_dispense=True)
+        if tips_saved < 0:
+            protocol.comment(f'Automatic tips: {-tips_saved} more tips than the Pick_Up_Tip column, which reuses tips that touched other liquids')
+        else:
+            protocol.comment(f'Automatic tips: {tips_saved} tips and about {seconds_saved} seconds saved compared to the Pick_Up_Tip column')
+
+    #Get which tip to start with
+    starting_tip = str(protocol.params.starting_tip_let) + str(protocol.params.starting_tip_num)
+
+    #Loading tip rack, after the api name, put comma and then which slot it is in on the Opentron
+    tip_racks_300 = [protocol.load_labware(load_name="opentrons_96_tiprack_300ul", location=9)]
+    #Tips used from the starting tip on: one for the water fill, one per new tip of step 2 and one per sample in step 3
+    #(the 8-channel does step 3 in plate format). Load more racks in the free slots until they all fit, if the deck
+    #runs out of slots the run pauses for the operator to swap in full racks when the loaded ones are used up
+    tips_needed = (tip_racks_300[0].wells().index(tip_racks_300[0].well(starting_tip)) + 1
+                   + sum(step.new_tip for step in transfer_plan) + (protocol.params.num_samples if plate_format == False else 0))
+    while len(tip_racks_300) * 96 < tips_needed and free_slots:
+        tip_racks_300.append(protocol.load_labware(load_name="opentrons_96_tiprack_300ul", location=free_slots.pop(0)))
+    if len(tip_racks_300) * 96 < tips_needed:
+        protocol.comment(f'{protocol.params.num_samples} samples need {math.ceil(tips_needed / 96)} P300 tip racks, '
+                         f'{len(tip_racks_300)} fit on the deck: the run pauses to swap in full racks')
+    #Loading pipette, 300uL single tip
+    s_300_pip = protocol.load_instrument(instrument_name="p300_single_gen2", mount=protocol.params.pipette_loc, tip_racks=tip_racks_300)
+
+    #Pipettes that can do the water fill of step 1
+    fill_pipettes = [s_300_pip]
+
+    #Load the extraneous pipette
+    if plate_format == True:
+        #One tip column for the water fill and one per plate column of the dilution, 12 columns per tip rack
+        num_columns = math.ceil(protocol.params.num_samples / 8)
+        tip_racks_multi = []
+        while len(tip_racks_multi) * 12 < num_columns + 1:
+            if not free_slots:
+                raise RuntimeError('No free slot left for the 8-channel P300 tip racks')
+            tip_racks_multi.append(protocol.load_labware(load_name="opentrons_96_tiprack_300ul", location=free_slots.pop(0)))
+        m_300_pip = protocol.load_instrument(instrument_name="p300_multi_gen2", mount=protocol.params.pipette_ext_loc, tip_racks=tip_racks_multi)
+    elif protocol.params.pipette_ext_choice == "p1000_single_gen2" and free_slots:
+        #A P1000 fills the water several tubes per aspiration, it needs its own tip rack
+        tip_rack_1000 = protocol.load_labware(load_name="opentrons_96_tiprack_1000ul", location=free_slots.pop(0))
+        fill_pipettes.append(protocol.load_instrument(instrument_name="p1000_single_gen2", mount=protocol.params.pipette_ext_loc, tip_racks=[tip_rack_1000]))
+    elif protocol.params.pipette_ext_choice != "none":
+        if protocol.params.pipette_ext_choice == "p1000_single_gen2":
+            protocol.comment('No free slot for P1000 tips, the P300 does the water fill')
+        #Load in the extraneous pipette, although it's not used.
+        protocol.load_instrument(instrument_name=protocol.params.pipette_ext_choice, mount=protocol.params.pipette_ext_loc)
+
+    #Tips left in the racks of each pipette, the P300 starts at the starting tip
+    tip_trackers = {pipette.name: TipTracker(pipette.tip_racks) for pipette in fill_pipettes}
+    if plate_format == True:
+        tip_trackers[m_300_pip.name] = TipTracker(m_300_pip.tip_racks)
+    tip_trackers[s_300_pip.name].skipTo(tip_racks_300[0].well(starting_tip))
+
     #Define the liquid "water"
     water = protocol.define_liquid(
                 name='Hyclone Water',
@@ -155,117 +695,78 @@ def run(protocol: protocol_api.ProtocolContext):
                 display_color='#00FF00'
             )
     
-    #Load water into the falcon rack
-    getLabwareObject(labware_dict, 'Falcon_Water_Rack')['A4'].load_liquid(liquid=water, volume=25000)
-
-    #Get which tip to start with
-    starting_tip = str(protocol.params.starting_tip_let) + str(protocol.params.starting_tip_num)
-    s_300_pip.starting_tip = tip_rack_300.well(starting_tip)
-    #Set first_transfer to false initially because we'll transfer 180uL before using the CSV
-    first_transfer = False
-
-    #Define var for remainder of num samples, check if it's perfectly filling rows of 6 wells
-    remainder = 0
-
-    #If there's a remainder in the number of samples, aka not perfectly filling up a row
-    if (protocol.params.num_samples % 6) != 0:
-        num_rows = (protocol.params.num_samples // 6) + 1
-        remainder = protocol.params.num_samples % 6
-    #Else, get the perfect amt of rows
-    else:
-        num_rows = protocol.params.num_samples // 6   
-
-    protocol.comment(f'Remainder = {remainder}')
-    protocol.comment(f'Rows = {num_rows}') 
+    #Load water into the falcon rack (or the reservoir in plate format)
+    water_volume = protocol.params.water_volume * 1000
+    if water_volume > water_source.max_volume:
+        raise RuntimeError(f'{protocol.params.water_volume} mL of water does not fit in the {water_source.max_volume / 1000:g} mL water source, '
+                           'lower Starting Water Volume')
+    water_source.load_liquid(liquid=water, volume=water_volume)
+
+    #Water left in the source, so the water is aspirated under its surface instead of at the bottom of the tube. The
+    #other step 2 sources aren't loaded, they are aspirated at their default height
+    liquid_tracker = LiquidTracker(protocol.params.follow_liquid)
+    liquid_tracker.load(water_source, water_volume)
 
     #----------------------------------------Step 1----------------------------------------#
-
-    #Pick up the tip, to transfer water
-    s_300_pip.pick_up_tip()
+    protocol.comment('\n\n~~~~~~~~~~Step 1: Water Fill~~~~~~~~~~\n')
 
     #First, automatically transfer 180uL water to each sample of working solution
-    for row in range(num_rows):
-        #If we're at the last row
-        if row == (num_rows - 1):
-            #If the last row is not full
-            if remainder != 0:
-                for col in range(remainder):
-                    #Aspirate/dispense the liquid
-                    s_300_pip.aspirate(180, getLabwareObject(labware_dict, 'Falcon_Water_Rack')["A4"], rate=2.0)
-                    s_300_pip.dispense(180, getLabwareObject(labware_dict, '10uM_SnapCaps').rows()[row][col],rate=2.0)
-                    s_300_pip.blow_out()
-            else:
-                for col in range(6):
-                    #Aspirate/dispense the liquid
-                    s_300_pip.aspirate(180, getLabwareObject(labware_dict, 'Falcon_Water_Rack')["A4"], rate=2.0)
-                    s_300_pip.dispense(180, getLabwareObject(labware_dict, '10uM_SnapCaps').rows()[row][col], rate=2.0)
-                    s_300_pip.blow_out()
-
-        #If we're at any other row (aka, a full row)
+    if plate_format == True:
+        #One trip per plate column, the 8-channel goes to the top well of the column
+        fill_pipette = m_300_pip
+        water_trips = [[column[0]] for column in labware_dict.columns('10uM_Plate')[:num_columns]]
+    else:
+        fill_pipette, water_trips = planWaterFill(fill_pipettes, 180, wellsByRow(labware_dict, working_labware, protocol.params.num_samples))
+    if len(water_trips) < protocol.params.num_samples:
+        protocol.comment(f'Water fill: {len(water_trips)} aspirations with the {fill_pipette.name} for {protocol.params.num_samples} samples')
+
+    #Pick up the tip, to transfer water
+    pickUpTip(protocol, fill_pipette, tip_trackers[fill_pipette.name])
+
+    for trip in water_trips:
+        if len(trip) == 1:
+            #Aspirate/dispense the liquid
+            fill_pipette.aspirate(180, liquid_tracker.aspirateFrom(fill_pipette, water_source, 180 * fill_pipette.channels), rate=2.0)
+            fill_pipette.dispense(180, trip[0], rate=2.0)
+            fill_pipette.blow_out()
         else:
-            for col in range(6):
-                #Aspirate/dispense the liquid
-                s_300_pip.aspirate(180, getLabwareObject(labware_dict, 'Falcon_Water_Rack')["A4"], rate=2.0)
-                s_300_pip.dispense(180, getLabwareObject(labware_dict, '10uM_SnapCaps').rows()[row][col], rate=2.0)
-                s_300_pip.blow_out()
+            #Aspirate the water for every tube of the trip plus the disposal volume, then dispense it tube by tube
+            fill_pipette.aspirate(180 * len(trip) + fill_pipette.min_volume, liquid_tracker.aspirateFrom(fill_pipette, water_source, 180 * len(trip) + fill_pipette.min_volume), rate=2.0)
+            for well in trip:
+                fill_pipette.dispense(180, well, rate=2.0)
+            #Return the disposal volume to the water tube
+            fill_pipette.blow_out(water_source.top())
+            liquid_tracker.dispenseInto(water_source, fill_pipette.min_volume)
+
+    #The P300 keeps its water tip for step 2, a tip of the other pipette is discarded
+    if fill_pipette is not s_300_pip:
+        fill_pipette.drop_tip()
 
     #Change the pipette dispense speed for this chunk of code to 15uL/s
     s_300_pip.flow_rate.dispense = 50
 
     #----------------------------------------Step 2----------------------------------------#
-    for csv_row in csv_iv_data:
-        #Check if the current row is empty, if it's empty then skip it
-        if csv_row[1] != "":
-            #Define variables from CSV columns
-            source_labware = csv_row[1]
-            source_well = csv_row[2]
-            destination_labware = csv_row[3]
-            destination_well = csv_row[4]
-            transfer_volume = float(csv_row[5])
-            pick_up_tip = str(csv_row[6])
-
-            curr_source_labware = getLabwareObject(labware_dict, source_labware)
-            curr_destination_labware = getLabwareObject(labware_dict, destination_labware)
-
-            if pick_up_tip == 'TRUE':
-
-                if first_transfer == True:
-                    #Pick up the first tip
-                    s_300_pip.pick_up_tip()
-                    first_transfer = False
-                else:
-                    #Touch tip first, in the previous well to prevent liquid from falling while pipette is moving
-                    s_300_pip.touch_tip()
-                    #Discard the previous tip
-                    s_300_pip.drop_tip()
-                    #Pick up the next tip, will always pick up the next available tip
-                    s_300_pip.pick_up_tip()
-
-                
-                #Now, start the volume transfer
-                
-                #Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                s_300_pip.aspirate(transfer_volume, curr_source_labware[source_well], rate=2.0)
-                #Dispense liquid, with this format (amount in microliters, well location)
-                s_300_pip.dispense(transfer_volume, curr_destination_labware[destination_well].top())
-                s_300_pip.blow_out()
-
-
-            elif pick_up_tip == 'FALSE':
-                if first_transfer == True:
-                    #Pick up the first tip
-                    s_300_pip.pick_up_tip()
-                    first_transfer = False
-
-                #Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                s_300_pip.aspirate(transfer_volume, curr_source_labware[source_well], rate=2.0)
-                #Dispense liquid, with this format (amount in microliters, well location)
-                s_300_pip.dispense(transfer_volume, curr_destination_labware[destination_well].top())
-                s_300_pip.blow_out()
-
-            else:
-
-                protocol.comment('Please specify whether to use new or same tip')
+    protocol.comment('\n\n~~~~~~~~~~Step 2: Resuspend Primer Stocks~~~~~~~~~~\n')
+    for step in transfer_plan:
+        event_trace.row = step.row
+        if not s_300_pip.has_tip:
+            #Pick up the first tip, when the other pipette did the water fill
+            pickUpTip(protocol, s_300_pip, tip_trackers[s_300_pip.name])
+        elif step.new_tip == True:
+            #Touch tip first, in the previous well to prevent liquid from falling while pipette is moving
+            s_300_pip.touch_tip()
+            #Discard the previous tip
+            s_300_pip.drop_tip()
+            #Pick up the next tip, will always pick up the next available tip
+            pickUpTip(protocol, s_300_pip, tip_trackers[s_300_pip.name])
+
+        #Aspirate [take in] liquid, with this format (amount in microliters, well location)
+        s_300_pip.aspirate(step.volume, liquid_tracker.aspirateFrom(s_300_pip, step.source, step.volume), rate=2.0)
+        #Dispense liquid, with this format (amount in microliters, well location)
+        s_300_pip.dispense(step.volume, step.destination.top())
+        s_300_pip.blow_out()
+
+    event_trace.row = None
 
     #Return the pipette dispense speed to default uL/sec
     s_300_pip.flow_rate.dispense = 92.86
@@ -276,56 +777,33 @@ def run(protocol: protocol_api.ProtocolContext):
     s_300_pip.drop_tip()
 
     #----------------------------------------Step 3----------------------------------------#
-
-    #First, automatically transfer 180uL water to each sample of working solution
-    for row in range(num_rows):
-        #If we're at the last row
-        protocol.comment(f'Current row: {row}')
-        
-        if row == (num_rows - 1):
-            #If the last row is not full
-            if remainder != 0:
-                protocol.comment(f'Last row: {num_rows - 1} and num_rows: {num_rows}')
-                for col in range(remainder):
-                    #Pick up a new tip
-                    s_300_pip.pick_up_tip()
-                    #Do a mix before aspiration, to make sure the powder is evenly distributed within the well
-                    s_300_pip.mix(3, 100, getLabwareObject(labware_dict, '100uM_ScrewCaps').rows()[row][col], rate=2.0)
-                    #Aspirate/dispense the liquid
-                    s_300_pip.aspirate(20, getLabwareObject(labware_dict, '100uM_ScrewCaps').rows()[row][col])
-                    s_300_pip.dispense(20, getLabwareObject(labware_dict, '10uM_SnapCaps').rows()[row][col], rate=2.0)
-                    #Blow out first, to prevent liquid from falling while pipette is moving
-                    s_300_pip.blow_out()
-                    #Drop the tip, since we need a new tip each time
-                    s_300_pip.drop_tip()
-            #If the last row is only partially full
-            else:
-                for col in range(6):
-                    #Pick up a new tip
-                    s_300_pip.pick_up_tip()
-                    #Do a mix before aspiration, to make sure the powder is evenly distributed within the well
-                    s_300_pip.mix(3, 100, getLabwareObject(labware_dict, '100uM_ScrewCaps').rows()[row][col], rate=2.0)
-                    #Aspirate/dispense the liquid
-                    s_300_pip.aspirate(20, getLabwareObject(labware_dict, '100uM_ScrewCaps').rows()[row][col])
-                    s_300_pip.dispense(20, getLabwareObject(labware_dict, '10uM_SnapCaps').rows()[row][col], rate=2.0)
-                    #Blow out first, to prevent liquid from falling while pipette is moving
-                    s_300_pip.blow_out()
-                    #Drop the tip, since we need a new tip each time
-                    s_300_pip.drop_tip()
-        #If we're at any other row (aka, a full row)
-        else:
-            for col in range(6):
-                #Pick up a new tip
-                s_300_pip.pick_up_tip()
-                #Do a mix before aspiration, to make sure the powder is evenly distributed within the well
-                s_300_pip.mix(3, 100, getLabwareObject(labware_dict, '100uM_ScrewCaps').rows()[row][col], rate=2.0)
-                #Aspirate/dispense the liquid
-                s_300_pip.aspirate(20, getLabwareObject(labware_dict, '100uM_ScrewCaps').rows()[row][col])
-                s_300_pip.dispense(20, getLabwareObject(labware_dict, '10uM_SnapCaps').rows()[row][col], rate=2.0)
-                #Blow out first, to prevent liquid from falling while pipette is moving
-                s_300_pip.blow_out()
-                #Drop the tip, since we need a new tip each time
-                s_300_pip.drop_tip()
+    protocol.comment('\n\n~~~~~~~~~~Step 3: Dilute to Working Solution~~~~~~~~~~\n')
+
+    #Dilute each 100uM stock into the 10uM tube at the same place of its rack pair,
+    #or in plate format each stock plate column into the same column of the working plate
+    if plate_format == True:
+        dilution_pipette = m_300_pip
+        stock_wells = [column[0] for column in labware_dict.columns('100uM_Plate')[:num_columns]]
+        working_wells = [column[0] for column in labware_dict.columns('10uM_Plate')[:num_columns]]
+    else:
+        dilution_pipette = s_300_pip
+        stock_wells = wellsByRow(labware_dict, stock_labware, protocol.params.num_samples)
+        working_wells = wellsByRow(labware_dict, working_labware, protocol.params.num_samples)
+    for stock_well, working_well in zip(stock_wells, working_wells):
+        #Pick up a new tip
+        pickUpTip(protocol, dilution_pipette, tip_trackers[dilution_pipette.name])
+        #Do a mix before aspiration, to make sure the powder is evenly distributed within the well
+        dilution_pipette.mix(3, 100, stock_well, rate=2.0)
+        #Aspirate/dispense the liquid
+        dilution_pipette.aspirate(20, stock_well)
+        dilution_pipette.dispense(20, working_well, rate=2.0)
+        #Blow out first, to prevent liquid from falling while pipette is moving
+        dilution_pipette.blow_out()
+        #Drop the tip, since we need a new tip each time
+        dilution_pipette.drop_tip()
+
+    #Stop the event trace
+    event_trace.close()
 
 
 
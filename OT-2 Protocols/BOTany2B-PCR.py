@@ -3,6 +3,10 @@ from opentrons import protocol_api
 import csv
 import json
 import math
+import os
+import tempfile
+import time
+import heapq
 
 #-------(Modify) Change name and description to suit your needs (1)
 metadata = {
@@ -13,12 +17,603 @@ metadata = {
     }
 #-------End of modifications (1)
 
-#Function that gets labware object to use given the string name of variable
+#Function that gets labware object to use given the string name of variable, or None if there is no such labware
 def getLabwareObject(labware_dict, labware_name):
-    for key, value in labware_dict.items():
-        if str(key) == str(labware_name):
-            return value
-    return
+    return labware_dict.get(str(labware_name))
+
+#Dictionary of the loaded labware keyed by the names used in the CSV, that also remembers the wells of each labware.
+#The Opentrons API rebuilds its well lists every time labware[well_name], rows() or columns() is called,
+#so loops that visit many wells should look them up here instead.
+class LabwareRegistry(dict):
+    __slots__ = ("_wells", "_rows", "_columns")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wells = {}
+        self._rows = {}
+        self._columns = {}
+
+    def __setitem__(self, labware_name, labware):
+        super().__setitem__(labware_name, labware)
+        #Forget the wells of any labware that was previously loaded under this name
+        self._wells.pop(labware_name, None)
+        self._rows.pop(labware_name, None)
+        self._columns.pop(labware_name, None)
+
+    #Well name -> Well object for the given labware, ex. {"A1": Well, ...}
+    def wells_by_name(self, labware_name):
+        wells = self._wells.get(labware_name)
+        if wells is None:
+            wells = self._wells[labware_name] = self[labware_name].wells_by_name()
+        return wells
+
+    def well(self, labware_name, well_name):
+        return self.wells_by_name(labware_name)[well_name]
+
+    def rows(self, labware_name):
+        rows = self._rows.get(labware_name)
+        if rows is None:
+            rows = self._rows[labware_name] = self[labware_name].rows()
+        return rows
+
+    def columns(self, labware_name):
+        columns = self._columns.get(labware_name)
+        if columns is None:
+            columns = self._columns[labware_name] = self[labware_name].columns()
+        return columns
+
+#Compiled pipetting step, one per non-empty row of a "Pipetting Steps" table in the CSV.
+#Labware and well objects are resolved once, before any robot motion, so the transfer loop only issues pipette commands.
+class TransferStep:
+    __slots__ = ("row", "source_labware", "source_well", "source", "destination_labware", "destination_well",
+                 "destination", "volume", "new_tip", "pipette_choice")
+
+    def __init__(self, row, source_labware, source_well, source, destination_labware, destination_well,
+                 destination, volume, new_tip, pipette_choice=None):
+        self.row = row #Row number in the spreadsheet, for error messages
+        self.source_labware = source_labware
+        self.source_well = source_well
+        self.source = source #Resolved Well object
+        self.destination_labware = destination_labware
+        self.destination_well = destination_well
+        self.destination = destination #Resolved Well object
+        self.volume = volume
+        self.new_tip = new_tip #True if the "Pick_Up_Tip" cell is TRUE
+        self.pipette_choice = pipette_choice #"Left"/"Right", or None for tables without a Pipette_Choice column
+
+    def __repr__(self):
+        return (f'TransferStep(row {self.row}: {self.volume} uL {self.source_labware} {self.source_well} -> '
+                f'{self.destination_labware} {self.destination_well}, new_tip={self.new_tip})')
+
+#Function that gets the Well object for a labware/well name pair, stopping the protocol with the CSV row number if either is wrong
+def resolveWell(labware_dict, labware_name, well_name, row):
+    if getLabwareObject(labware_dict, labware_name) is None:
+        raise RuntimeError(f'CSV row {row}: unknown labware "{labware_name}"')
+    try:
+        return labware_dict.well(labware_name, well_name)
+    except KeyError:
+        raise RuntimeError(f'CSV row {row}: "{well_name}" is not a well of "{labware_name}"')
+
+#Function that compiles one "Pipetting Steps" table of the CSV into a list of TransferSteps.
+#first_col is the index of the Source_Labware column, the table continues with Source_Well, Destination_Labware,
+#Destination_Well, Transfer_Volume, Pick_Up_Tip and (if has_pipette_col) Pipette_Choice.
+def compileTransferPlan(protocol, csv_data_list, labware_dict, first_col, has_pipette_col=False):
+    num_cols = 7 if has_pipette_col else 6
+    plan = []
+
+    #Discard the first two rows of csv, since those are the titles of the tables and columns. Spreadsheet rows start at 1.
+    for row, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [str(cell).strip() for cell in csv_row[first_col:first_col + num_cols]]
+        #Check if the current row is empty, if it's empty then skip it
+        if len(cells) == 0 or cells[0] == "":
+            continue
+        if len(cells) < num_cols:
+            raise RuntimeError(f'CSV row {row}: expected {num_cols} pipetting columns, found {len(cells)}')
+
+        source_labware, source_well, destination_labware, destination_well, transfer_volume, pick_up_tip = cells[:6]
+        pipette_choice = cells[6] if has_pipette_col else None
+
+        if pick_up_tip not in ('TRUE', 'FALSE'):
+            protocol.comment('Please specify whether to use new or same tip')
+            continue
+        try:
+            volume = float(transfer_volume)
+        except ValueError:
+            raise RuntimeError(f'CSV row {row}: transfer volume "{transfer_volume}" is not a number')
+
+        plan.append(TransferStep(
+            row,
+            source_labware, source_well, resolveWell(labware_dict, source_labware, source_well, row),
+            destination_labware, destination_well, resolveWell(labware_dict, destination_labware, destination_well, row),
+            volume, pick_up_tip == 'TRUE', pipette_choice))
+
+    return plan
+
+#Seconds the robot needs to drop a tip in the trash and pick up the next one, used to estimate time saved
+TIP_CHANGE_SECONDS = 10
+
+#Function that counts the tips a plan picks up: the first step of each pipette, plus every step that asks for a new tip
+def countTips(plan):
+    pipettes_used = set()
+    tips = 0
+    for step in plan:
+        if step.new_tip == True or step.pipette_choice not in pipettes_used:
+            tips += 1
+            pipettes_used.add(step.pipette_choice)
+    return tips
+
+#Function that reorders a compiled plan so that rows taking liquid from the same source share one tip.
+#Returns (new_plan, tips_saved, seconds_saved), or the plan unchanged if reordering does not save tips.
+#- Rows chained by the user with Pick_Up_Tip = FALSE stay together, in their original order.
+#- A chain only moves ahead of another chain if they do not touch the same well, or both only dispense into it,
+#  so every well receives the same volumes and a well filled by the table is filled before it is used as a source.
+#- A tip is reused for another chain only if it only aspirated from that chain's source and only dispensed into
+#  wells holding nothing but that source's liquid, so no other liquid is carried back into the source.
+#initial_wells is the set of (labware, well) names that hold liquid before the run starts.
+def optimizeTipUse(plan, initial_wells):
+    #Split the plan into chains: a row that needs a tip, plus the FALSE rows after it for the same pipette
+    chains = []
+    follows = [] #Chain of the same pipette that a chain continues with the same tip, or None
+    last_chain_of_pip = {}
+    for step in plan:
+        if step.new_tip == False and chains and chains[-1][-1].pipette_choice == step.pipette_choice:
+            chains[-1].append(step)
+            continue
+        chains.append([step])
+        follows.append(last_chain_of_pip.get(step.pipette_choice) if step.new_tip == False else None)
+        last_chain_of_pip[step.pipette_choice] = len(chains) - 1
+    num_chains = len(chains)
+
+    #Dependencies between chains: reading a well waits for earlier dispenses into it, dispensing into a well waits
+    #for earlier aspirations from it. Dispenses into the same well can be swapped.
+    successors = [set() for _ in range(num_chains)]
+    indegree = [0] * num_chains
+    readers = {}
+    writers = {}
+    for c, chain in enumerate(chains):
+        deps = set()
+        if follows[c] is not None:
+            deps.add(follows[c])
+        for step in chain:
+            source_key = (step.source_labware, step.source_well)
+            destination_key = (step.destination_labware, step.destination_well)
+            deps.update(writers.get(source_key, ()))
+            deps.update(readers.get(destination_key, ()))
+            readers.setdefault(source_key, set()).add(c)
+            writers.setdefault(destination_key, set()).add(c)
+        deps.discard(c)
+        for d in deps:
+            successors[d].add(c)
+        indegree[c] = len(deps)
+
+    #Chains that are ready to run, by original position and by (pipette, first source)
+    ready = []
+    ready_by_source = {}
+    def _make_ready(c):
+        head = chains[c][0]
+        heapq.heappush(ready, c)
+        heapq.heappush(ready_by_source.setdefault((head.pipette_choice, head.source_labware, head.source_well), []), c)
+    for c in range(num_chains):
+        if indegree[c] == 0:
+            _make_ready(c)
+    continued_by = {f: c for c, f in enumerate(follows) if f is not None}
+
+    done = [False] * num_chains
+    contents = {} #(labware, well) -> set of sources dispensed into it so far
+    tip_state = {} #pipette -> [(labware, well) of the only source aspirated, or None if several; tip is still clean]
+    last_on_pip = {}
+    last = None
+    new_plan = []
+    while len(new_plan) < len(plan):
+        pick = None
+        if last is not None:
+            #Keep a user chain going on the same tip, if it is ready
+            nxt = continued_by.get(last)
+            if nxt is not None and indegree[nxt] == 0 and not done[nxt]:
+                pick = nxt
+            #Otherwise prefer a chain that can reuse the current tip
+            state = tip_state.get(chains[last][0].pipette_choice)
+            if pick is None and state is not None and state[0] is not None and state[1] == True:
+                heap = ready_by_source.get((chains[last][0].pipette_choice,) + state[0], [])
+                while heap and done[heap[0]]:
+                    heapq.heappop(heap)
+                if heap:
+                    pick = heap[0]
+        if pick is None:
+            while done[ready[0]]:
+                heapq.heappop(ready)
+            pick = ready[0]
+        done[pick] = True
+
+        head = chains[pick][0]
+        pip = head.pipette_choice
+        head_key = (head.source_labware, head.source_well)
+        state = tip_state.get(pip)
+        if follows[pick] is not None and last_on_pip.get(pip) == follows[pick]:
+            new_tip = False
+        else:
+            new_tip = not (state is not None and state[0] == head_key and state[1] == True)
+        if new_tip == True:
+            state = tip_state[pip] = [head_key, True]
+
+        for i, step in enumerate(chains[pick]):
+            source_key = (step.source_labware, step.source_well)
+            destination_key = (step.destination_labware, step.destination_well)
+            if state[0] != source_key:
+                state[0] = None
+            well_contents = contents.setdefault(destination_key, set())
+            if destination_key in initial_wells or len(well_contents - {source_key}) > 0:
+                state[1] = False
+            well_contents.add(source_key)
+            new_plan.append(TransferStep(
+                step.row, step.source_labware, step.source_well, step.source,
+                step.destination_labware, step.destination_well, step.destination,
+                step.volume, new_tip if i == 0 else False, step.pipette_choice))
+
+        last_on_pip[pip] = pick
+        last = pick
+        for s in successors[pick]:
+            indegree[s] -= 1
+            if indegree[s] == 0:
+                _make_ready(s)
+
+    tips_saved = countTips(plan) - countTips(new_plan)
+    if tips_saved <= 0:
+        return plan, 0, 0
+    return new_plan, tips_saved, tips_saved * TIP_CHANGE_SECONDS
+
+#Function that decides the Pick_Up_Tip of every step in place of the table, from what each tip has touched. A tip is kept
+#for the next step of its pipette only if that step aspirates from the same source and the tip has not been in any
+#other liquid: a dispense into a well touches its liquid unless it is at the top of the well (top_dispense), and a well
+#holding nothing but the source's liquid can't carry anything back into the source. initial_wells is the set of
+#(labware, well) names that hold liquid before the run starts. Returns (new_plan, tips_saved, seconds_saved) compared to
+#the Pick_Up_Tip column, tips_saved is below 0 when the table reused tips this rule would not.
+def planTipReuse(plan, initial_wells, top_dispense=False):
+    contents = {} #(labware, well) -> set of sources dispensed into it so far
+    tip_state = {} #pipette -> [(labware, well) of the source its tip aspirated from, tip touched no other liquid]
+    new_plan = []
+    for step in plan:
+        source_key = (step.source_labware, step.source_well)
+        destination_key = (step.destination_labware, step.destination_well)
+        state = tip_state.get(step.pipette_choice)
+        new_tip = not (state is not None and state[0] == source_key and state[1] == True)
+        if new_tip == True:
+            state = tip_state[step.pipette_choice] = [source_key, True]
+        well_contents = contents.setdefault(destination_key, set())
+        if top_dispense == False and (destination_key in initial_wells or len(well_contents - {source_key}) > 0):
+            state[1] = False
+        well_contents.add(source_key)
+        new_plan.append(TransferStep(
+            step.row, step.source_labware, step.source_well, step.source,
+            step.destination_labware, step.destination_well, step.destination,
+            step.volume, new_tip, step.pipette_choice))
+
+    tips_saved = countTips(plan) - countTips(new_plan)
+    return new_plan, tips_saved, tips_saved * TIP_CHANGE_SECONDS
+
+#Function that packs consecutive steps into multi-dispenses: steps that keep the same tip and aspirate from the same
+#source share one aspiration, as long as their volumes plus the disposal volume fit in the pipette
+def packMultiDispense(plan, max_volume, disposal_volume):
+    packs = []
+    total = 0
+    for step in plan:
+        prev = packs[-1][-1] if packs else None
+        if (prev is not None and step.new_tip == False and step.pipette_choice == prev.pipette_choice
+                and step.source is prev.source and total + step.volume + disposal_volume <= max_volume):
+            packs[-1].append(step)
+            total += step.volume
+        else:
+            packs.append([step])
+            total = step.volume
+    return packs
+
+#Function that replaces the shared components of a set of reactions (buffer, dNTPs, enzymes, water...) by one master
+#mix built in mix_well. A component is a source that gives every destination it goes to the same volume, that no step
+#fills and whose destinations no step aspirates from. The components going to exactly the same destinations make a
+#master mix, and the one saving the most transfers is built, scaled up by overage percent plus the dead volume of the
+#tube. Each component goes into the mix first, with a new tip every trip so the mix never gets back into a component
+#tube, then every reaction gets one aliquot of the mix in place of its first component row. Returns (plan, None) when
+#no master mix saves transfers or fits in the tube, else (new_plan, summary).
+def planMasterMix(plan, mix_labware, mix_well_name, mix_well, max_volume, overage):
+    filled = set(step.destination for step in plan)
+    doses = dict() #source -> {destination: volume}
+    first_steps = dict() #source -> first step aspirating from it
+    for step in plan:
+        dest_volumes = doses.setdefault(step.source, dict())
+        dest_volumes[step.destination] = dest_volumes.get(step.destination, 0) + step.volume
+        first_steps.setdefault(step.source, step)
+
+    groups = dict() #destinations -> components giving each of them the same volume
+    for source, dest_volumes in doses.items():
+        if (source in filled or len(dest_volumes) < 2 or len(set(dest_volumes.values())) > 1
+                or any(destination in doses for destination in dest_volumes)):
+            continue
+        groups.setdefault(frozenset(dest_volumes), []).append(source)
+
+    best = None
+    for destinations, components in groups.items():
+        if len(components) < 2:
+            continue
+        reaction = sum(next(iter(doses[source].values())) for source in components)
+        #Reactions worth of mix to build
+        scale = len(destinations) * (1 + overage / 100) + deadVolume(mix_well) / reaction
+        build_trips = sum(math.ceil(next(iter(doses[source].values())) * scale / max_volume) for source in components)
+        transfers_before = sum(1 for step in plan if step.source in components and step.destination in destinations)
+        transfers_after = build_trips + len(destinations) * math.ceil(reaction / max_volume)
+        if (transfers_after < transfers_before and reaction * scale <= mix_well.max_volume
+                and (best is None or transfers_before - transfers_after > best[0])):
+            best = (transfers_before - transfers_after, destinations, components, reaction, scale, transfers_before, transfers_after)
+    if best is None:
+        return plan, None
+    _, destinations, components, reaction, scale, transfers_before, transfers_after = best
+
+    #Build the master mix, one component after the other
+    new_plan = []
+    for source in components:
+        first = first_steps[source]
+        total = next(iter(doses[source].values())) * scale
+        trips = math.ceil(total / max_volume)
+        for _ in range(trips):
+            new_plan.append(TransferStep(first.row, first.source_labware, first.source_well, source,
+                                         mix_labware, mix_well_name, mix_well, total / trips, True, first.pipette_choice))
+
+    #Then the table without the component rows, each reaction getting its aliquot at its first component row. A row
+    #that kept the tip of the same source's row before it gets a new tip if that row is gone
+    served = set()
+    previous = None
+    for step in plan:
+        if step.source in components and step.destination in destinations:
+            if step.destination not in served:
+                served.add(step.destination)
+                trips = math.ceil(reaction / max_volume)
+                for _ in range(trips):
+                    new_tip = step.new_tip or new_plan[-1].source is not mix_well
+                    new_plan.append(TransferStep(step.row, mix_labware, mix_well_name, mix_well, step.destination_labware,
+                                                 step.destination_well, step.destination, reaction / trips, new_tip, step.pipette_choice))
+        elif step.new_tip == False and previous is not None and previous.source is step.source and new_plan[-1].source is not step.source:
+            new_plan.append(TransferStep(step.row, step.source_labware, step.source_well, step.source, step.destination_labware,
+                                         step.destination_well, step.destination, step.volume, True, step.pipette_choice))
+        else:
+            new_plan.append(step)
+        previous = step
+
+    summary = (f'Master mix: {len(components)} components for {len(destinations)} reactions, {reaction * scale:.1f} µL '
+               f'in {mix_labware} {mix_well_name} with {overage}% overage, {transfers_before} -> {transfers_after} transfers')
+    return new_plan, summary
+
+#Liquid a pipette can't get back from the bottom of a well, by the capacity of the well in µL: PCR wells, 1.5-2 mL tubes
+#and deep wells, 15 mL tubes and reservoir columns, 50 mL tubes, then larger reservoirs
+DEAD_VOLUMES = [(300, 1), (2500, 3), (20000, 300), (60000, 1000), (float("inf"), 3000)]
+
+def deadVolume(well):
+    return next(dead for capacity, dead in DEAD_VOLUMES if well.max_volume <= capacity)
+
+#Function that writes CSV row numbers as ranges, ex. 3-7, 12
+def rowRanges(rows):
+    ranges = []
+    for row in sorted(set(rows)):
+        if ranges and row == ranges[-1][1] + 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return ", ".join(f'{first}-{last}' if first != last else f'{first}' for first, last in ranges)
+
+#Function that plays the whole plan on paper before any motion, packs being the aspirations in run order (a list of
+#steps each, a multi-dispense also aspirates the disposal volume and returns it to the source). Every aspiration must
+#leave the source's dead volume behind, and no well may go over its capacity. Wells start from the loaded volumes, or
+#empty. A source with no loaded volume that no earlier step fills can't be checked, its volume is unknown. Raises one
+#error listing every short or overflowing well with the CSV rows that take from or add to it, else returns the names
+#of the sources it couldn't check.
+def checkVolumes(packs, loaded_volumes, disposal_volume=0):
+    volumes = dict(loaded_volumes)
+    names = dict()
+    taken = dict() #source well -> [µL taken, rows taking from it, first row that comes up short]
+    unknown = [] #sources aspirated before anything declared or put liquid in them
+    added = dict() #destination well -> [highest µL, rows adding to it]
+    for pack in packs:
+        step = pack[0]
+        names[step.source] = f'{step.source_labware} {step.source_well}'
+        pack_volume = sum(s.volume for s in pack)
+        if step.source not in volumes and step.source not in unknown:
+            unknown.append(step.source)
+        source = taken.setdefault(step.source, [0, [], None])
+        if step.source not in unknown and source[2] is None and volumes.get(step.source, 0) < pack_volume + (disposal_volume if len(pack) > 1 else 0) + deadVolume(step.source):
+            source[2] = step.row
+        source[0] += pack_volume
+        source[1].extend(s.row for s in pack)
+        volumes[step.source] = volumes.get(step.source, 0) - pack_volume
+        for s in pack:
+            names[s.destination] = f'{s.destination_labware} {s.destination_well}'
+            volumes[s.destination] = volumes.get(s.destination, 0) + s.volume
+            destination = added.setdefault(s.destination, [0, []])
+            destination[0] = max(destination[0], volumes[s.destination])
+            destination[1].append(s.row)
+
+    problems = []
+    for well, (volume, rows, first_short) in taken.items():
+        if first_short is not None:
+            problems.append(f'{names[well]} runs short at CSV row {first_short}: {loaded_volumes.get(well, 0):g} µL loaded, {volume:g} µL '
+                            f'taken plus {deadVolume(well):g} µL dead volume (rows {rowRanges(rows)})')
+    for well, (volume, rows) in added.items():
+        if volume > well.max_volume:
+            problems.append(f'{names[well]} overflows: {volume:g} µL in a {well.max_volume:g} µL well (rows {rowRanges(rows)})')
+    if problems:
+        raise RuntimeError('Volume check failed, fix the CSV volumes before the run:\n' + '\n'.join(problems))
+    return [names[well] for well in unknown]
+
+#Opt-in trace of the run: every pipette, module, delay and pause command is written to a JSON-lines file with
+#the phase (from the "~~~Phase~~~" comments), the CSV row being executed, its monotonic start/end time, the volume,
+#the tip on the pipette and the labware/well. Set row before the commands of each CSV row (an int, or a list of
+#rows for a multi-dispense). When disabled every method does nothing, so the protocol can always call it.
+class EventTrace:
+    def __init__(self, protocol, enabled, name="run"):
+        self.row = None
+        self.phase = "Setup"
+        #Loaded labware keyed by their CSV names, set it once the labware is loaded so events use the table's names
+        self.labware_dict = {}
+        self.path = None
+        self._file = None
+        self._stack = []
+        self._tips = {}
+        self._count = 0
+        if not enabled:
+            return
+        #On the robot traces go to the user storage, kept between runs. Simulations (and the App analysis) use a temp folder
+        folder = os.path.join(tempfile.gettempdir(), "botany_traces") if protocol.is_simulating() else "/data/user_storage/botany_traces"
+        self.path = os.path.join(folder, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.jsonl')
+        try:
+            os.makedirs(folder, exist_ok=True)
+            #Line buffered, so the trace is complete up to the last command even if the run is cancelled
+            self._file = open(self.path, "w", buffering=1)
+        except OSError as error:
+            protocol.comment(f'Event trace disabled, cannot write {self.path}: {error}')
+            return
+        self._unsubscribe = protocol.broker.subscribe("command", self._onMessage)
+        protocol.comment(f'Event trace: {self.path}')
+
+    #CSV name (or load name) and deck slot of a labware, labware on a module takes the module's slot
+    def _labware(self, labware):
+        labware_name = next((name for name, loaded in self.labware_dict.items() if loaded is labware), labware.load_name)
+        slot = labware.parent if isinstance(labware.parent, str) else getattr(labware.parent, "parent", None)
+        return labware_name, slot
+
+    #Labware name, slot and well of a command location (a Well, a Location or a disposal location like the trash)
+    def _place(self, location):
+        if location is None:
+            return None, None, None
+        labware_like = getattr(location, "labware", None)
+        well = labware_like.as_well() if labware_like is not None and labware_like.is_well else location
+        if hasattr(well, "well_name"):
+            return self._labware(well.parent) + (well.well_name,)
+        if labware_like is not None and labware_like.is_labware:
+            return self._labware(labware_like.object) + (None,)
+        return type(location).__name__, None, None
+
+    def _onMessage(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][2] = True
+            self._stack.append([message, time.monotonic(), False])
+            return
+        before, start, has_children = self._stack.pop()
+        name = before["name"].replace("command.", "")
+        payload = before["payload"]
+        text = payload.get("text", "")
+        if name == "COMMENT":
+            if text.strip().startswith("~") and text.strip().endswith("~"):
+                self.phase = text.strip().strip("~").strip()
+            return
+        #Commands made of other commands (transfer, distribute, mix...) are traced through their parts
+        if has_children:
+            return
+        instrument = payload.get("instrument")
+        mount = instrument.mount if instrument is not None else None
+        labware, slot, well = self._place(payload.get("location"))
+        if name == "PICK_UP_TIP":
+            self._tips[mount] = f"{slot}/{well}"
+        event = {"seq": self._count, "command": name, "phase": self.phase, "row": self.row,
+                 "start": round(start, 4), "end": round(time.monotonic(), 4),
+                 "volume": payload.get("volume"), "pipette": mount, "tip": self._tips.get(mount),
+                 "labware": labware, "slot": slot, "well": well, "text": text}
+        if message.get("error") is not None:
+            event["error"] = str(message["error"])
+        if name in ("DROP_TIP", "DROP_TIP_IN_DISPOSAL_LOCATION", "RETURN_TIP"):
+            self._tips.pop(mount, None)
+        self._file.write(json.dumps(event) + "\n")
+        self._count += 1
+
+    #Stop tracing and close the file, call at the end of the run
+    def close(self):
+        if self._file is not None:
+            self._unsubscribe()
+            self._file.close()
+            self._file = None
+
+#How a liquid is pipetted: aspirate, dispense and blow-out speeds as multiples of the pipette's default flow rates, the
+#seconds to wait after aspirating and dispensing, an air gap in µL carried on top of the liquid, and whether to blow out
+#and touch the tip after dispensing. LiquidClass() pipettes like a plain aspirate and dispense.
+class LiquidClass:
+    __slots__ = ("aspirate_rate", "dispense_rate", "blow_out_rate", "aspirate_delay", "dispense_delay", "air_gap",
+                 "blow_out", "touch_tip")
+
+    def __init__(self, aspirate_rate=1.0, dispense_rate=1.0, blow_out_rate=1.0, aspirate_delay=0, dispense_delay=0,
+                 air_gap=0, blow_out=False, touch_tip=False):
+        self.aspirate_rate = aspirate_rate
+        self.dispense_rate = dispense_rate
+        self.blow_out_rate = blow_out_rate
+        self.aspirate_delay = aspirate_delay
+        self.dispense_delay = dispense_delay
+        self.air_gap = air_gap
+        self.blow_out = blow_out
+        self.touch_tip = touch_tip
+
+    #Air gap that still fits in the tip on top of the volume
+    def _air_gap(self, pipette, volume):
+        return max(0, min(self.air_gap, pipette.max_volume - volume))
+
+    def aspirate(self, protocol, pipette, volume, location, air_gap=True):
+        pipette.aspirate(volume, location, rate=self.aspirate_rate)
+        if self.aspirate_delay > 0:
+            protocol.delay(seconds=self.aspirate_delay)
+        if air_gap and self._air_gap(pipette, volume) > 0:
+            pipette.air_gap(self._air_gap(pipette, volume))
+
+    #The air gap of the aspiration goes out with the liquid
+    def dispense(self, protocol, pipette, volume, location, air_gap=True):
+        pipette.dispense(volume + (self._air_gap(pipette, volume) if air_gap else 0), location, rate=self.dispense_rate)
+        if self.dispense_delay > 0:
+            protocol.delay(seconds=self.dispense_delay)
+
+    #Empty and wipe the tip in the well it dispensed into, when the tip holds nothing more to dispense
+    def finish(self, pipette):
+        if self.blow_out:
+            default_rate = pipette.flow_rate.blow_out
+            pipette.flow_rate.blow_out = default_rate * self.blow_out_rate
+            pipette.blow_out()
+            pipette.flow_rate.blow_out = default_rate
+        if self.touch_tip:
+            pipette.touch_tip()
+
+    def transfer(self, protocol, pipette, volume, source, destination):
+        self.aspirate(protocol, pipette, volume, source)
+        self.dispense(protocol, pipette, volume, destination)
+        self.finish(pipette)
+
+#Liquid classes the CSV can give a liquid. Water runs at twice the default speed, enzymes in glycerol slowly with pauses
+#for the viscous liquid to follow the plunger and a touch tip for the film left outside the tip, competent cells gently,
+#bead suspensions slowly in and a blow-out, and ethanol washes with an air gap against drips.
+LIQUID_CLASSES = {
+    "water": LiquidClass(aspirate_rate=2.0, dispense_rate=2.0, blow_out=True),
+    "enzyme-glycerol": LiquidClass(aspirate_rate=0.25, dispense_rate=0.25, blow_out_rate=0.5, aspirate_delay=2, dispense_delay=2, touch_tip=True),
+    "competent cells": LiquidClass(aspirate_rate=0.5, dispense_rate=0.5, aspirate_delay=1),
+    "bead suspension": LiquidClass(aspirate_rate=0.5, blow_out=True),
+    "ethanol wash": LiquidClass(air_gap=10, blow_out=True, touch_tip=True),
+}
+
+#Function that reads the optional liquid class table of the CSV, found by its Class_Liquid_Name header and followed by
+#the Liquid_Class column: each row gives one liquid of the Initial Liquid Definitions one of the LIQUID_CLASSES. Returns
+#the liquid name -> LiquidClass dict, empty if the CSV has no such table.
+def liquidClassesFromCsv(csv_data_list, liquid_names):
+    headers = [cell.strip() for cell in csv_data_list[1]] if len(csv_data_list) > 1 else []
+    if "Class_Liquid_Name" not in headers:
+        return dict()
+    first_col = headers.index("Class_Liquid_Name")
+
+    liquid_classes = dict()
+    for row_number, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [cell.strip() for cell in csv_row[first_col:first_col + 2]]
+        cells += [""] * (2 - len(cells))
+        liquid_name, class_name = cells
+        #Check if the current row is empty, if it's empty then skip it
+        if liquid_name == "":
+            continue
+        if liquid_name not in liquid_names:
+            raise RuntimeError(f'CSV row {row_number}: liquid "{liquid_name}" is not in the Initial Liquid Definitions')
+        if class_name.lower() not in LIQUID_CLASSES:
+            raise RuntimeError(f'CSV row {row_number}: unknown liquid class "{class_name}", use one of {", ".join(LIQUID_CLASSES)}')
+        liquid_classes[liquid_name] = LIQUID_CLASSES[class_name.lower()]
+    return liquid_classes
+
 
 #Runtime parameter definitions
 def add_parameters(parameters):
@@ -118,6 +713,60 @@ def add_parameters(parameters):
     default="right"
     )
 
+    #Allows user to let the protocol reorder the pipetting steps so that fewer tips are used
+    parameters.add_bool(
+        variable_name="optimize_tips",
+        display_name="Optimize Tip Use",
+        description="On = reorder steps so rows from one source share a tip, every well still gets the same volumes",
+        default=False
+    )
+
+    #Allows user to let the protocol decide when to change tips instead of the Pick_Up_Tip column
+    parameters.add_bool(
+        variable_name="auto_tips",
+        display_name="Automatic Tip Reuse",
+        description="On = ignore Pick_Up_Tip, keep a tip only for the same source while it touched no other liquid",
+        default=False
+    )
+
+    #Allows user to fill several wells from one aspiration when consecutive rows take the same liquid with the same tip
+    parameters.add_bool(
+        variable_name="multi_dispense",
+        display_name="Multi-Dispense",
+        description="On = rows with the same source and tip share one aspiration, Off = one aspiration per row",
+        default=False
+    )
+
+    #Extra volume aspirated with each multi-dispense for accuracy, returned to the source afterwards
+    parameters.add_float(
+        variable_name="disposal_volume",
+        display_name="Multi-Dispense Disposal Volume",
+        description="Extra volume aspirated with each multi-dispense, blown out back into the source",
+        default=2.0,
+        minimum=0.0,
+        maximum=10.0,
+        unit="µL"
+    )
+
+    #Allows user to let the protocol premix the components that every reaction gets in the same volume
+    parameters.add_bool(
+        variable_name="master_mix",
+        display_name="Build Master Mix",
+        description="On = premix the components shared by the reactions in a free temp_tubes tube",
+        default=False
+    )
+
+    #Extra master mix made on top of what the reactions take, for the pipetting losses and the dead volume
+    parameters.add_int(
+        variable_name="master_mix_overage",
+        display_name="Master Mix Overage",
+        description="Extra master mix made on top of what the reactions take",
+        default=10,
+        minimum=0,
+        maximum=50,
+        unit="%"
+    )
+
     #Allows user to prevent a long temperature module cooling period at the start of the protocol, when the robot cannot simultaneously pipette
     parameters.add_bool(
         variable_name="temp_mod_cooling",
@@ -126,6 +775,14 @@ def add_parameters(parameters):
         default=False
     )
 
+    #Allows user to record every command of the run (phase, CSV row, timing, volume, tip, well) to a JSON-lines file
+    parameters.add_bool(
+        variable_name="event_trace",
+        display_name="Event Trace",
+        description="On = write a JSON-lines trace of every command to the robot's user storage",
+        default=False
+    )
+
     
 
 
@@ -136,6 +793,9 @@ def run(protocol: protocol_api.ProtocolContext):
     #Each item in the child lists corresponds to a single cell within its row. Data is represented as string.
     csv_data_list = protocol.params.svt_csv.parse_as_csv()
 
+    #Opt-in JSON-lines trace of every command of the run (see EventTrace)
+    event_trace = EventTrace(protocol, protocol.params.event_trace, name=metadata["protocolName"])
+
     #---------(Modify) Load the needed Modules, Labware, Tip racks, Pipettes  (2)
     #Load the temperature module
     temp_mod = protocol.load_module(
@@ -170,7 +830,7 @@ def run(protocol: protocol_api.ProtocolContext):
 
     #Load the labware with its api name, look it up in labware library - https://labware.opentrons.com/
     #Add labware to dictionary
-    labware_dict = dict([('tube_rack1', protocol.load_labware("opentrons_24_tuberack_nest_1.5ml_snapcap", 4)), 
+    labware_dict = LabwareRegistry([('tube_rack1', protocol.load_labware("opentrons_24_tuberack_nest_1.5ml_snapcap", 4)), 
                          ('tube_rack2', protocol.load_labware("opentrons_24_tuberack_nest_1.5ml_snapcap", 5)),
                          ('tube_rack3', protocol.load_labware("opentrons_24_tuberack_nest_1.5ml_snapcap", 6)),
                          ('tube_rack4', protocol.load_labware("opentrons_24_tuberack_nest_1.5ml_snapcap", 2)),
@@ -184,6 +844,11 @@ def run(protocol: protocol_api.ProtocolContext):
     #Discard the first row of csv, since that's all the titles of the columns.
     csv_iv_data = csv_data_list[2:]
 
+    #Wells that hold liquid before the run starts
+    loaded_wells = set()
+    loaded_volumes = dict()
+    loaded_liquids = dict() #well -> liquid name
+
     for csv_row in csv_iv_data:
         #Check if the current row is empty, if it's empty then skip it
         if csv_row[1] != "":
@@ -204,68 +869,111 @@ def run(protocol: protocol_api.ProtocolContext):
 
             
 
-            #Get object of current labware given the variable name
-            curr_labware = getLabwareObject(labware_dict, labware)
-            #Add the liquids to the current labware
-            curr_labware[liquid_well].load_liquid(liquid=current_liquid, volume=liquid_volume)
-
-
-    first_transfer = True
-
-    for csv_row in csv_iv_data:
-        #Check if the current row is empty, if it's empty then skip it
-        if csv_row[8] != "":
-            # Define variables from CSV columns
-            source_labware = csv_row[8]
-            source_well = csv_row[9]
-            destination_labware = csv_row[10]
-            destination_well = csv_row[11]
-            transfer_volume = float(csv_row[12])
-            pick_up_tip = str(csv_row[13])
-
-            curr_source_labware = getLabwareObject(labware_dict, source_labware)
-            curr_destination_labware = getLabwareObject(labware_dict, destination_labware)
-
-            if pick_up_tip == 'TRUE':
-
-                if first_transfer == True:
-                    #Pick up the first tip
-                    s_20_pip.pick_up_tip()
-                    first_transfer = False
-                else:
-                    #Discard the previous tip
-                    s_20_pip.drop_tip()
-                    #Pick up the next tip, will always pick up the next available tip
-                    s_20_pip.pick_up_tip()
-
-                
-                #Now, start the volume transfer
-                
-                #Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                s_20_pip.aspirate(transfer_volume, curr_source_labware[source_well])
-                #Dispense liquid, with this format (amount in microliters, well location)
-                s_20_pip.dispense(transfer_volume, curr_destination_labware[destination_well])
-
-            elif pick_up_tip == 'FALSE':
-                if first_transfer == True:
-                    #Pick up the first tip
-                    s_20_pip.pick_up_tip()
-                    first_transfer = False
-
-                # Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                s_20_pip.aspirate(transfer_volume, curr_source_labware[source_well])
-                # Dispense liquid, with this format (amount in microliters, well location)
-                s_20_pip.dispense(transfer_volume, curr_destination_labware[destination_well])
-
+            #Add the liquids to the current labware, given the variable name
+            labware_dict.well(labware, liquid_well).load_liquid(liquid=current_liquid, volume=liquid_volume)
+            loaded_liquids[labware_dict.well(labware, liquid_well)] = liquid_name
+            loaded_wells.add((labware, liquid_well))
+            loaded_volumes[labware_dict.well(labware, liquid_well)] = loaded_volumes.get(labware_dict.well(labware, liquid_well), 0) + liquid_volume
+
+
+    #Liquid class of each loaded well, from the optional Class_Liquid_Name table of the CSV
+    liquid_classes = liquidClassesFromCsv(csv_data_list, set(loaded_liquids.values()))
+    well_classes = {well: liquid_classes[name] for well, name in loaded_liquids.items() if name in liquid_classes}
+
+    event_trace.labware_dict = labware_dict
+
+    #Compile the pipetting steps table (Source_Labware is column 8 of the CSV) once, before any liquid handling
+    transfer_plan = compileTransferPlan(protocol, csv_data_list, labware_dict, first_col=8)
+
+    #Optionally premix the components every reaction gets in the same volume, in the first free tube of temp_tubes
+    mix_well = None
+    if protocol.params.master_mix == True:
+        used_wells = set(loaded_volumes) | set(step.source for step in transfer_plan) | set(step.destination for step in transfer_plan)
+        free_wells = [well for well in labware_dict.wells_by_name("temp_tubes").values() if well not in used_wells]
+        if len(free_wells) == 0:
+            protocol.comment('Master mix: no free tube on temp_tubes, the table is used as is')
+        else:
+            transfer_plan, summary = planMasterMix(transfer_plan, "temp_tubes", free_wells[0].well_name, free_wells[0],
+                                                   s_20_pip.max_volume, protocol.params.master_mix_overage)
+            if summary is None:
+                protocol.comment('Master mix: no components worth premixing, the table is used as is')
             else:
-
-                protocol.comment('Please specify whether to use new or same tip')
+                mix_well = free_wells[0]
+                protocol.comment(summary)
+
+    #Optionally reorder the steps so rows from the same source share a tip
+    if protocol.params.optimize_tips == True:
+        transfer_plan, tips_saved, seconds_saved = optimizeTipUse(transfer_plan, loaded_wells)
+        protocol.comment(f'Tip optimizer: {tips_saved} tips and about {seconds_saved} seconds saved compared to the table order')
+
+    #Optionally decide the tip changes from what each tip touched, in place of the Pick_Up_Tip column
+    if protocol.params.auto_tips == True:
+        transfer_plan, tips_saved, seconds_saved = planTipReuse(transfer_plan, loaded_wells)
+        if tips_saved < 0:
+            protocol.comment(f'Automatic tips: {-tips_saved} more tips than the Pick_Up_Tip column, which reuses tips that touched other liquids')
+        else:
+            protocol.comment(f'Automatic tips: {tips_saved} tips and about {seconds_saved} seconds saved compared to the Pick_Up_Tip column')
+
+    #Group the steps into aspirations, several destinations per aspiration if multi-dispense is on. The disposal volume
+    #only goes with multi-dispense
+    disposal_volume = protocol.params.disposal_volume if protocol.params.multi_dispense == True else 0
+    if protocol.params.multi_dispense == True:
+        dispense_packs = packMultiDispense(transfer_plan, s_20_pip.max_volume, disposal_volume)
+        protocol.comment(f'Multi-dispense: {len(dispense_packs)} aspirations for {len(transfer_plan)} rows')
+    else:
+        dispense_packs = [[step] for step in transfer_plan]
+
+    #Check the sources hold enough liquid and no well overflows, before any motion
+    unchecked = checkVolumes(dispense_packs, loaded_volumes, disposal_volume)
+    if unchecked:
+        protocol.comment(f'Volume check: no Initial_Volume for {", ".join(unchecked)}, these sources are not checked')
+
+    protocol.comment('\n\n~~~~~~~~~~Liquid Transfers~~~~~~~~~~\n')
+    first_transfer = True
+    plain_class = LiquidClass()
+    mix_ready = False
+
+    for pack in dispense_packs:
+        step = pack[0]
+        event_trace.row = step.row if len(pack) == 1 else [s.row for s in pack]
+        if first_transfer == True:
+            #Pick up the first tip
+            s_20_pip.pick_up_tip()
+            first_transfer = False
+        elif step.new_tip == True:
+            #Discard the previous tip
+            s_20_pip.drop_tip()
+            #Pick up the next tip, will always pick up the next available tip
+            s_20_pip.pick_up_tip()
+
+        #Mix the master mix before its first aliquot
+        if step.source is mix_well and mix_ready == False:
+            s_20_pip.mix(10, min(s_20_pip.max_volume, sum(s.volume for s in transfer_plan if s.destination is mix_well) / 2), mix_well)
+            mix_ready = True
+
+        #Pipette the source's liquid the way its liquid class says, a plain aspirate and dispense without one
+        liquid_class = well_classes.get(step.source, plain_class)
+        if len(pack) == 1:
+            #Aspirate [take in] liquid and dispense it, with this format (amount in microliters, well location)
+            liquid_class.transfer(protocol, s_20_pip, step.volume, step.source, step.destination)
+        else:
+            #Aspirate the liquid for every destination of the pack plus the disposal volume, then dispense it well by well.
+            #The disposal volume stands in for the air gap
+            liquid_class.aspirate(protocol, s_20_pip, sum(s.volume for s in pack) + disposal_volume, step.source, air_gap=False)
+            for s in pack:
+                liquid_class.dispense(protocol, s_20_pip, s.volume, s.destination, air_gap=False)
+            #Return the disposal volume to the source
+            s_20_pip.blow_out(step.source.top())
 
     #Discard the previous tip
     s_20_pip.drop_tip()
+    event_trace.row = None
 
     #Deactivate the temperature module
-    temp_mod.deactivate() 
+    temp_mod.deactivate()
+
+    #Stop the event trace
+    event_trace.close() 
 
 
         
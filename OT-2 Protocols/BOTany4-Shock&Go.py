@@ -3,6 +3,9 @@ from opentrons import protocol_api
 import csv
 import json
 import math
+import os
+import tempfile
+import time
 from collections import defaultdict
 
 #-------(Modify) Change name and description to suit your needs (1)
@@ -14,12 +17,530 @@ metadata = {
     }
 #-------End of modifications (1)
 
-#Function that gets labware object to use given the string name of variable
+#Function that gets labware object to use given the string name of variable, or None if there is no such labware
 def getLabwareObject(labware_dict, labware_name):
-    for key, value in labware_dict.items():
-        if str(key) == str(labware_name):
-            return value
-    return
+    return labware_dict.get(str(labware_name))
+
+#Dictionary of the loaded labware keyed by the names used in the CSV, that also remembers the wells of each labware.
+#The Opentrons API rebuilds its well lists every time labware[well_name], rows() or columns() is called,
+#so loops that visit many wells should look them up here instead.
+class LabwareRegistry(dict):
+    __slots__ = ("_wells", "_rows", "_columns")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wells = {}
+        self._rows = {}
+        self._columns = {}
+
+    def __setitem__(self, labware_name, labware):
+        super().__setitem__(labware_name, labware)
+        #Forget the wells of any labware that was previously loaded under this name
+        self._wells.pop(labware_name, None)
+        self._rows.pop(labware_name, None)
+        self._columns.pop(labware_name, None)
+
+    #Well name -> Well object for the given labware, ex. {"A1": Well, ...}
+    def wells_by_name(self, labware_name):
+        wells = self._wells.get(labware_name)
+        if wells is None:
+            wells = self._wells[labware_name] = self[labware_name].wells_by_name()
+        return wells
+
+    def well(self, labware_name, well_name):
+        return self.wells_by_name(labware_name)[well_name]
+
+    def rows(self, labware_name):
+        rows = self._rows.get(labware_name)
+        if rows is None:
+            rows = self._rows[labware_name] = self[labware_name].rows()
+        return rows
+
+    def columns(self, labware_name):
+        columns = self._columns.get(labware_name)
+        if columns is None:
+            columns = self._columns[labware_name] = self[labware_name].columns()
+        return columns
+
+#Compiled pipetting step, one per non-empty row of a "Pipetting Steps" table in the CSV.
+#Labware and well objects are resolved once, before any robot motion, so the transfer loop only issues pipette commands.
+class TransferStep:
+    __slots__ = ("row", "source_labware", "source_well", "source", "destination_labware", "destination_well",
+                 "destination", "volume", "new_tip", "pipette_choice")
+
+    def __init__(self, row, source_labware, source_well, source, destination_labware, destination_well,
+                 destination, volume, new_tip, pipette_choice=None):
+        self.row = row #Row number in the spreadsheet, for error messages
+        self.source_labware = source_labware
+        self.source_well = source_well
+        self.source = source #Resolved Well object
+        self.destination_labware = destination_labware
+        self.destination_well = destination_well
+        self.destination = destination #Resolved Well object
+        self.volume = volume
+        self.new_tip = new_tip #True if the "Pick_Up_Tip" cell is TRUE
+        self.pipette_choice = pipette_choice #"Left"/"Right", or None for tables without a Pipette_Choice column
+
+    def __repr__(self):
+        return (f'TransferStep(row {self.row}: {self.volume} uL {self.source_labware} {self.source_well} -> '
+                f'{self.destination_labware} {self.destination_well}, new_tip={self.new_tip})')
+
+#Function that gets the Well object for a labware/well name pair, stopping the protocol with the CSV row number if either is wrong
+def resolveWell(labware_dict, labware_name, well_name, row):
+    if getLabwareObject(labware_dict, labware_name) is None:
+        raise RuntimeError(f'CSV row {row}: unknown labware "{labware_name}"')
+    try:
+        return labware_dict.well(labware_name, well_name)
+    except KeyError:
+        raise RuntimeError(f'CSV row {row}: "{well_name}" is not a well of "{labware_name}"')
+
+#Function that compiles one "Pipetting Steps" table of the CSV into a list of TransferSteps.
+#first_col is the index of the Source_Labware column, the table continues with Source_Well, Destination_Labware,
+#Destination_Well, Transfer_Volume, Pick_Up_Tip (if has_tip_col) and Pipette_Choice (if has_pipette_col).
+#A table without a Pick_Up_Tip column gets new_tip=None. With skip_bad_volumes, rows whose volume isn't a number are
+#skipped instead of stopping the protocol.
+def compileTransferPlan(protocol, csv_data_list, labware_dict, first_col, has_pipette_col=False, has_tip_col=True,
+                        skip_bad_volumes=False):
+    num_cols = 5 + has_tip_col + has_pipette_col
+    plan = []
+
+    #Discard the first two rows of csv, since those are the titles of the tables and columns. Spreadsheet rows start at 1.
+    for row, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [str(cell).strip() for cell in csv_row[first_col:first_col + num_cols]]
+        #Check if the current row is empty, if it's empty then skip it
+        if len(cells) == 0 or cells[0] == "":
+            continue
+        if len(cells) < num_cols:
+            raise RuntimeError(f'CSV row {row}: expected {num_cols} pipetting columns, found {len(cells)}')
+
+        source_labware, source_well, destination_labware, destination_well, transfer_volume = cells[:5]
+        pick_up_tip = cells[5] if has_tip_col else None
+        pipette_choice = cells[5 + has_tip_col] if has_pipette_col else None
+
+        if has_tip_col and pick_up_tip not in ('TRUE', 'FALSE'):
+            protocol.comment('Please specify whether to use new or same tip')
+            continue
+        try:
+            volume = float(transfer_volume)
+        except ValueError:
+            if skip_bad_volumes:
+                continue
+            raise RuntimeError(f'CSV row {row}: transfer volume "{transfer_volume}" is not a number')
+
+        plan.append(TransferStep(
+            row,
+            source_labware, source_well, resolveWell(labware_dict, source_labware, source_well, row),
+            destination_labware, destination_well, resolveWell(labware_dict, destination_labware, destination_well, row),
+            volume, pick_up_tip == 'TRUE' if has_tip_col else None, pipette_choice))
+
+    return plan
+
+#Thermocycler program made of stages. Each stage is a list of {"temperature", "hold_time_seconds"} steps, the format
+#execute_profile() takes, and a repetition count. The whole cycled stage is one execute_profile() command instead of one
+#set_block_temperature() per hold. final_hold is the temperature the block is left at afterwards, None for no hold.
+class ThermocyclerProfile:
+    __slots__ = ("stages", "final_hold")
+
+    def __init__(self, final_hold=None):
+        self.stages = []
+        self.final_hold = final_hold
+
+    #steps is a list of (temperature in Celsius, hold time in seconds) pairs
+    def add_stage(self, steps, repetitions=1):
+        self.stages.append(([{"temperature": temperature, "hold_time_seconds": hold} for temperature, hold in steps],
+                            int(repetitions)))
+        return self
+
+    def run(self, tc_mod):
+        for steps, repetitions in self.stages:
+            if not steps or repetitions < 1:
+                continue
+            #A single hold doesn't need a profile
+            if len(steps) == 1 and repetitions == 1:
+                tc_mod.set_block_temperature(temperature=steps[0]["temperature"], hold_time_seconds=steps[0]["hold_time_seconds"])
+            else:
+                tc_mod.execute_profile(steps=steps, repetitions=repetitions)
+        if self.final_hold is not None:
+            tc_mod.set_block_temperature(temperature=self.final_hold)
+
+
+#Function that reads the optional thermocycler profile table of the CSV, found by its Profile_Stage header and followed by
+#the Temperature, Hold_Seconds and Repetitions columns. Rows with the same stage make one cycled stage (the repetitions
+#are read from its first row), a row without a hold time is the final hold. Returns None if the CSV has no such table.
+def profileFromCsv(csv_data_list):
+    headers = [cell.strip() for cell in csv_data_list[1]] if len(csv_data_list) > 1 else []
+    if "Profile_Stage" not in headers:
+        return None
+    first_col = headers.index("Profile_Stage")
+
+    profile = ThermocyclerProfile()
+    stages = dict()
+    for row_number, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [cell.strip() for cell in csv_row[first_col:first_col + 4]]
+        cells += [""] * (4 - len(cells))
+        stage, temperature, hold, repetitions = cells
+        #Check if the current row is empty, if it's empty then skip it
+        if stage == "" and temperature == "":
+            continue
+        try:
+            temperature = float(temperature)
+            hold = float(hold) if hold != "" else None
+            repetitions = int(repetitions) if repetitions != "" else 1
+        except ValueError:
+            raise RuntimeError(f'CSV row {row_number}: thermocycler profile values must be numbers')
+        if not 4 <= temperature <= 99 or (hold is not None and hold < 0) or repetitions < 1:
+            raise RuntimeError(f'CSV row {row_number}: thermocycler profile needs 4-99 C, a hold of 0 or more seconds and at least 1 repetition')
+        if hold is None:
+            profile.final_hold = temperature
+        elif stage in stages:
+            stages[stage][0].append((temperature, hold))
+        else:
+            stages[stage] = ([(temperature, hold)], repetitions)
+
+    for steps, repetitions in stages.values():
+        profile.add_stage(steps, repetitions)
+    return profile
+
+#Tips left in a set of 96 tip racks, shared by every pipette (single or 8-channel) that picks up from them. Each tip is
+#one byte of a bytearray (free, used or reserved) in the racks' column order, and the free tips and full free columns
+#are counted as tips get used, so remaining() is O(1). Reserved tips, ex. columns kept for parking, are never handed
+#out and stay as they are on refill(). state() gives a JSON-friendly copy of the tracker that restore() reads back.
+class TipTracker:
+    __slots__ = ("racks", "_wells", "_state", "_column_free", "_free", "_free_columns")
+    FREE, USED, RESERVED = 0, 1, 2
+
+    def __init__(self, racks):
+        self.racks = list(racks)
+        #Every tip, A1, B1 ... H1, A2 ... of the first rack, then the next rack
+        self._wells = [well for rack in self.racks for well in rack.wells()]
+        self._state = bytearray(len(self._wells))
+        self._recount()
+
+    #Position of a tip well in the tracker
+    def _index(self, well):
+        rack_number = next((number for number, rack in enumerate(self.racks) if rack is well.parent), None)
+        if rack_number is None:
+            raise RuntimeError(f'{well} is not in the tip racks {", ".join(str(rack) for rack in self.racks)}')
+        return rack_number * 96 + (int(well.well_name[1:]) - 1) * 8 + ord(well.well_name[0]) - ord("A")
+
+    def _mark(self, index, tip_state):
+        if self._state[index] == self.FREE:
+            self._free -= 1
+            column = index // 8
+            if self._column_free[column] == 8:
+                self._free_columns -= 1
+            self._column_free[column] -= 1
+        self._state[index] = tip_state
+
+    def _recount(self):
+        self._column_free = bytearray(self._state[start:start + 8].count(self.FREE) for start in range(0, len(self._state), 8))
+        self._free = self._state.count(self.FREE)
+        self._free_columns = self._column_free.count(8)
+
+    #Keep tips out of the pick ups, with channels=8 each well reserves itself and the 7 wells below it
+    def reserve(self, wells, channels=1):
+        for well in wells:
+            first = self._index(well)
+            for index in range(first, first + channels):
+                self._mark(index, self.RESERVED)
+
+    #Start picking up at this tip, every free tip before it counts as used (like the pipette's starting_tip)
+    def skipTo(self, well):
+        for index in range(self._index(well)):
+            if self._state[index] == self.FREE:
+                self._mark(index, self.USED)
+
+    #Free tips, or full free columns for an 8-channel
+    def remaining(self, channels=1):
+        return self._free if channels == 1 else self._free_columns
+
+    #Tips (or columns) the racks without reserved tips hold when full, what refill() gives back
+    def refillable(self, channels=1):
+        racks = sum(1 for number in range(len(self.racks)) if self.RESERVED not in self._state[number * 96:(number + 1) * 96])
+        return racks * (96 if channels == 1 else 12)
+
+    #Next tip (or the top of the next full column for an 8-channel), marked as used, None if there is none left
+    def next(self, channels=1):
+        if self.remaining(channels) == 0:
+            return None
+        if channels == 1:
+            first = self._state.find(self.FREE)
+        else:
+            first = self._column_free.find(8) * 8
+        for index in range(first, first + channels):
+            self._mark(index, self.USED)
+        return self._wells[first]
+
+    #Pick up the next tip with the pipette, returns the tip well
+    def pickUp(self, pipette):
+        well = self.next(pipette.channels)
+        if well is None:
+            raise RuntimeError(f'Out of tips for the {pipette.name}, add more tip racks')
+        pipette.pick_up_tip(well)
+        return well
+
+    #The operator swapped the racks without reserved tips for full ones
+    def refill(self):
+        for number in range(len(self.racks)):
+            if self.RESERVED not in self._state[number * 96:(number + 1) * 96]:
+                self._state[number * 96:(number + 1) * 96] = bytes(96)
+        self._recount()
+
+    def state(self):
+        return {"racks": [f"{rack.load_name} in slot {rack.parent}" for rack in self.racks], "tips": self._state.hex()}
+
+    def restore(self, state):
+        if state["racks"] != self.state()["racks"]:
+            raise RuntimeError('The saved tip state is for other tip racks: ' + ", ".join(state["racks"]))
+        self._state = bytearray.fromhex(state["tips"])
+        self._recount()
+
+
+#Volume ledger of the wells the protocol pipettes from and into, to aspirate just under the meniscus instead of near the
+#bottom. A well starts with its load_liquid volume (or empty), and every aspirate and dispense moves it. The height is
+#the volume over the well's cross-section from the labware definition: tubes and wells that narrow to the bottom hold
+#the liquid higher than that, so the estimate errs on the deep side. The tip goes immersion mm under the level left
+#once the aspiration is done, never lower than the pipette's bottom clearance. Wells the ledger knows nothing about
+#(never loaded or dispensed into) are aspirated at the well's default height, like every well when disabled, where the
+#ledger is still kept.
+class LiquidTracker:
+    __slots__ = ("enabled", "immersion", "_volumes")
+
+    def __init__(self, enabled, immersion=2):
+        self.enabled = enabled
+        self.immersion = immersion
+        self._volumes = dict()
+
+    def load(self, well, volume):
+        self._volumes[well] = self._volumes.get(well, 0) + volume
+
+    def volume(self, well):
+        return self._volumes.get(well, 0)
+
+    #Height in mm of a volume in the well, capped at the well depth
+    def height(self, well, volume):
+        if well.diameter:
+            area = math.pi * (well.diameter / 2) ** 2
+        else:
+            area = well.length * well.width
+        return min(max(volume, 0) / area, well.depth)
+
+    #Location to aspirate the volume from the well, and take it out of the ledger
+    def aspirateFrom(self, pipette, well, volume):
+        known = well in self._volumes
+        self._volumes[well] = self.volume(well) - volume
+        if not self.enabled or not known:
+            return well
+        return well.bottom(z=max(self.height(well, self._volumes[well]) - self.immersion, pipette.well_bottom_clearance.aspirate))
+
+    def dispenseInto(self, well, volume):
+        self._volumes[well] = self.volume(well) + volume
+        return well
+
+    #Liquid that was moved without this run pipetting it, ex. the rows a resumed run already did
+    def moved(self, source, destination, volume):
+        self._volumes[source] = self.volume(source) - volume
+        self._volumes[destination] = self.volume(destination) + volume
+
+
+#Opt-in trace of the run: every pipette, module, delay and pause command is written to a JSON-lines file with
+#the phase (from the "~~~Phase~~~" comments), the CSV row being executed, its monotonic start/end time, the volume,
+#the tip on the pipette and the labware/well. Set row before the commands of each CSV row (an int, or a list of
+#rows for a multi-dispense). When disabled every method does nothing, so the protocol can always call it.
+class EventTrace:
+    def __init__(self, protocol, enabled, name="run"):
+        self.row = None
+        self.phase = "Setup"
+        #Loaded labware keyed by their CSV names, set it once the labware is loaded so events use the table's names
+        self.labware_dict = {}
+        self.path = None
+        self._file = None
+        self._stack = []
+        self._tips = {}
+        self._count = 0
+        if not enabled:
+            return
+        #On the robot traces go to the user storage, kept between runs. Simulations (and the App analysis) use a temp folder
+        folder = os.path.join(tempfile.gettempdir(), "botany_traces") if protocol.is_simulating() else "/data/user_storage/botany_traces"
+        self.path = os.path.join(folder, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.jsonl')
+        try:
+            os.makedirs(folder, exist_ok=True)
+            #Line buffered, so the trace is complete up to the last command even if the run is cancelled
+            self._file = open(self.path, "w", buffering=1)
+        except OSError as error:
+            protocol.comment(f'Event trace disabled, cannot write {self.path}: {error}')
+            return
+        self._unsubscribe = protocol.broker.subscribe("command", self._onMessage)
+        protocol.comment(f'Event trace: {self.path}')
+
+    #CSV name (or load name) and deck slot of a labware, labware on a module takes the module's slot
+    def _labware(self, labware):
+        labware_name = next((name for name, loaded in self.labware_dict.items() if loaded is labware), labware.load_name)
+        slot = labware.parent if isinstance(labware.parent, str) else getattr(labware.parent, "parent", None)
+        return labware_name, slot
+
+    #Labware name, slot and well of a command location (a Well, a Location or a disposal location like the trash)
+    def _place(self, location):
+        if location is None:
+            return None, None, None
+        labware_like = getattr(location, "labware", None)
+        well = labware_like.as_well() if labware_like is not None and labware_like.is_well else location
+        if hasattr(well, "well_name"):
+            return self._labware(well.parent) + (well.well_name,)
+        if labware_like is not None and labware_like.is_labware:
+            return self._labware(labware_like.object) + (None,)
+        return type(location).__name__, None, None
+
+    def _onMessage(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][2] = True
+            self._stack.append([message, time.monotonic(), False])
+            return
+        before, start, has_children = self._stack.pop()
+        name = before["name"].replace("command.", "")
+        payload = before["payload"]
+        text = payload.get("text", "")
+        if name == "COMMENT":
+            if text.strip().startswith("~") and text.strip().endswith("~"):
+                self.phase = text.strip().strip("~").strip()
+            return
+        #Commands made of other commands (transfer, distribute, mix...) are traced through their parts
+        if has_children:
+            return
+        instrument = payload.get("instrument")
+        mount = instrument.mount if instrument is not None else None
+        labware, slot, well = self._place(payload.get("location"))
+        if name == "PICK_UP_TIP":
+            self._tips[mount] = f"{slot}/{well}"
+        event = {"seq": self._count, "command": name, "phase": self.phase, "row": self.row,
+                 "start": round(start, 4), "end": round(time.monotonic(), 4),
+                 "volume": payload.get("volume"), "pipette": mount, "tip": self._tips.get(mount),
+                 "labware": labware, "slot": slot, "well": well, "text": text}
+        if message.get("error") is not None:
+            event["error"] = str(message["error"])
+        if name in ("DROP_TIP", "DROP_TIP_IN_DISPOSAL_LOCATION", "RETURN_TIP"):
+            self._tips.pop(mount, None)
+        self._file.write(json.dumps(event) + "\n")
+        self._count += 1
+
+    #Stop tracing and close the file, call at the end of the run
+    def close(self):
+        if self._file is not None:
+            self._unsubscribe()
+            self._file.close()
+            self._file = None
+
+#How a liquid is pipetted: aspirate, dispense and blow-out speeds as multiples of the pipette's default flow rates, the
+#seconds to wait after aspirating and dispensing, an air gap in µL carried on top of the liquid, and whether to blow out
+#and touch the tip after dispensing. LiquidClass() pipettes like a plain aspirate and dispense.
+class LiquidClass:
+    __slots__ = ("aspirate_rate", "dispense_rate", "blow_out_rate", "aspirate_delay", "dispense_delay", "air_gap",
+                 "blow_out", "touch_tip")
+
+    def __init__(self, aspirate_rate=1.0, dispense_rate=1.0, blow_out_rate=1.0, aspirate_delay=0, dispense_delay=0,
+                 air_gap=0, blow_out=False, touch_tip=False):
+        self.aspirate_rate = aspirate_rate
+        self.dispense_rate = dispense_rate
+        self.blow_out_rate = blow_out_rate
+        self.aspirate_delay = aspirate_delay
+        self.dispense_delay = dispense_delay
+        self.air_gap = air_gap
+        self.blow_out = blow_out
+        self.touch_tip = touch_tip
+
+    #Air gap that still fits in the tip on top of the volume
+    def _air_gap(self, pipette, volume):
+        return max(0, min(self.air_gap, pipette.max_volume - volume))
+
+    def aspirate(self, protocol, pipette, volume, location, air_gap=True):
+        pipette.aspirate(volume, location, rate=self.aspirate_rate)
+        if self.aspirate_delay > 0:
+            protocol.delay(seconds=self.aspirate_delay)
+        if air_gap and self._air_gap(pipette, volume) > 0:
+            pipette.air_gap(self._air_gap(pipette, volume))
+
+    #The air gap of the aspiration goes out with the liquid
+    def dispense(self, protocol, pipette, volume, location, air_gap=True):
+        pipette.dispense(volume + (self._air_gap(pipette, volume) if air_gap else 0), location, rate=self.dispense_rate)
+        if self.dispense_delay > 0:
+            protocol.delay(seconds=self.dispense_delay)
+
+    #Empty and wipe the tip in the well it dispensed into, when the tip holds nothing more to dispense
+    def finish(self, pipette):
+        if self.blow_out:
+            default_rate = pipette.flow_rate.blow_out
+            pipette.flow_rate.blow_out = default_rate * self.blow_out_rate
+            pipette.blow_out()
+            pipette.flow_rate.blow_out = default_rate
+        if self.touch_tip:
+            pipette.touch_tip()
+
+    def transfer(self, protocol, pipette, volume, source, destination):
+        self.aspirate(protocol, pipette, volume, source)
+        self.dispense(protocol, pipette, volume, destination)
+        self.finish(pipette)
+
+#Liquid classes the CSV can give a liquid. Water runs at twice the default speed, enzymes in glycerol slowly with pauses
+#for the viscous liquid to follow the plunger and a touch tip for the film left outside the tip, competent cells gently,
+#bead suspensions slowly in and a blow-out, and ethanol washes with an air gap against drips.
+LIQUID_CLASSES = {
+    "water": LiquidClass(aspirate_rate=2.0, dispense_rate=2.0, blow_out=True),
+    "enzyme-glycerol": LiquidClass(aspirate_rate=0.25, dispense_rate=0.25, blow_out_rate=0.5, aspirate_delay=2, dispense_delay=2, touch_tip=True),
+    "competent cells": LiquidClass(aspirate_rate=0.5, dispense_rate=0.5, aspirate_delay=1),
+    "bead suspension": LiquidClass(aspirate_rate=0.5, blow_out=True),
+    "ethanol wash": LiquidClass(air_gap=10, blow_out=True, touch_tip=True),
+}
+
+#Function that splits a distribute into its aspirations the way the Opentrons distribute does: a volume over the
+#pipette's max volume less the disposal volume is split in two (or chunks of that size first), then consecutive
+#destinations share an aspiration while their volumes plus the disposal volume fit in the pipette.
+#Returns a list of (volumes, destinations) trips, one aspiration each
+def distributeTrips(vols, dests, max_volume, disposal_volume):
+    capacity = max_volume - disposal_volume
+    parts = []
+    for vol, dest in zip(vols, dests):
+        while vol > capacity * 2:
+            parts.append((capacity, dest))
+            vol -= capacity
+        if vol > capacity:
+            vol /= 2
+            parts.append((vol, dest))
+        parts.append((vol, dest))
+
+    trips = []
+    for vol, dest in parts:
+        if trips and sum(trips[-1][0]) + disposal_volume + vol <= max_volume:
+            trips[-1][0].append(vol)
+            trips[-1][1].append(dest)
+        else:
+            trips.append(([vol], [dest]))
+    return trips
+
+#Function that reads the optional liquid class table of the CSV, found by its Class_Liquid_Name header and followed by
+#the Liquid_Class column: each row gives one liquid of the Initial Liquid Definitions one of the LIQUID_CLASSES. Returns
+#the liquid name -> LiquidClass dict, empty if the CSV has no such table.
+def liquidClassesFromCsv(csv_data_list, liquid_names):
+    headers = [cell.strip() for cell in csv_data_list[1]] if len(csv_data_list) > 1 else []
+    if "Class_Liquid_Name" not in headers:
+        return dict()
+    first_col = headers.index("Class_Liquid_Name")
+
+    liquid_classes = dict()
+    for row_number, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [cell.strip() for cell in csv_row[first_col:first_col + 2]]
+        cells += [""] * (2 - len(cells))
+        liquid_name, class_name = cells
+        #Check if the current row is empty, if it's empty then skip it
+        if liquid_name == "":
+            continue
+        if liquid_name not in liquid_names:
+            raise RuntimeError(f'CSV row {row_number}: liquid "{liquid_name}" is not in the Initial Liquid Definitions')
+        if class_name.lower() not in LIQUID_CLASSES:
+            raise RuntimeError(f'CSV row {row_number}: unknown liquid class "{class_name}", use one of {", ".join(LIQUID_CLASSES)}')
+        liquid_classes[liquid_name] = LIQUID_CLASSES[class_name.lower()]
+    return liquid_classes
+
 
 #Runtime parameter definitions
 def add_parameters(parameters):
@@ -132,6 +653,22 @@ def add_parameters(parameters):
         default="p300_single_gen2"
     )
 
+    #Allows user to aspirate just under the liquid level, tracked from the loaded volumes, instead of near the well bottom
+    parameters.add_bool(
+        variable_name="follow_liquid",
+        display_name="Follow Liquid Level",
+        description="On = aspirate just under the liquid surface, needs the loaded volumes to be right",
+        default=False
+    )
+
+    #Allows user to record every command of the run (phase, CSV row, timing, volume, tip, well) to a JSON-lines file
+    parameters.add_bool(
+        variable_name="event_trace",
+        display_name="Event Trace",
+        description="On = write a JSON-lines trace of every command to the robot's user storage",
+        default=False
+    )
+
 #Protocol context - https://docs.opentrons.com/v2/tutorial.html
 def run(protocol: protocol_api.ProtocolContext):
 
@@ -139,6 +676,15 @@ def run(protocol: protocol_api.ProtocolContext):
     #Each item in the child lists corresponds to a single cell within its row. Data is represented as string.
     csv_data_list = protocol.params.etp_csv.parse_as_csv()
 
+    #Heat shock program, from the optional Profile_Stage table of the CSV or else 42 degrees Celsius for 40 sec then a 4 degrees
+    #Celsius hold. Built before any liquid handling so a wrong profile table stops the run right away
+    shock_profile = profileFromCsv(csv_data_list)
+    if shock_profile is None:
+        shock_profile = ThermocyclerProfile(final_hold=4).add_stage([(42, 40)])
+
+    #Opt-in JSON-lines trace of every command of the run (see EventTrace)
+    event_trace = EventTrace(protocol, protocol.params.event_trace, name=metadata["protocolName"])
+
     #Discard the first row of csv, since that's all the titles of the columns.
     csv_trunc_data = csv_data_list[2:]
 
@@ -158,7 +704,7 @@ def run(protocol: protocol_api.ProtocolContext):
 
     #Load the labware with its api name, look it up in labware library - https://labware.opentrons.com/
     #Add labware to dictionary
-    labware_dict = dict([
+    labware_dict = LabwareRegistry([
                          ('pcr_strip', tc_mod.load_labware("opentrons_96_aluminumblock_generic_pcr_strip_200ul")), 
                          ('media_rack', protocol.load_labware("opentrons_10_tuberack_falcon_4x50ml_6x15ml_conical", 6)), 
                          ('cell_rack', protocol.load_labware("opentrons_24_aluminumblock_nest_2ml_snapcap", 2)),
@@ -182,6 +728,10 @@ def run(protocol: protocol_api.ProtocolContext):
 
     # ----------------------LIQUID DEFINITIONS------------------------- #
 
+    #Volume in every well the steps touch, starting from the loaded liquids
+    liquid_tracker = LiquidTracker(protocol.params.follow_liquid)
+    loaded_liquids = dict() #well -> liquid name
+
     for csv_row in csv_trunc_data:
         #Check if the current row is empty, if it's empty then skip it
         if csv_row[1] != "":
@@ -201,24 +751,38 @@ def run(protocol: protocol_api.ProtocolContext):
                 display_color=liquid_color
             )
 
-            #Get object of current labware given the variable name
-            curr_labware = getLabwareObject(labware_dict, labware)
-            #Add the liquids to the current labware
-            curr_labware[liquid_well].load_liquid(liquid=current_liquid, volume=liquid_volume)
+            #Add the liquids to the current labware, given the variable name
+            labware_dict.well(labware, liquid_well).load_liquid(liquid=current_liquid, volume=liquid_volume)
+            loaded_liquids[labware_dict.well(labware, liquid_well)] = liquid_name
+            liquid_tracker.load(labware_dict.well(labware, liquid_well), liquid_volume)
+
+    #Liquid class of each loaded well, from the optional Class_Liquid_Name table of the CSV
+    liquid_classes = liquidClassesFromCsv(csv_data_list, set(loaded_liquids.values()))
+    well_classes = {well: liquid_classes[name] for well, name in loaded_liquids.items() if name in liquid_classes}
+
+    event_trace.labware_dict = labware_dict
+
+    #Compile the three pipetting steps tables once, before any liquid handling
+    #Source_Labware is column 8 for the cell transfer, 16 for the DNA transfer and 24 for the media transfer
+    cell_plan = compileTransferPlan(protocol, csv_data_list, labware_dict, first_col=8, has_pipette_col=True)
+    dna_plan = compileTransferPlan(protocol, csv_data_list, labware_dict, first_col=16, has_pipette_col=True)
+    #The media is distributed with one tip per source, so its Pick_Up_Tip and Pipette_Choice columns aren't read, and
+    #rows with a blank or non-numeric volume are skipped
+    media_plan = compileTransferPlan(protocol, csv_data_list, labware_dict, first_col=24, has_tip_col=False,
+                                     skip_bad_volumes=True)
 
     #Get the starting tips in this format: LetterNumber ex. A1
     left_starting_tip = str(protocol.params.left_starting_tip_let) + str(protocol.params.left_starting_tip_num)
     right_starting_tip = str(protocol.params.right_starting_tip_let) + str(protocol.params.right_starting_tip_num)
 
+    #Tips left in each tip rack, keyed by the pipette that uses it
+    tip_trackers = {"p20": TipTracker([tips_20]), "p300": TipTracker([tips_300])}
+
     #Set the starting tips for the tip racks:
-    if left_pip_name == "p20":
-        pipette_dict[str(left_pip_name)].starting_tip = tips_20.well(left_starting_tip)
-    elif left_pip_name == "p300":
-        pipette_dict[str(left_pip_name)].starting_tip = tips_300.well(left_starting_tip)
-    if right_pip_name == "p20":
-        pipette_dict[str(right_pip_name)].starting_tip = tips_20.well(right_starting_tip)
-    elif right_pip_name == "p300":
-        pipette_dict[str(right_pip_name)].starting_tip = tips_300.well(right_starting_tip)
+    if left_pip_name in tip_trackers:
+        tip_trackers[left_pip_name].skipTo(tip_trackers[left_pip_name].racks[0].well(left_starting_tip))
+    if right_pip_name in tip_trackers:
+        tip_trackers[right_pip_name].skipTo(tip_trackers[right_pip_name].racks[0].well(right_starting_tip))
 
     #Set the first transfer (aka var for checking if this is the first liquid transfer)
     first_transfer_left = True
@@ -241,69 +805,58 @@ def run(protocol: protocol_api.ProtocolContext):
     
 
     # ----------------------TRANSFER COMPETENT CELLS------------------------- #
-    # Column indices from your CSV
-    SRC_LAB_COL = 8
-    SRC_WELL_COL = 9
-    DST_LAB_COL = 10
-    DST_WELL_COL = 11
-    VOLUME_COL = 12   # <-- 'Competent cell transfer volume' for this table
-
-    # Group (src_lab, src_well) -> list of (dest_lab, dest_well) and matching volumes
-    groups = defaultdict(lambda: {"dests": [], "vols": []})
-    for row in csv_trunc_data:
-
-
-        # skip rows without a source labware entry
-        if not str(row[SRC_LAB_COL]).strip():
-            continue
-
-        src_lab  = str(row[SRC_LAB_COL]).strip()
-        src_well = str(row[SRC_WELL_COL]).strip()
-        dst_lab  = str(row[DST_LAB_COL]).strip()
-        dst_well = str(row[DST_WELL_COL]).strip()
-
-        # parse per-row volume (uL)
-        vol_cell = row[VOLUME_COL] if len(row) > VOLUME_COL else ""
-        try:
-            vol = float(str(vol_cell).strip())
-        except Exception:
-            # skip rows with non-numeric volume
-            continue
-        if vol <= 0:
+    protocol.comment('\n\n~~~~~~~~~~Transfer Competent Cells~~~~~~~~~~\n')
+    # Group (src_lab, src_well) -> source well, list of destination wells and matching volumes
+    groups = defaultdict(lambda: {"src": None, "dests": [], "vols": [], "rows": []})
+    for step in cell_plan:
+        # skip rows without a positive volume
+        if step.volume <= 0:
             continue
 
-        groups[(src_lab, src_well)]["dests"].append((dst_lab, dst_well))
-        groups[(src_lab, src_well)]["vols"].append(vol)
+        groups[(step.source_labware, step.source_well)]["src"] = step.source
+        groups[(step.source_labware, step.source_well)]["dests"].append(step.destination)
+        groups[(step.source_labware, step.source_well)]["vols"].append(step.volume)
+        groups[(step.source_labware, step.source_well)]["rows"].append(step.row)
 
 
-    # 2) (optional) mimic your previous rate=2.0 behavior once, not per row
+    # 2) twice the default flow rates (the previous rate=2.0), unless the source's liquid class says otherwise
     orig_asp, orig_disp = p300.flow_rate.aspirate, p300.flow_rate.dispense
-    p300.flow_rate.aspirate = orig_asp * 2.0
-    p300.flow_rate.dispense = orig_disp * 2.0
+    double_class = LiquidClass(aspirate_rate=2.0, dispense_rate=2.0)
 
     # 3) One tip for the entire distribute step (or move pick/drop inside the loop to use one tip per source)
     # Do one distribute per source with a LIST of volumes
-    for (src_lab, src_well), payload in groups.items():
-        src_labware = getLabwareObject(labware_dict, src_lab)
-        src = src_labware[src_well]
+    for payload in groups.values():
+        src = payload["src"]
+        event_trace.row = payload["rows"]
 
-        dest_wells = [getLabwareObject(labware_dict, dl)[dw] for (dl, dw) in payload["dests"]]
+        dest_wells = payload["dests"]
         vols = payload["vols"]  # aligns 1:1 with dest_wells
 
         if not dest_wells:
             continue
 
-        p300.pick_up_tip()
-        p300.distribute(
-            vols,                 # <-- list of per-destination volumes (uL)
-            src,
-            dest_wells,
-            new_tip='never',
-            disposal_volume=5,
-            blow_out=True
-        )
+        liquid_class = well_classes.get(src, double_class)
+        p300.flow_rate.aspirate = orig_asp * liquid_class.aspirate_rate
+        p300.flow_rate.dispense = orig_disp * liquid_class.dispense_rate
+
+        tip_trackers["p300"].pickUp(p300)
+        # one distribute per aspiration, each going under the level left once it is done, its disposal volume included
+        for trip_vols, trip_dests in distributeTrips(vols, dest_wells, p300.max_volume, 5):
+            src_loc = liquid_tracker.aspirateFrom(p300, src, sum(trip_vols) + 5)
+            for dest, vol in zip(trip_dests, trip_vols):
+                liquid_tracker.dispenseInto(dest, vol)
+            p300.distribute(
+                trip_vols,            # <-- list of per-destination volumes (uL)
+                src_loc,
+                trip_dests,
+                new_tip='never',
+                disposal_volume=5,
+                blow_out=True
+            )
         p300.drop_tip()
 
+    event_trace.row = None
+
     # 4) restore flow rates
     p300.flow_rate.aspirate = orig_asp
     p300.flow_rate.dispense = orig_disp
@@ -311,152 +864,111 @@ def run(protocol: protocol_api.ProtocolContext):
 
         
     # ----------------------TRANSFER DNA------------------------- #
-    for csv_row in csv_trunc_data:
-        #Check if the current row is empty, if it's empty then skip it
-        if csv_row[16] != "":
-
-            #Define variables from CSV columns
-            source_labware = csv_row[16]
-            source_well = csv_row[17]
-            destination_labware = csv_row[18]
-            destination_well = csv_row[19]
-            transfer_volume = float(csv_row[20])
-            pick_up_tip = str(csv_row[21])
-            pipette_choice = csv_row[22]
-
-            curr_source_labware = getLabwareObject(labware_dict, source_labware)
-            curr_destination_labware = getLabwareObject(labware_dict, destination_labware)
-
-            if pipette_choice == "Left":
-                curr_pip = left_pip_obj
-            elif pipette_choice == "Right":
-                curr_pip = right_pip_obj
-
-            #If we want to switch tips, pick up a new tip
-            if pick_up_tip == 'TRUE':
-                if pipette_choice == "Left" and first_transfer_left == True:
-                    #Pick up the first tip
-                    curr_pip.pick_up_tip()
-                    first_transfer_left = False
-                elif pipette_choice == "Right" and first_transfer_right == True:
-                    #Pick up the first tip
-                    curr_pip.pick_up_tip()
-                    first_transfer_right = False
-                else:
-                    #Discard the previous tip
-                    curr_pip.drop_tip()
-                    #Pick up the next tip, will always pick up the next available tip
-                    curr_pip.pick_up_tip()
-
-                #Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                curr_pip.aspirate(transfer_volume, curr_source_labware[source_well])
-                #Dispense liquid, with this format (amount in microliters, well location)
-                curr_pip.dispense(transfer_volume, curr_destination_labware[destination_well])
-                curr_pip.mix(2, 10, curr_destination_labware[destination_well], rate=3)
-                curr_pip.blow_out()
-
-            #If we want to keep using the same tip as before
-            elif pick_up_tip == 'FALSE':
-                if pipette_choice == "Left" and first_transfer_left == True:
-                #Pick up the first tip
-                    curr_pip.pick_up_tip()
-                    first_transfer_left = False
-                elif pipette_choice == "Right" and first_transfer_right == True:
-                    #Pick up the first tip
-                    curr_pip.pick_up_tip()
-                    first_transfer_right = False
-
-                #Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                curr_pip.aspirate(transfer_volume, curr_source_labware[source_well])
-                #Dispense liquid, with this format (amount in microliters, well location)
-                curr_pip.dispense(transfer_volume, curr_destination_labware[destination_well])
-                curr_pip.mix(2, 10, curr_destination_labware[destination_well], rate=3)
-                curr_pip.blow_out()
-
-            else:
-
-                protocol.comment('Please specify whether to use new or same tip')
+    protocol.comment('\n\n~~~~~~~~~~Transfer DNA~~~~~~~~~~\n')
+    #The DNA is pipetted the way its liquid class says, and blown out after the mix without one
+    blow_out_class = LiquidClass(blow_out=True)
+    for step in dna_plan:
+        event_trace.row = step.row
+        if step.pipette_choice == "Left":
+            curr_pip = left_pip_obj
+            curr_tips = tip_trackers[left_pip_name]
+        elif step.pipette_choice == "Right":
+            curr_pip = right_pip_obj
+            curr_tips = tip_trackers[right_pip_name]
+
+        if step.pipette_choice == "Left" and first_transfer_left == True:
+            #Pick up the first tip
+            curr_tips.pickUp(curr_pip)
+            first_transfer_left = False
+        elif step.pipette_choice == "Right" and first_transfer_right == True:
+            #Pick up the first tip
+            curr_tips.pickUp(curr_pip)
+            first_transfer_right = False
+        #If we want to switch tips, pick up a new tip
+        elif step.new_tip == True:
+            #Discard the previous tip
+            curr_pip.drop_tip()
+            #Pick up the next tip, will always pick up the next available tip
+            curr_tips.pickUp(curr_pip)
+
+        liquid_class = well_classes.get(step.source, blow_out_class)
+        #Aspirate [take in] liquid, with this format (amount in microliters, well location)
+        liquid_class.aspirate(protocol, curr_pip, step.volume, liquid_tracker.aspirateFrom(curr_pip, step.source, step.volume))
+        #Dispense liquid, with this format (amount in microliters, well location)
+        liquid_class.dispense(protocol, curr_pip, step.volume, liquid_tracker.dispenseInto(step.destination, step.volume))
+        curr_pip.mix(2, 10, step.destination, rate=3)
+        liquid_class.finish(curr_pip)
 
     #Discard the previous tip
     curr_pip.drop_tip()
+    event_trace.row = None
 
     #Set the first transfer (aka var for checking if this is the first liquid transfer)
     first_transfer_left = True
     first_transfer_right = True
 
     # ----------------------------HEAT SHOCK -------------------------- #
+    protocol.comment('\n\n~~~~~~~~~~Heat Shock~~~~~~~~~~\n')
     protocol.delay(minutes=10)
 
-    tc_mod.set_block_temperature(
-        temperature=42,
-        hold_time_seconds=40)
-    tc_mod.set_block_temperature(temperature=4)
+    #Heat shock pulse, then back to the cold block
+    shock_profile.run(tc_mod)
 
     protocol.delay(minutes=5)
     
 # ----------------------TRANSFER OUTGROWTH MEDIUM------------------------- #
-    # Column indices from your CSV
-    SRC_LAB_COL = 24
-    SRC_WELL_COL = 25
-    DST_LAB_COL = 26
-    DST_WELL_COL = 27
-    VOLUME_COL = 28   # <-- 'medium transfer volume' for this table
-
-    # Group (src_lab, src_well) -> list of (dest_lab, dest_well) and matching volumes
-    groups = defaultdict(lambda: {"dests": [], "vols": []})
-    for row in csv_trunc_data:
-
-        # skip rows without a source labware entry
-        if not str(row[SRC_LAB_COL]).strip():
-            continue
-
-        src_lab  = str(row[SRC_LAB_COL]).strip()
-        src_well = str(row[SRC_WELL_COL]).strip()
-        dst_lab  = str(row[DST_LAB_COL]).strip()
-        dst_well = str(row[DST_WELL_COL]).strip()
-
-        # parse per-row volume (uL)
-        vol_cell = row[VOLUME_COL] if len(row) > VOLUME_COL else ""
-        try:
-            vol = float(str(vol_cell).strip())
-        except Exception:
-            # skip rows with non-numeric volume
-            continue
-        if vol <= 0:
+    protocol.comment('\n\n~~~~~~~~~~Transfer Outgrowth Medium~~~~~~~~~~\n')
+    # Group (src_lab, src_well) -> source well, list of destination wells and matching volumes
+    groups = defaultdict(lambda: {"src": None, "dests": [], "vols": [], "rows": []})
+    for step in media_plan:
+        # skip rows without a positive volume
+        if step.volume <= 0:
             continue
 
-        groups[(src_lab, src_well)]["dests"].append((dst_lab, dst_well))
-        groups[(src_lab, src_well)]["vols"].append(vol)
+        groups[(step.source_labware, step.source_well)]["src"] = step.source
+        groups[(step.source_labware, step.source_well)]["dests"].append(step.destination)
+        groups[(step.source_labware, step.source_well)]["vols"].append(step.volume)
+        groups[(step.source_labware, step.source_well)]["rows"].append(step.row)
 
 
-    # 2) (optional) mimic your previous rate=2.0 behavior once, not per row
+    # 2) twice the default flow rates (the previous rate=2.0), unless the source's liquid class says otherwise
     orig_asp, orig_disp = p300.flow_rate.aspirate, p300.flow_rate.dispense
-    p300.flow_rate.aspirate = orig_asp * 2.0
-    p300.flow_rate.dispense = orig_disp * 2.0
+    double_class = LiquidClass(aspirate_rate=2.0, dispense_rate=2.0)
 
     # 3) One tip for the entire distribute step (or move pick/drop inside the loop to use one tip per source)
     # Do one distribute per source with a LIST of volumes
-    for (src_lab, src_well), payload in groups.items():
-        src_labware = getLabwareObject(labware_dict, src_lab)
-        src = src_labware[src_well]
+    for payload in groups.values():
+        src = payload["src"]
+        event_trace.row = payload["rows"]
 
-        dest_wells = [getLabwareObject(labware_dict, dl)[dw].top(z=0) for (dl, dw) in payload["dests"]]
+        dest_wells = payload["dests"]
         vols = payload["vols"]  # aligns 1:1 with dest_wells
 
         if not dest_wells:
             continue
 
-        p300.pick_up_tip()
-        p300.distribute(
-            vols,                 # <-- list of per-destination volumes (uL)
-            src,
-            dest_wells,
-            new_tip='never',
-            disposal_volume=0,
-            blow_out=False
-        )
+        liquid_class = well_classes.get(src, double_class)
+        p300.flow_rate.aspirate = orig_asp * liquid_class.aspirate_rate
+        p300.flow_rate.dispense = orig_disp * liquid_class.dispense_rate
+
+        tip_trackers["p300"].pickUp(p300)
+        # one distribute per aspiration, each going under the level left once it is done
+        for trip_vols, trip_dests in distributeTrips(vols, payload["dests"], p300.max_volume, 0):
+            src_loc = liquid_tracker.aspirateFrom(p300, src, sum(trip_vols))
+            for dest, vol in zip(trip_dests, trip_vols):
+                liquid_tracker.dispenseInto(dest, vol)
+            p300.distribute(
+                trip_vols,            # <-- list of per-destination volumes (uL)
+                src_loc,
+                [dest.top(z=0) for dest in trip_dests],
+                new_tip='never',
+                disposal_volume=0,
+                blow_out=False
+            )
         p300.drop_tip()
 
+    event_trace.row = None
+
     # 4) restore flow rates
     p300.flow_rate.aspirate = orig_asp
     p300.flow_rate.dispense = orig_disp
@@ -466,6 +978,7 @@ def run(protocol: protocol_api.ProtocolContext):
     protocol.pause("Cap the PCR strip tubes on TC and turn off the HEPA module")
 
     # -----------------INCUBATION AT 37C------------------- #
+    protocol.comment('\n\n~~~~~~~~~~Incubation at 37C~~~~~~~~~~\n')
     tc_mod.set_block_temperature(
         temperature=37,
         hold_time_minutes=60)
@@ -474,3 +987,6 @@ def run(protocol: protocol_api.ProtocolContext):
 
     # -----------------MANUAL PLATING------------------- #
     protocol.pause("Time to plate the cells on agar plates")
+
+    #Stop the event trace
+    event_trace.close()
@@ -4,6 +4,11 @@ from opentrons.types import Point
 import threading
 from time import sleep
 import math
+import json
+import re
+import os
+import tempfile
+import time
 
 # metadata
 metadata = {
@@ -83,6 +88,43 @@ def add_parameters(parameters):
         {"display_name": "Right", "value": "right"}]
     )
 
+    #Allows user to add unused wells as liquid waste once the slot 8 reservoir is full, instead of pausing to empty it
+    parameters.add_str(
+        variable_name="overflow_waste",
+        display_name="Overflow Liquid Waste",
+        description="Unused wells that take the liquid waste once the slot 8 reservoir is full",
+        default="none",
+        choices=[
+            {"display_name": "None", "value": "none"},
+            {"display_name": "Reservoir columns 9-12", "value": "reservoir"},
+            {"display_name": "Reservoir 9-12, deep-well 3-12", "value": "reservoir_plate"},
+        ]
+    )
+
+    #Allows user to process two collection plates in one run, interleaved on the heater-shaker and magnetic module
+    parameters.add_bool(
+        variable_name="two_plates",
+        display_name="Two-Plate Batch",
+        description="On = 2nd collection plate in slot 7, its parking rack in slot 6; tips only in slot 5",
+        default=False
+    )
+
+    #Allows user to take fresh tips from the parking rack columns that no sample parks in, after the 300µl racks
+    parameters.add_bool(
+        variable_name="parking_rack_tips",
+        display_name="Tips From Parking Racks",
+        description="On = use the parking racks' spare columns as fresh tips, load fresh parking racks",
+        default=False
+    )
+
+    #Allows user to record every command of the run (phase, CSV row, timing, volume, tip, well) to a JSON-lines file
+    parameters.add_bool(
+        variable_name="event_trace",
+        display_name="Event Trace",
+        description="On = write a JSON-lines trace of every command to the robot's user storage",
+        default=False
+    )
+
 # Definitions for deck light flashing
 class CancellationToken:
     def __init__(self):
@@ -109,11 +151,271 @@ def create_thread(ctx, cancel_token):
     t1.start()
     return t1
 
+#Tips left in a set of 96 tip racks, shared by every pipette (single or 8-channel) that picks up from them. Each tip is
+#one byte of a bytearray (free, used or reserved) in the racks' column order, and the free tips and full free columns
+#are counted as tips get used, so remaining() is O(1). Reserved tips, ex. columns kept for parking, are never handed
+#out and stay as they are on refill(). state() gives a JSON-friendly copy of the tracker that restore() reads back.
+class TipTracker:
+    __slots__ = ("racks", "_wells", "_state", "_column_free", "_free", "_free_columns")
+    FREE, USED, RESERVED = 0, 1, 2
+
+    def __init__(self, racks):
+        self.racks = list(racks)
+        #Every tip, A1, B1 ... H1, A2 ... of the first rack, then the next rack
+        self._wells = [well for rack in self.racks for well in rack.wells()]
+        self._state = bytearray(len(self._wells))
+        self._recount()
+
+    #Position of a tip well in the tracker
+    def _index(self, well):
+        rack_number = next((number for number, rack in enumerate(self.racks) if rack is well.parent), None)
+        if rack_number is None:
+            raise RuntimeError(f'{well} is not in the tip racks {", ".join(str(rack) for rack in self.racks)}')
+        return rack_number * 96 + (int(well.well_name[1:]) - 1) * 8 + ord(well.well_name[0]) - ord("A")
+
+    def _mark(self, index, tip_state):
+        if self._state[index] == self.FREE:
+            self._free -= 1
+            column = index // 8
+            if self._column_free[column] == 8:
+                self._free_columns -= 1
+            self._column_free[column] -= 1
+        self._state[index] = tip_state
+
+    def _recount(self):
+        self._column_free = bytearray(self._state[start:start + 8].count(self.FREE) for start in range(0, len(self._state), 8))
+        self._free = self._state.count(self.FREE)
+        self._free_columns = self._column_free.count(8)
+
+    #Keep tips out of the pick ups, with channels=8 each well reserves itself and the 7 wells below it
+    def reserve(self, wells, channels=1):
+        for well in wells:
+            first = self._index(well)
+            for index in range(first, first + channels):
+                self._mark(index, self.RESERVED)
+
+    #Start picking up at this tip, every free tip before it counts as used (like the pipette's starting_tip)
+    def skipTo(self, well):
+        for index in range(self._index(well)):
+            if self._state[index] == self.FREE:
+                self._mark(index, self.USED)
+
+    #Free tips, or full free columns for an 8-channel
+    def remaining(self, channels=1):
+        return self._free if channels == 1 else self._free_columns
+
+    #Tips (or columns) the racks without reserved tips hold when full, what refill() gives back
+    def refillable(self, channels=1):
+        racks = sum(1 for number in range(len(self.racks)) if self.RESERVED not in self._state[number * 96:(number + 1) * 96])
+        return racks * (96 if channels == 1 else 12)
+
+    #Next tip (or the top of the next full column for an 8-channel), marked as used, None if there is none left
+    def next(self, channels=1):
+        if self.remaining(channels) == 0:
+            return None
+        if channels == 1:
+            first = self._state.find(self.FREE)
+        else:
+            first = self._column_free.find(8) * 8
+        for index in range(first, first + channels):
+            self._mark(index, self.USED)
+        return self._wells[first]
+
+    #Pick up the next tip with the pipette, returns the tip well
+    def pickUp(self, pipette):
+        well = self.next(pipette.channels)
+        if well is None:
+            raise RuntimeError(f'Out of tips for the {pipette.name}, add more tip racks')
+        pipette.pick_up_tip(well)
+        return well
+
+    #The operator swapped the racks without reserved tips for full ones
+    def refill(self):
+        for number in range(len(self.racks)):
+            if self.RESERVED not in self._state[number * 96:(number + 1) * 96]:
+                self._state[number * 96:(number + 1) * 96] = bytes(96)
+        self._recount()
+
+    def state(self):
+        return {"racks": [f"{rack.load_name} in slot {rack.parent}" for rack in self.racks], "tips": self._state.hex()}
+
+    def restore(self, state):
+        if state["racks"] != self.state()["racks"]:
+            raise RuntimeError('The saved tip state is for other tip racks: ' + ", ".join(state["racks"]))
+        self._state = bytearray.fromhex(state["tips"])
+        self._recount()
+
+
+#Opt-in trace of the run: every pipette, module, delay and pause command is written to a JSON-lines file with
+#the phase (from the "~~~Phase~~~" comments), the CSV row being executed, its monotonic start/end time, the volume,
+#the tip on the pipette and the labware/well. Set row before the commands of each CSV row (an int, or a list of
+#rows for a multi-dispense). When disabled every method does nothing, so the protocol can always call it.
+class EventTrace:
+    def __init__(self, protocol, enabled, name="run"):
+        self.row = None
+        self.phase = "Setup"
+        #Loaded labware keyed by their CSV names, set it once the labware is loaded so events use the table's names
+        self.labware_dict = {}
+        self.path = None
+        self._file = None
+        self._stack = []
+        self._tips = {}
+        self._count = 0
+        if not enabled:
+            return
+        #On the robot traces go to the user storage, kept between runs. Simulations (and the App analysis) use a temp folder
+        folder = os.path.join(tempfile.gettempdir(), "botany_traces") if protocol.is_simulating() else "/data/user_storage/botany_traces"
+        self.path = os.path.join(folder, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.jsonl')
+        try:
+            os.makedirs(folder, exist_ok=True)
+            #Line buffered, so the trace is complete up to the last command even if the run is cancelled
+            self._file = open(self.path, "w", buffering=1)
+        except OSError as error:
+            protocol.comment(f'Event trace disabled, cannot write {self.path}: {error}')
+            return
+        self._unsubscribe = protocol.broker.subscribe("command", self._onMessage)
+        protocol.comment(f'Event trace: {self.path}')
+
+    #CSV name (or load name) and deck slot of a labware, labware on a module takes the module's slot
+    def _labware(self, labware):
+        labware_name = next((name for name, loaded in self.labware_dict.items() if loaded is labware), labware.load_name)
+        slot = labware.parent if isinstance(labware.parent, str) else getattr(labware.parent, "parent", None)
+        return labware_name, slot
+
+    #Labware name, slot and well of a command location (a Well, a Location or a disposal location like the trash)
+    def _place(self, location):
+        if location is None:
+            return None, None, None
+        labware_like = getattr(location, "labware", None)
+        well = labware_like.as_well() if labware_like is not None and labware_like.is_well else location
+        if hasattr(well, "well_name"):
+            return self._labware(well.parent) + (well.well_name,)
+        if labware_like is not None and labware_like.is_labware:
+            return self._labware(labware_like.object) + (None,)
+        return type(location).__name__, None, None
+
+    def _onMessage(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][2] = True
+            self._stack.append([message, time.monotonic(), False])
+            return
+        before, start, has_children = self._stack.pop()
+        name = before["name"].replace("command.", "")
+        payload = before["payload"]
+        text = payload.get("text", "")
+        if name == "COMMENT":
+            if text.strip().startswith("~") and text.strip().endswith("~"):
+                self.phase = text.strip().strip("~").strip()
+            return
+        #Commands made of other commands (transfer, distribute, mix...) are traced through their parts
+        if has_children:
+            return
+        instrument = payload.get("instrument")
+        mount = instrument.mount if instrument is not None else None
+        labware, slot, well = self._place(payload.get("location"))
+        if name == "PICK_UP_TIP":
+            self._tips[mount] = f"{slot}/{well}"
+        event = {"seq": self._count, "command": name, "phase": self.phase, "row": self.row,
+                 "start": round(start, 4), "end": round(time.monotonic(), 4),
+                 "volume": payload.get("volume"), "pipette": mount, "tip": self._tips.get(mount),
+                 "labware": labware, "slot": slot, "well": well, "text": text}
+        if message.get("error") is not None:
+            event["error"] = str(message["error"])
+        if name in ("DROP_TIP", "DROP_TIP_IN_DISPOSAL_LOCATION", "RETURN_TIP"):
+            self._tips.pop(mount, None)
+        self._file.write(json.dumps(event) + "\n")
+        self._count += 1
+
+    #Stop tracing and close the file, call at the end of the run
+    def close(self):
+        if self._file is not None:
+            self._unsubscribe()
+            self._file.close()
+            self._file = None
+
+#Robot time of the run so far, predicted from the commands issued: the volume over the flow rate of every aspirate and
+#dispense, fixed times for moves, tips, blow-outs and modules, and the delays and heater-shaker ramps. It follows the
+#commands only, never the wall clock, so the protocol analysis and the robot run work out the same waits. Pauses and
+#manual labware moves count for nothing, the robot waits on the operator there.
+class RunClock:
+    FLOW_RATE_PATTERN = re.compile(r"at ([0-9.]+) uL/sec")
+    TEMPERATURE_PATTERN = re.compile(r"to (-?[0-9.]+) °C")
+    #Seconds per command, from the Opentrons duration estimator and Tools/botany_estimate.py
+    MOVE_SECONDS = 1.0
+    PICK_UP_TIP_SECONDS = 4.0
+    DROP_TIP_SECONDS = 10.0
+    BLOW_OUT_SECONDS = 0.5
+    TOUCH_TIP_SECONDS = 0.5
+    MODULE_SECONDS = 3.0
+    HS_RAMP_RATE = 0.1 #Celsius per second
+    ROOM_TEMPERATURE = 25.0
+
+    def __init__(self, protocol):
+        self.seconds = 0.0
+        self._stack = []
+        self._heater_shaker = self.ROOM_TEMPERATURE
+        self._heater_shaker_ready_at = 0.0
+        self._unsubscribe = protocol.broker.subscribe("command", self._onMessage)
+
+    def _onMessage(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][1] = True
+            self._stack.append([message, False])
+            return
+        before, has_children = self._stack.pop()
+        #Commands made of other commands (transfer, mix...) are counted through their parts
+        if message.get("error") is None and not has_children:
+            self.seconds += self._estimate(before["name"].replace("command.", ""), before["payload"])
+
+    def _estimate(self, name, payload):
+        text = payload.get("text", "")
+        if name in ("ASPIRATE", "DISPENSE", "DISPENSE_IN_DISPOSAL_LOCATION"):
+            flow_rate = self.FLOW_RATE_PATTERN.search(text)
+            if flow_rate and float(flow_rate.group(1)) > 0:
+                return self.MOVE_SECONDS + float(payload.get("volume") or 0) / float(flow_rate.group(1))
+            return self.MOVE_SECONDS
+        if name in ("BLOW_OUT", "BLOW_OUT_IN_DISPOSAL_LOCATION"):
+            return self.MOVE_SECONDS + self.BLOW_OUT_SECONDS
+        if name == "TOUCH_TIP":
+            return self.TOUCH_TIP_SECONDS
+        if name == "PICK_UP_TIP":
+            return self.MOVE_SECONDS + self.PICK_UP_TIP_SECONDS
+        if name in ("DROP_TIP", "DROP_TIP_IN_DISPOSAL_LOCATION", "RETURN_TIP"):
+            return self.MOVE_SECONDS + self.DROP_TIP_SECONDS
+        if name in ("MOVE_TO", "MOVE_TO_DISPOSAL_LOCATION"):
+            return self.MOVE_SECONDS
+        if name == "DELAY":
+            return float(payload.get("minutes") or 0) * 60 + float(payload.get("seconds") or 0)
+        #Heater-Shaker, heating runs in the background until the protocol waits for the temperature
+        if name == "HEATER_SHAKER_SET_TARGET_TEMPERATURE":
+            target = self.TEMPERATURE_PATTERN.search(text)
+            target = float(target.group(1)) if target else self.ROOM_TEMPERATURE
+            self._heater_shaker_ready_at = self.seconds + max(target - self._heater_shaker, 0) / self.HS_RAMP_RATE
+            self._heater_shaker = target
+            return 0.0
+        if name == "HEATER_SHAKER_WAIT_FOR_TEMPERATURE":
+            return max(self._heater_shaker_ready_at - self.seconds, 0.0)
+        if name == "HEATER_SHAKER_DEACTIVATE_HEATER":
+            self._heater_shaker = self.ROOM_TEMPERATURE
+            return 0.0
+        if name.startswith("HEATER_SHAKER") or name.startswith("MAGDECK"):
+            return self.MODULE_SECONDS
+        return 0.0
+
+    #Stop following the commands, call at the end of the run
+    def close(self):
+        self._unsubscribe()
+
 # protocol run function
 def run(ctx: protocol_api.ProtocolContext):
     # Setup for flashing lights notification to empty trash
     cancellationToken = CancellationToken()
 
+    #Opt-in JSON-lines trace of every command of the run (see EventTrace)
+    event_trace = EventTrace(ctx, ctx.params.event_trace, name=metadata["protocolName"])
+
     # run time parameters
     num_samp = ctx.params.num_samp  
     starting_col = ctx.params.starting_col
@@ -122,6 +424,9 @@ def run(ctx: protocol_api.ProtocolContext):
     collection_plate_type = ctx.params.collection_plate_type
     dry_run = ctx.params.dry_run     ## ctx.params.dry_run skips steps & shorthens incubations for quicker run-time/testing
     pipette_location = ctx.params.pipette_side
+    two_plates = ctx.params.two_plates
+    overflow_waste = ctx.params.overflow_waste
+    parking_rack_tips = ctx.params.parking_rack_tips
 
 
     # variables
@@ -147,6 +452,8 @@ def run(ctx: protocol_api.ProtocolContext):
     hs_mod = ctx.load_module('heaterShakerModuleV1', location=10)
     # hs_adapter = hs_mod.load_adapter("opentrons_96_deep_well_adapter")
     hs_mod.close_labware_latch()
+    # the samples sit on the heater-shaker for the bead binding, make sure it isn't still warm from a previous run
+    hs_mod.deactivate_heater()
 
     # optimization parameters
     # mag_time = 3        # number of minutes on magnetic block
@@ -160,13 +467,20 @@ def run(ctx: protocol_api.ProtocolContext):
     collection_plate = hs_mod.load_labware(collection_plate_type, label="Collection Plate")  # 'nest_96_wellplate_2ml_deep' Replaced with custom labware definition
     dw_plate = ctx.load_labware("nest_96_wellplate_2ml_deep", location=2, label="NEST 2 mL Deepwell Plate") # requested slot 7, moved due to conflict with H-S mod
     reservoir = ctx.load_labware("nest_12_reservoir_15ml", location= 3, label="NEST 12-well Reservoir")
-    waste = ctx.load_labware('nest_1_reservoir_195ml', location= 8, label="NEST 1-well Reservoir").wells()[0].top()  # empty (trash)
+    waste_reservoir = ctx.load_labware('nest_1_reservoir_195ml', location= 8, label="NEST 1-well Reservoir")  # empty (trash)
     tips300 = [ctx.load_labware("opentrons_96_tiprack_300ul", location = slot, label="300 µL Tiprack")
-                               for slot in ['5', '6']] 
+                               for slot in (['5'] if two_plates else ['5', '6'])] 
     
     parkingrack = ctx.load_labware(
         'opentrons_96_tiprack_300ul', '9', 'tiprack for parking')
     parking_spots = parkingrack.rows()[0][starting_col:adj_col]
+
+    # two-plate batch: the 2nd collection plate waits in slot 7 (the 8-channel can't reach it there, it is only pipetted on
+    # the modules), its tips are parked in slot 6 and its elution plate replaces the 1st one in slot 4 before it elutes
+    if two_plates:
+        collection_plate_2 = ctx.load_labware(collection_plate_type, location=7, label="Collection Plate 2")
+        parkingrack_2 = ctx.load_labware('opentrons_96_tiprack_300ul', '6', 'tiprack for parking, plate 2')
+        elution_plate_2 = ctx.load_labware(elution_plate_type, location=protocol_api.OFF_DECK, label="Elution Plate 2")
    
 
     # pipettes
@@ -234,56 +548,54 @@ def run(ctx: protocol_api.ProtocolContext):
     adj_well = starting_col*8
     for well in collection_plate.wells()[adj_well:num_samp+adj_well]:
         well.load_liquid(liquid=sample_color, volume=sample_vol)
+    if two_plates:
+        for well in collection_plate_2.wells()[adj_well:num_samp+adj_well]:
+            well.load_liquid(liquid=sample_color, volume=sample_vol)
+
+    # plates of the run, the helper functions below work on the active one (see _use_plate)
+    plates = [{'name': 'Plate 1', 'labware': collection_plate, 'wells': collection_wells, 'parking': parking_spots,
+               'elution_plate': elution_plate, 'elution': elution_wells, 'location': 'hs', 'tips': 0, 'waste': 0}]
+    if two_plates:
+        plates.append({'name': 'Plate 2', 'labware': collection_plate_2, 'wells': collection_plate_2.rows()[0][starting_col:adj_col],
+                       'parking': parkingrack_2.rows()[0][starting_col:adj_col], 'elution_plate': elution_plate_2,
+                       'elution': elution_plate_2.rows()[0][:num_cols], 'location': 'staging', 'tips': 0, 'waste': 0})
+    active_plate = plates[0]
     
     # helper functions
-    #Made a tip_log dictionary where 'count' is the key
-    tip_log = {'count': {}}
-    #Not sure what ctx.is_simulating means...
-    if not ctx.is_simulating():
-            #Add a value to tip_log where the key is 'count' and val is m300 pipette loaded object, including the tiprack it uses. 
-            #Then m300 is a nested key-value pair, where m300 : 0
-            tip_log['count'][m300] = 0
+    # fresh tips come from the 300µl racks, with parking_rack_tips also from the columns of the parking racks that no
+    # plate parks in. Used tips are parked back in the racks, so these must be fresh racks and not the last run's
+    if parking_rack_tips:
+        tip_tracker = TipTracker(tips300 + [plate['parking'][0].parent for plate in plates])
+        for plate in plates:
+            tip_tracker.reserve(plate['parking'], channels=8)
+        parking_slots = ' and '.join(str(plate['parking'][0].parent.parent) for plate in plates)
+        ctx.comment(f'Load a fresh, full 300µl tiprack for parking in slot {parking_slots}, its spare columns are used as fresh tips')
     else:
-        tip_log['count'] = {m300: 0}
-
-    
-
-    #For each tip rack, and for each row in the racks, give total count of columns
-    tip_log['tips'] = {
-        m300: [tip for rack in tips300 for tip in rack.rows()[0]]}
-    
-    #After printing these, found that tip_log['tips'] stores the first wells for each column of the various tipracks, ex. 
-    ctx.comment("tip_log[tips]")
-    ctx.comment(str(tip_log['tips']))
-    
-    #Get the maximum amt of tips in m300
-    tip_log['max'] = {m300: len(tip_log['tips'][m300])}
+        tip_tracker = TipTracker(tips300)
+    tiprack_slots = ', '.join(str(rack.parent) for rack in tips300)
+    ctx.comment(f'{tip_tracker.remaining(8)} columns of fresh 300µl tips')
 
-    ctx.comment("tip_log[max]")
-    ctx.comment(str(tip_log['max']))
-    ctx.comment("tip_log[count]")
-    ctx.comment(str(tip_log['count']))
 
+    def _use_plate(plate):
+        # point the helper functions at the wells, parked tips and elution wells of this plate
+        nonlocal active_plate, collection_wells, parking_spots, elution_wells
+        active_plate = plate
+        collection_wells = plate['wells']
+        parking_spots = plate['parking']
+        elution_wells = plate['elution']
 
     def _pick_up(pip, loc=None):
-        #Allows you to assign tip_log to an outside of loop scope, but not glocal
-        nonlocal tip_log
-
         #If all the tips have been used, then tell user to add another tiprack before resuming.
-        if tip_log['count'][pip] == tip_log['max'][pip] and not loc:
-            ctx.pause('\n\n~~~~Replace ' + str(pip.max_volume) + 'µl tipracks before resuming~~~~\n')
+        if tip_tracker.remaining(pip.channels) == 0 and not loc:
+            ctx.pause('\n\n~~~~Replace ' + str(pip.max_volume) + 'µl tipracks (slot ' + tiprack_slots + ') before resuming~~~~\n')
+            tip_tracker.refill()
             pip.reset_tipracks()
-            tip_log['count'][pip] = 0
         #Allows pipette to go to a specific location
         if loc:
             pip.pick_up_tip(loc)
         else:
-            pip.pick_up_tip(tip_log['tips'][pip][tip_log['count'][pip]])
-            ctx.comment("Picking up tips from:")
-            ctx.comment(str(tip_log['tips'][pip][tip_log['count'][pip]]))
-            tip_log['count'][pip] += 1
-            ctx.comment("Current count value:")
-            ctx.comment(str(tip_log['count']))
+            active_plate['tips'] += pip.channels
+            tip_tracker.pickUp(pip)
 
    
     drop_count = 0
@@ -311,8 +623,88 @@ def run(ctx: protocol_api.ProtocolContext):
                 thread.join()
             drop_count = 0
 
-    waste_vol = 0
-    waste_threshold = 250000
+    # liquid waste targets, filled in this order: the slot 8 reservoir, then the unused reservoir columns and deep-well
+    # columns chosen in the runtime parameters. Each keeps a ledger of the volume put in it (all 8 channels), and
+    # the operator is only asked to empty the waste once none of them has room left
+    waste_fill = 0.9  # fraction of a waste well filled before moving on to the next target
+    waste_targets = [{'name': 'slot 8 reservoir', 'location': waste_reservoir.wells()[0].top(),
+                      'capacity': waste_fill * waste_reservoir.wells()[0].max_volume, 'volume': 0}]
+    if overflow_waste in ('reservoir', 'reservoir_plate'):
+        # the 8 channels go in the same reservoir well
+        waste_targets += [{'name': 'reservoir column ' + str(col + 1), 'location': reservoir.rows()[0][col].top(),
+                           'capacity': waste_fill * reservoir.rows()[0][col].max_volume, 'volume': 0} for col in range(8, 12)]
+    if overflow_waste == 'reservoir_plate':
+        # one deep well per channel
+        waste_targets += [{'name': 'deep-well column ' + str(col + 1), 'location': dw_plate.rows()[0][col].top(),
+                           'capacity': waste_fill * 8 * dw_plate.rows()[0][col].max_volume, 'volume': 0} for col in range(2, 12)]
+    waste_current = 0
+
+    # manual pauses of the run so far, and the tip refills and trash/waste emptying the pause planner moved to each of
+    # them ({pause number: chores}, set once the run's steps are known)
+    pause_count = 0
+    pause_plan = {}
+    chore_prompts = {'tips': 'replace the ' + str(m300.max_volume) + 'µl tipracks (slot ' + tiprack_slots + ')', 'trash': 'empty tips from waste',
+                     'waste': 'empty liquid waste'}
+    if len(waste_targets) > 1:
+        chore_prompts['waste'] += ' (' + ', '.join(target['name'] for target in waste_targets) + ')'
+
+    def _operator_pause(msg):
+        # a manual pause (plate move, HEPA module), the operator also does the chores planned for it
+        nonlocal pause_count, drop_count
+        pause_count += 1
+        chores = pause_plan.get(pause_count, [])
+        if chores:
+            msg += '~~~~Also ' + ', '.join(chore_prompts[chore] for chore in chores) + ' before resuming~~~~\n'
+        ctx.pause(msg)
+        if 'tips' in chores:
+            tip_tracker.refill()
+            m300.reset_tipracks()
+        if 'trash' in chores:
+            drop_count = 0
+        if 'waste' in chores:
+            for target in waste_targets:
+                target['volume'] = 0
+
+    def _waste_room(volumes, vol):
+        # index of the first waste target with room for vol, None if they are all full
+        return next((i for i, target in enumerate(waste_targets) if volumes[i] + vol <= target['capacity']), None)
+
+    supernatant_air_gap = 20
+
+    def _liquid_height(well, vol):
+        # height in mm of vol µL in the well, taken as a straight column of the well's cross-section
+        if well.diameter:
+            area = math.pi * (well.diameter / 2) ** 2
+        else:
+            area = well.length * well.width
+        return vol / area
+
+    def _trip_plan(vol, well):
+        # (volume, aspiration height) of each remove_supernatant trip from one well. A trip holds the tip volume
+        # minus the air gap that seals it on the way to the waste, the air gap left in the tip by the previous trip
+        # is voided at the top of the well first so it takes no room. The fewest trips that fit are balanced, and
+        # each trip aspirates 2 mm under where the liquid will be once it's done, down to bottom(z=4) over the pellet
+        capacity = m300.max_volume - supernatant_air_gap
+        num_trans = math.ceil(vol/capacity)
+        vol_per_trans = vol/num_trans
+        return [(vol_per_trans, max(4, _liquid_height(well, vol - vol_per_trans*n) - 2)) for n in range(1, num_trans + 1)]
+
+    def _waste_trips(vol):
+        # waste volumes (all 8 channels) remove_supernatant(vol) puts out for one plate, one per trip
+        return [trip_vol*8 for trip_vol, _ in _trip_plan(vol, collection_wells[0])] * num_cols
+
+    def _waste_fill(volumes, trips):
+        # waste ledgers after the trips, and how many times the waste had to be emptied on the way
+        volumes = list(volumes)
+        pauses = 0
+        for vol in trips:
+            target = _waste_room(volumes, vol)
+            if target is None:
+                pauses += 1
+                volumes = [0] * len(waste_targets)
+                target = 0
+            volumes[target] += vol
+        return volumes, pauses
 
     def remove_supernatant(vol, park):
         """
@@ -324,16 +716,21 @@ def run(ctx: protocol_api.ProtocolContext):
                                in the 'parking rack' or to pick up new tips.
         """
         def _waste_track(vol):
-            nonlocal waste_vol
+            # returns where the trip's waste goes
+            nonlocal waste_current
 
-            if waste_vol + vol >= waste_threshold:
+            target = _waste_room([target['volume'] for target in waste_targets], vol)
+            if target is None:
                 # Setup for flashing lights notification to empty liquid waste
                 if flash:
                     if not ctx._hw_manager.hardware.is_simulator:
                         cancellationToken.set_true()
                     thread = create_thread(ctx, cancellationToken)
                 m300.home()
-                ctx.pause('\n\n~~~~Please empty liquid waste before resuming.~~~~\n')
+                if len(waste_targets) == 1:
+                    ctx.pause('\n\n~~~~Please empty liquid waste before resuming.~~~~\n')
+                else:
+                    ctx.pause('\n\n~~~~Please empty liquid waste (' + ', '.join(target['name'] for target in waste_targets) + ') before resuming.~~~~\n')
 
                 ctx.home()  # home before continuing with protocol
                 if flash:
@@ -341,30 +738,35 @@ def run(ctx: protocol_api.ProtocolContext):
                     cancellationToken.set_false()
                     thread.join()
 
-                waste_vol = 0
-            waste_vol += vol
+                for target in waste_targets:
+                    target['volume'] = 0
+                target = 0
+            if target != waste_current:
+                ctx.comment('Liquid waste now goes to the ' + waste_targets[target]['name'])
+                waste_current = target
+            waste_targets[target]['volume'] += vol
+            active_plate['waste'] += vol
+            return waste_targets[target]['location']
 
         m300.flow_rate.aspirate = 30
-        num_trans = math.ceil(vol/m300.max_volume)
-        vol_per_trans = vol/num_trans
         for i, (m, spot) in enumerate(zip(collection_wells, parking_spots)):
             if park:
                 _pick_up(m300, spot)
             else:
                 _pick_up(m300)
             side = -1 if i % 2 == 0 else 1
-            loc = m.bottom(z=4).move(Point(x=side*1.3))
-            for _ in range(num_trans):
-                _waste_track(vol_per_trans*8)
+            for vol_per_trans, height in _trip_plan(vol, m):
+                loc = m.bottom(z=height).move(Point(x=side*1.3))
+                waste = _waste_track(vol_per_trans*8)
                 if m300.current_volume > 0:
                     # void air gap if necessary
                     m300.dispense(m300.current_volume, m.top())
                     m300.blow_out()
                 m300.move_to(m.center())
                 m300.transfer(vol_per_trans, loc, waste, new_tip='never',
-                              air_gap=20)
+                              air_gap=supernatant_air_gap)
                 m300.blow_out(waste)
-                m300.air_gap(20)
+                m300.air_gap(supernatant_air_gap)
             if park:
                 m300.drop_tip(spot)
             else:
@@ -432,9 +834,6 @@ def run(ctx: protocol_api.ProtocolContext):
                 _pick_up(m300)
 
             first_col = False #Now set it to false
-
-            ctx.comment("Current count value for mix_bind():")
-            ctx.comment(str(tip_log['count']))
             for _ in range(mix_reps):
                 m300.aspirate(vol, binding_buffer.bottom(1))
                 m300.dispense(vol, binding_buffer.bottom(5))
@@ -474,9 +873,6 @@ def run(ctx: protocol_api.ProtocolContext):
 
         for i, m in enumerate(collection_wells):
             #Pick up col of multichannel tips
-            
-            ctx.comment("Current count value for wash():")
-            ctx.comment(str(tip_log['count']))
             #Go to well that contains the liquid, calculate which well depending on liquid???
             src = source[i//(12//len(source))]
             for n in range(num_trans):
@@ -522,8 +918,273 @@ def run(ctx: protocol_api.ProtocolContext):
         m300.flow_rate.aspirate = 94 #Change back to default
 
 
+    def _usage(step, vol=None):
+        # (tip columns picked up, tips dropped in the trash, liquid waste trips) of one helper call on one plate
+        if step == 'remove':
+            # the tips are parked, not thrown away
+            return 0, 0, _waste_trips(vol)
+        if step == 'elute':
+            return num_cols, 8 * num_cols, []
+        # mix_bind, wash and custom_transfer use one column of tips
+        return 1, 8, []
+
+    def _plan_pauses(plan):
+        """
+        `_plan_pauses` walks the tip, trash and liquid waste use of the run up
+        front and moves every tip refill and trash/waste emptying to the last
+        manual pause before that resource would run out, so the operator does
+        it along with the plate move instead of the run stopping mid-step.
+        :param plan (list): The `_usage` of every helper call in run order,
+                            with 'pause' for each `_operator_pause`.
+        Returns {pause number: chores}, the pauses counted from 1.
+        """
+        segments = [[]]
+        for step in plan:
+            if step == 'pause':
+                segments.append([])
+            else:
+                segments[-1].append(step)
+
+        chores = {}
+        unplanned = 0
+        tips_left = tip_tracker.remaining(8)
+        trash_left = drop_threshold - drop_count
+        waste_volumes = [target['volume'] for target in waste_targets]
+        for pause, segment in enumerate(segments):
+            tips = sum(step[0] for step in segment)
+            trash = sum(step[1] for step in segment)
+            trips = [trip for step in segment for trip in step[2]]
+            # the steps up to the next manual pause would run out: do it at this one
+            if pause > 0:
+                if tips > tips_left:
+                    chores.setdefault(pause, []).append('tips')
+                    tips_left = tip_tracker.refillable(8)
+                if trash >= trash_left:
+                    chores.setdefault(pause, []).append('trash')
+                    trash_left = drop_threshold
+                if _waste_fill(waste_volumes, trips)[1]:
+                    chores.setdefault(pause, []).append('waste')
+                    waste_volumes = [0] * len(waste_targets)
+            # what still runs out mid-step (a single step using more than a full refill) pauses there as before
+            for step in segment:
+                for _ in range(step[0]):
+                    if tips_left == 0:
+                        unplanned += 1
+                        tips_left = tip_tracker.refillable(8)
+                    tips_left -= 1
+                for _ in range(step[1] // 8):
+                    trash_left -= 8
+                    if trash_left <= 0:
+                        unplanned += 1
+                        trash_left = drop_threshold
+            waste_volumes, waste_pauses = _waste_fill(waste_volumes, trips)
+            unplanned += waste_pauses
+
+        ctx.comment(f"Pause plan: {len(segments) - 1} manual pause(s), {len(chores)} of them also used to refill tips "
+                    f"or empty waste, {unplanned} pause(s) left mid-step")
+        for pause, pause_chores in chores.items():
+            ctx.comment(f'Pause {pause}: ' + ', '.join(chore_prompts[chore] for chore in pause_chores))
+        return chores
+
     ##### requested partial tip pick up if the sample number is not divisible by 8. 
 
+    # forecast the liquid waste of the run and how often the operator will have to empty it
+    removals = [650, 200, 300] + ([300] if not dry_run else [])
+    waste_pauses = _waste_fill([0] * len(waste_targets), [trip for plate in plates for removal in removals for trip in _waste_trips(removal)])[1]
+    ctx.comment(f"Liquid waste: {sum(sum(_waste_trips(removal)) for removal in removals) * len(plates) / 1000:.1f} mL expected, "
+                f"{sum(target['capacity'] for target in waste_targets) / 1000:.1f} mL of room in {len(waste_targets)} waste target(s), "
+                f"{waste_pauses} pause(s) to empty them")
+    for removal in removals:
+        trips = _trip_plan(removal, collection_wells[0])
+        ctx.comment(f"Remove {removal} µL in {len(trips)} trip(s) of {trips[0][0]:.1f} µL, aspirating at "
+                    + ", ".join(f"{height:.1f}" for _, height in trips) + " mm")
+
+    #### Two-plate batch mode ####
+    # The plates take turns on the heater-shaker and the magnetic module, plate 2 one stage behind plate 1: while one
+    # plate gets its buffer and shakes (or dries), the other settles on the magnet and has its supernatant removed.
+    # Every round ends with one pause to swap the plates, and the settling and shaking times run while the pipette works.
+    if two_plates:
+        settle_seconds = (settling_time if not dry_run else 0.1) * 60
+        # wash buffer left in the reservoir, 12 mL per column when full
+        buffer_left = {'Endo Wash Buffer': 12000 * len(endo_wash), 'Zyppy Wash Buffer': 12000 * len(zyppy_wash)}
+        hepa_on = False
+
+        # robot time predicted from the commands, the same in the analysis and on the robot
+        run_clock = RunClock(ctx)
+
+        def _wait_for(start, seconds, msg=None):
+            # only wait for the part of the incubation the pipetting didn't already cover
+            remaining = math.ceil(seconds - (run_clock.seconds - start))
+            if remaining > 0:
+                ctx.delay(seconds=remaining, msg=msg)
+
+        def _dry_start():
+            nonlocal hepa_on
+            if not hepa_on:
+                _operator_pause('\n\n~~~~~~~~~~~~Manually Turn On the HEPA Module~~~~~~~~~~~~~~~~~~~\n')
+                hepa_on = True
+            hs_mod.set_and_wait_for_temperature(75)
+
+        def _dry_end():
+            nonlocal hepa_on
+            hs_mod.deactivate_heater()
+            if active_plate is plates[-1]:
+                _operator_pause('\n\n~~~~~~~~~~~~Manually Turn Off the HEPA Module~~~~~~~~~~~~~~~~~~\n')
+                hepa_on = False
+            ctx.comment('\n\n~~~~~~~~~~Transfer Elution Buffer to Collection Plate~~~~~~~~\n')
+            custom_transfer(40, elution_buffer)
+            hs_mod.set_and_wait_for_shake_speed(1000)
+            ctx.delay(minutes=3)
+            hs_mod.deactivate_shaker()
+
+        # heater-shaker stages: (name, wash buffer used or None, pipetting before the shake, rpm, shake seconds, steps after it)
+        hs_stages = [
+            ('Mix & Transfer Binding Bead Buffer', None, lambda: mix_bind(30, mix_reps=5), 1000, 5 * 60, None),
+            ('Transfer Endo Wash Buffer', 'Endo Wash Buffer', lambda: wash(200, endo_wash, mix_reps=0, resuspend=False), 1100, 90, None),
+            ('1st Wash with Zyppy Wash Buffer', 'Zyppy Wash Buffer', lambda: wash(300, zyppy_wash, mix_reps=0, resuspend=False), 1200, 90, None),
+            ('2nd Wash with Zyppy Wash Buffer', 'Zyppy Wash Buffer', lambda: wash(300, zyppy_wash, mix_reps=0, resuspend=False), 1200, 90, None),
+            ('Shake 10 Minutes @ 1800 RPM 75C', None, _dry_start, 1800, (10 if not dry_run else 0.1) * 60, _dry_end),
+        ]
+        wash_volumes = {1: 200, 2: 300, 3: 300}
+        # magnet stages: (name, pipetting after the beads settled)
+        mag_stages = [
+            ('Remove Supernatant', lambda: remove_supernatant(650, park=True)),
+            ('Remove Supernatant', lambda: remove_supernatant(200, park=True)),
+            ('Remove Supernatant', lambda: remove_supernatant(300, park=True)),
+            ('Remove Supernatant', lambda: remove_supernatant(300, park=True)),
+            ('Transfer Eluate to Elution Plate', lambda: elute(30)),
+        ]
+        if dry_run:
+            # skips the 2nd Zyppy wash like the single plate run
+            del hs_stages[3], mag_stages[3]
+        stages = [stage for pair in zip(hs_stages, mag_stages) for stage in pair]
+
+        # stage of each plate in each round, plate i runs stage (round - i)
+        num_rounds = len(stages) + len(plates) - 1
+        schedule = [[(plate, r - i) for i, plate in enumerate(plates) if 0 <= r - i < len(stages)] for r in range(num_rounds)]
+
+        ctx.comment('\n\n~~~~~~~~~~~~Two-Plate Batch Schedule~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+        for r, jobs in enumerate(schedule):
+            ctx.comment(f'Round {r + 1}: ' + ' | '.join(
+                f"{plate['name']} on {'Heater-Shaker' if stage % 2 == 0 else 'Magnet'}: {stages[stage][0]}" for plate, stage in jobs))
+
+        # the same rounds as resource use for the pause planner: every round after the first starts with the plate swap,
+        # the dry turns the HEPA module on for the first plate and off after the last one
+        plan = []
+        for r, jobs in enumerate(schedule):
+            hs_stage = next((stage // 2 for plate, stage in jobs if stage % 2 == 0), None)
+            mag_stage = next((stage // 2 for plate, stage in jobs if stage % 2 == 1), None)
+            hs_plate = next((plate for plate, stage in jobs if stage % 2 == 0), None)
+            if r > 0:
+                plan.append('pause')
+            if hs_stage == len(hs_stages) - 1:
+                plan += ['pause'] if hs_plate is plates[0] else []
+            elif hs_stage is not None:
+                plan.append(_usage('bind' if hs_stage == 0 else 'wash'))
+            if mag_stage == len(mag_stages) - 1:
+                plan.append(_usage('elute'))
+            elif mag_stage is not None:
+                plan.append(_usage('remove', removals[mag_stage]))
+            if hs_stage == len(hs_stages) - 1:
+                plan += (['pause'] if hs_plate is plates[-1] else []) + [_usage('elution buffer')]
+        pause_plan = _plan_pauses(plan)
+
+        round_minutes = []
+        for r, jobs in enumerate(schedule):
+            hs_job = next(((plate, stages[stage]) for plate, stage in jobs if stage % 2 == 0), None)
+            mag_job = next(((plate, stages[stage]) for plate, stage in jobs if stage % 2 == 1), None)
+
+            # where each plate goes for this round, a plate without a stage left leaves the modules
+            targets = {plate['name']: 'hs' if stage % 2 == 0 else 'mag' for plate, stage in jobs}
+            for plate in plates:
+                if plate['name'] not in targets:
+                    targets[plate['name']] = 'done' if plate['location'] in ('hs', 'mag') else plate['location']
+            movers = [plate for plate in plates if targets[plate['name']] != plate['location']]
+            destinations = {'hs': ' to the Heater-Shaker', 'mag': ' to the Magnetic Module', 'done': ' off the deck'}
+            moves = [plate['name'] + destinations[targets[plate['name']]] for plate in movers]
+            new_elution_plate = None
+            if mag_job and mag_job[1] is mag_stages[-1] and mag_job[0]['elution_plate'] is not elution_plate:
+                new_elution_plate = mag_job[0]['elution_plate']
+                moves.append('the used Elution Plate off the deck and ' + mag_job[0]['name'] + "'s Elution Plate into slot 4")
+            if hs_job and hs_job[1][1] is not None:
+                need = wash_volumes[hs_stages.index(hs_job[1])] * 8 * num_cols
+                if buffer_left[hs_job[1][1]] < need:
+                    moves.append('refill the ' + hs_job[1][1] + ' columns of the reservoir to 12 mL')
+                    buffer_left[hs_job[1][1]] = 12000 * (len(endo_wash) if hs_job[1][1] == 'Endo Wash Buffer' else len(zyppy_wash))
+                buffer_left[hs_job[1][1]] -= need
+            if moves:
+                mag_mod.disengage()
+                hs_mod.open_labware_latch()
+                _operator_pause('\n\n~~~~~~~Manually move ' + ', '.join(moves) + '~~~~~~~\n')
+                # clear the magnet first, then heater-shaker to magnet, then onto the heater-shaker
+                for plate in movers:
+                    if plate['location'] == 'mag':
+                        ctx.move_labware(labware=plate['labware'], new_location=protocol_api.OFF_DECK, use_gripper=False)
+                        plate['location'] = 'done' if targets[plate['name']] == 'done' else 'off'
+                for plate in movers:
+                    if plate['location'] == 'hs':
+                        ctx.move_labware(labware=plate['labware'], new_location=mag_mod if targets[plate['name']] == 'mag' else protocol_api.OFF_DECK, use_gripper=False)
+                        plate['location'] = targets[plate['name']]
+                for plate in movers:
+                    if targets[plate['name']] == 'hs':
+                        ctx.move_labware(labware=plate['labware'], new_location=hs_mod, use_gripper=False)
+                        plate['location'] = 'hs'
+                if new_elution_plate is not None:
+                    ctx.move_labware(labware=elution_plate, new_location=protocol_api.OFF_DECK, use_gripper=False)
+                    ctx.move_labware(labware=new_elution_plate, new_location=4, use_gripper=False)
+            hs_mod.close_labware_latch()
+            round_start = run_clock.seconds
+
+            # the beads start settling right away, the heater-shaker plate gets its buffer meanwhile
+            if mag_job:
+                mag_mod.engage(height_from_base=3.9)
+                settle_start = run_clock.seconds
+            if hs_job:
+                plate, (name, buffer, before, rpm, seconds, after) = hs_job
+                _use_plate(plate)
+                ctx.comment(f"\n\n~~~~~~{plate['name']}: {name}~~~~~~\n")
+                before()
+                hs_mod.set_and_wait_for_shake_speed(rpm)
+                shake_start = run_clock.seconds
+            if mag_job:
+                plate, (name, work) = mag_job
+                _use_plate(plate)
+                _wait_for(settle_start, settle_seconds, msg='\n\n~~~~~Incubating on mag_mod for ' + str(settling_time) + ' minutes~~~~~~\n')
+                ctx.comment(f"\n\n~~~~~~{plate['name']}: {name}~~~~~~\n")
+                work()
+            if hs_job:
+                plate, (name, buffer, before, rpm, seconds, after) = hs_job
+                _use_plate(plate)
+                _wait_for(shake_start, seconds)
+                hs_mod.deactivate_shaker()
+                if after:
+                    after()
+            round_minutes.append((run_clock.seconds - round_start) / 60)
+
+        mag_mod.disengage()
+        hs_mod.open_labware_latch()
+        run_clock.close()
+
+        # timeline and tip/waste accounting of the batch, the round times are predicted robot time without the pauses
+        ctx.comment('\n\n~~~~~~~~~~~~Two-Plate Batch Summary~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+        for r, minutes in enumerate(round_minutes):
+            ctx.comment(f'Round {r + 1}: {minutes:.1f} min of predicted robot time')
+        for plate in plates:
+            ctx.comment(f"{plate['name']}: {plate['tips']} new tips, {num_cols * 8} parked tips, "
+                        f"{plate['waste'] / 1000:.1f} mL liquid waste")
+
+        ctx.comment('\n\n~~~~~~~~~~~~~~~~~~~Protocol Complete~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+
+        #Stop the event trace
+        event_trace.close()
+        return
+
+    # resource use of the steps below, 'pause' for each manual pause
+    pause_plan = _plan_pauses([_usage('bind'), 'pause', _usage('remove', 650), 'pause', _usage('wash'), 'pause',
+                               _usage('remove', 200), 'pause', _usage('wash'), 'pause', _usage('remove', 300), 'pause']
+                              + ([_usage('wash'), 'pause', _usage('remove', 300), 'pause'] if not dry_run else [])
+                              + ['pause', 'pause', _usage('elution buffer'), 'pause', _usage('elute')])
+
     #### Protocol Steps Begin Here ####
 
     # 1: Mix the binding buffer at the default rate for 5 times in the first column of NEST 96 Deep Well Plate (slot 7).
@@ -551,7 +1212,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # 4: Move Zymo collection plate from the heater shaker onto the magnetic module and engage magnetics to the height of 3.9mm. Pause for 1 minute.
     hs_mod.open_labware_latch()
-    ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
     ctx.move_labware(labware=collection_plate, new_location=mag_mod, use_gripper=False)
     mag_mod.engage(height_from_base=3.9)
     ctx.delay(minutes=settling_time if not dry_run else 0.1, msg='\n\n~~~~~Incubating on mag_mod for ' + str(settling_time) + ' minutes~~~~~~\n')
@@ -563,7 +1224,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # 6: Disengage the magnet and move Zymo collection plate from the magnetic module onto the heater shaker.
     mag_mod.disengage()
-    ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
     ctx.move_labware(labware=collection_plate, new_location=hs_mod, use_gripper=False)
     hs_mod.close_labware_latch()
 
@@ -579,7 +1240,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # 9: Move Zymo collection plate from the heater shaker onto the magnetic module and engage magnetics to the height of 3.9mm. Pause for 1 minute.
     hs_mod.open_labware_latch()
-    ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
     ctx.move_labware(labware=collection_plate, new_location=mag_mod, use_gripper=False)
     mag_mod.engage(height_from_base=3.9)
     ctx.delay(minutes=settling_time if not dry_run else 0.1, msg='\n\n~~~~~Incubating on mag_mod for ' + str(settling_time) + ' minutes~~~~~~~\n')
@@ -591,7 +1252,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # 11: Disengage the magnet and move Zymo collection plate from the magnetic module onto the heater shaker.
     mag_mod.disengage()
-    ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
     ctx.move_labware(labware=collection_plate, new_location=hs_mod, use_gripper=False)
     hs_mod.close_labware_latch()
 
@@ -606,9 +1267,12 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # 14: Move Zymo collection plate from the heater shaker onto the magnetic module and engage magnetics to the height of 3.9mm. Pause for 1 minute.
     hs_mod.open_labware_latch()
-    ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
     
     ctx.move_labware(labware=collection_plate, new_location=mag_mod, use_gripper=False)
+    # a dry run skips the 2nd wash, so the heater-shaker is empty from now until the dry: pre-heat it in the background
+    if dry_run:
+        hs_mod.set_target_temperature(75)
     mag_mod.engage(height_from_base=3.9)
     ctx.delay(minutes=settling_time if not dry_run else 0.1, msg='\n\n~~~~~Incubating on mag_mod for ' + str(settling_time) + ' minutes~~~~~~~\n')
 
@@ -617,7 +1281,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # 16: Disengage the magnet and move Zymo collection plate from the magnetic module onto the heater shaker.
     mag_mod.disengage()
-    ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
     ctx.move_labware(labware=collection_plate, new_location=hs_mod, use_gripper=False)
     hs_mod.close_labware_latch()
 
@@ -636,8 +1300,11 @@ def run(ctx: protocol_api.ProtocolContext):
     # Move Zymo collection plate from the heater shaker onto the magnetic module and engage magnetics to the height of 3.9mm. Pause for 1 minute.
     if not dry_run:   
         hs_mod.open_labware_latch()
-        ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
+        _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
         ctx.move_labware(labware=collection_plate, new_location=mag_mod, use_gripper=False)
+        # the heater-shaker is empty from now until the dry: pre-heat it in the background while the beads settle
+        # and the supernatant is removed, so it is already at 75C when the plate comes back
+        hs_mod.set_target_temperature(75)
         mag_mod.engage(height_from_base=3.9)
         ctx.delay(minutes=settling_time if not dry_run else 0.1, msg='\n\n~~~~Incubating on mag_mod for ' + str(settling_time) + ' minutes~~~~\n')
 
@@ -649,24 +1316,25 @@ def run(ctx: protocol_api.ProtocolContext):
     # Disengage the magnet and move Zymo collection plate from the magnetic module onto the heater shaker.
     if not dry_run:   
         mag_mod.disengage()
-        ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
+        _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Heater-Shaker~~~~~~~~~\n')
         ctx.move_labware(labware=collection_plate, new_location=hs_mod, use_gripper=False)
         hs_mod.close_labware_latch()
 
     # 18: Manually turn on the HEPA module.
-    ctx.pause('\n\n~~~~~~~~~~~~Manually Turn On the HEPA Module~~~~~~~~~~~~~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~~~~~~Manually Turn On the HEPA Module~~~~~~~~~~~~~~~~~~~\n')
 
     #If this doesn't work, Moni can further modify it
     # 18: Vortex Zymo collection plate (on heater shaker) at 1800 rpm at 65C for 6 minutes.
     ctx.comment('\n\n~~~~~~~~~~Shake 6 Minutes @ 1800 RPM 65C~~~~~~~~~~~~~~~~~~~~~\n')
-    hs_mod.set_and_wait_for_temperature(75)
+    # pre-heated since the last move to the magnet, this only waits for what is left of the ramp
+    hs_mod.wait_for_temperature()
     hs_mod.set_and_wait_for_shake_speed(1800)
     ctx.delay(minutes=10 if not dry_run else 0.1)
     hs_mod.deactivate_shaker()
     hs_mod.deactivate_heater()
 
     # 19: Manually turn off the HEPA module and deactivate the heater shaker.
-    ctx.pause('\n\n~~~~~~~~~~~~Manually Turn Off the HEPA Module~~~~~~~~~~~~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~~~~~~Manually Turn Off the HEPA Module~~~~~~~~~~~~~~~~~~\n')
 
     # 20: Distribute 40uL Elution buffer (slot 7, column 2) to each well of Zymo collection plate.
     ctx.comment('\n\n~~~~~~~~~~Transfer Elution Buffer to Collection Plate~~~~~~~~\n')
@@ -691,7 +1359,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # 22: Move Zymo collection plate from the heater shaker onto the magnetic module and engage magnetics to the height of 3.9mm. Pause for 1 minute.
     hs_mod.open_labware_latch()
-    ctx.pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
+    _operator_pause('\n\n~~~~~~~Manually Move Collection Plate to Magnetic Module~~~~~~~\n')
     ctx.move_labware(labware=collection_plate, new_location=mag_mod, use_gripper=False)
     mag_mod.engage(height_from_base=3.9)
     ctx.delay(minutes=settling_time if not dry_run else 0.1, msg='\n\n~~~~Incubating on mag_mod for ' + str(settling_time) + ' minutes~~~~\n')
@@ -701,3 +1369,6 @@ def run(ctx: protocol_api.ProtocolContext):
     elute(30)
     
     ctx.comment('\n\n~~~~~~~~~~~~~~~~~~~Protocol Complete~~~~~~~~~~~~~~~~~~~~~~~~~\n')
+
+    #Stop the event trace
+    event_trace.close()
@@ -1,8 +1,13 @@
 from opentrons import protocol_api
 
 import csv
+import hashlib
 import json
 import math
+import os
+import tempfile
+import time
+import heapq
 
 #-------(Modify) Change name and description to suit your needs (1)
 metadata = {
@@ -13,12 +18,808 @@ metadata = {
     }
 #-------End of modifications (1)
 
-#Function that gets labware object to use given the string name of variable
+#Function that gets labware object to use given the string name of variable, or None if there is no such labware
 def getLabwareObject(labware_dict, labware_name):
-    for key, value in labware_dict.items():
-        if str(key) == str(labware_name):
-            return value
-    return
+    return labware_dict.get(str(labware_name))
+
+#Dictionary of the loaded labware keyed by the names used in the CSV, that also remembers the wells of each labware.
+#The Opentrons API rebuilds its well lists every time labware[well_name], rows() or columns() is called,
+#so loops that visit many wells should look them up here instead.
+class LabwareRegistry(dict):
+    __slots__ = ("_wells", "_rows", "_columns")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wells = {}
+        self._rows = {}
+        self._columns = {}
+
+    def __setitem__(self, labware_name, labware):
+        super().__setitem__(labware_name, labware)
+        #Forget the wells of any labware that was previously loaded under this name
+        self._wells.pop(labware_name, None)
+        self._rows.pop(labware_name, None)
+        self._columns.pop(labware_name, None)
+
+    #Well name -> Well object for the given labware, ex. {"A1": Well, ...}
+    def wells_by_name(self, labware_name):
+        wells = self._wells.get(labware_name)
+        if wells is None:
+            wells = self._wells[labware_name] = self[labware_name].wells_by_name()
+        return wells
+
+    def well(self, labware_name, well_name):
+        return self.wells_by_name(labware_name)[well_name]
+
+    def rows(self, labware_name):
+        rows = self._rows.get(labware_name)
+        if rows is None:
+            rows = self._rows[labware_name] = self[labware_name].rows()
+        return rows
+
+    def columns(self, labware_name):
+        columns = self._columns.get(labware_name)
+        if columns is None:
+            columns = self._columns[labware_name] = self[labware_name].columns()
+        return columns
+
+#Compiled pipetting step, one per non-empty row of a "Pipetting Steps" table in the CSV.
+#Labware and well objects are resolved once, before any robot motion, so the transfer loop only issues pipette commands.
+class TransferStep:
+    __slots__ = ("row", "source_labware", "source_well", "source", "destination_labware", "destination_well",
+                 "destination", "volume", "new_tip", "pipette_choice")
+
+    def __init__(self, row, source_labware, source_well, source, destination_labware, destination_well,
+                 destination, volume, new_tip, pipette_choice=None):
+        self.row = row #Row number in the spreadsheet, for error messages
+        self.source_labware = source_labware
+        self.source_well = source_well
+        self.source = source #Resolved Well object
+        self.destination_labware = destination_labware
+        self.destination_well = destination_well
+        self.destination = destination #Resolved Well object
+        self.volume = volume
+        self.new_tip = new_tip #True if the "Pick_Up_Tip" cell is TRUE
+        self.pipette_choice = pipette_choice #"Left"/"Right", or None for tables without a Pipette_Choice column
+
+    def __repr__(self):
+        return (f'TransferStep(row {self.row}: {self.volume} uL {self.source_labware} {self.source_well} -> '
+                f'{self.destination_labware} {self.destination_well}, new_tip={self.new_tip})')
+
+#Function that gets the Well object for a labware/well name pair, stopping the protocol with the CSV row number if either is wrong
+def resolveWell(labware_dict, labware_name, well_name, row):
+    if getLabwareObject(labware_dict, labware_name) is None:
+        raise RuntimeError(f'CSV row {row}: unknown labware "{labware_name}"')
+    try:
+        return labware_dict.well(labware_name, well_name)
+    except KeyError:
+        raise RuntimeError(f'CSV row {row}: "{well_name}" is not a well of "{labware_name}"')
+
+#Function that compiles one "Pipetting Steps" table of the CSV into a list of TransferSteps.
+#first_col is the index of the Source_Labware column, the table continues with Source_Well, Destination_Labware,
+#Destination_Well, Transfer_Volume, Pick_Up_Tip and (if has_pipette_col) Pipette_Choice.
+def compileTransferPlan(protocol, csv_data_list, labware_dict, first_col, has_pipette_col=False):
+    num_cols = 7 if has_pipette_col else 6
+    plan = []
+
+    #Discard the first two rows of csv, since those are the titles of the tables and columns. Spreadsheet rows start at 1.
+    for row, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [str(cell).strip() for cell in csv_row[first_col:first_col + num_cols]]
+        #Check if the current row is empty, if it's empty then skip it
+        if len(cells) == 0 or cells[0] == "":
+            continue
+        if len(cells) < num_cols:
+            raise RuntimeError(f'CSV row {row}: expected {num_cols} pipetting columns, found {len(cells)}')
+
+        source_labware, source_well, destination_labware, destination_well, transfer_volume, pick_up_tip = cells[:6]
+        pipette_choice = cells[6] if has_pipette_col else None
+
+        if pick_up_tip not in ('TRUE', 'FALSE'):
+            protocol.comment('Please specify whether to use new or same tip')
+            continue
+        try:
+            volume = float(transfer_volume)
+        except ValueError:
+            raise RuntimeError(f'CSV row {row}: transfer volume "{transfer_volume}" is not a number')
+
+        plan.append(TransferStep(
+            row,
+            source_labware, source_well, resolveWell(labware_dict, source_labware, source_well, row),
+            destination_labware, destination_well, resolveWell(labware_dict, destination_labware, destination_well, row),
+            volume, pick_up_tip == 'TRUE', pipette_choice))
+
+    return plan
+
+#Seconds the robot needs to drop a tip in the trash and pick up the next one, used to estimate time saved
+TIP_CHANGE_SECONDS = 10
+
+#Function that counts the tips a plan picks up: the first step of each pipette, plus every step that asks for a new tip
+def countTips(plan):
+    pipettes_used = set()
+    tips = 0
+    for step in plan:
+        if step.new_tip == True or step.pipette_choice not in pipettes_used:
+            tips += 1
+            pipettes_used.add(step.pipette_choice)
+    return tips
+
+#Function that reorders a compiled plan so that rows taking liquid from the same source share one tip.
+#Returns (new_plan, tips_saved, seconds_saved), or the plan unchanged if reordering does not save tips.
+#- Rows chained by the user with Pick_Up_Tip = FALSE stay together, in their original order.
+#- A chain only moves ahead of another chain if they do not touch the same well, or both only dispense into it,
+#  so every well receives the same volumes and a well filled by the table is filled before it is used as a source.
+#- A tip is reused for another chain only if it only aspirated from that chain's source and only dispensed into
+#  wells holding nothing but that source's liquid, so no other liquid is carried back into the source.
+#initial_wells is the set of (labware, well) names that hold liquid before the run starts.
+def optimizeTipUse(plan, initial_wells):
+    #Split the plan into chains: a row that needs a tip, plus the FALSE rows after it for the same pipette
+    chains = []
+    follows = [] #Chain of the same pipette that a chain continues with the same tip, or None
+    last_chain_of_pip = {}
+    for step in plan:
+        if step.new_tip == False and chains and chains[-1][-1].pipette_choice == step.pipette_choice:
+            chains[-1].append(step)
+            continue
+        chains.append([step])
+        follows.append(last_chain_of_pip.get(step.pipette_choice) if step.new_tip == False else None)
+        last_chain_of_pip[step.pipette_choice] = len(chains) - 1
+    num_chains = len(chains)
+
+    #Dependencies between chains: reading a well waits for earlier dispenses into it, dispensing into a well waits
+    #for earlier aspirations from it. Dispenses into the same well can be swapped.
+    successors = [set() for _ in range(num_chains)]
+    indegree = [0] * num_chains
+    readers = {}
+    writers = {}
+    for c, chain in enumerate(chains):
+        deps = set()
+        if follows[c] is not None:
+            deps.add(follows[c])
+        for step in chain:
+            source_key = (step.source_labware, step.source_well)
+            destination_key = (step.destination_labware, step.destination_well)
+            deps.update(writers.get(source_key, ()))
+            deps.update(readers.get(destination_key, ()))
+            readers.setdefault(source_key, set()).add(c)
+            writers.setdefault(destination_key, set()).add(c)
+        deps.discard(c)
+        for d in deps:
+            successors[d].add(c)
+        indegree[c] = len(deps)
+
+    #Chains that are ready to run, by original position and by (pipette, first source)
+    ready = []
+    ready_by_source = {}
+    def _make_ready(c):
+        head = chains[c][0]
+        heapq.heappush(ready, c)
+        heapq.heappush(ready_by_source.setdefault((head.pipette_choice, head.source_labware, head.source_well), []), c)
+    for c in range(num_chains):
+        if indegree[c] == 0:
+            _make_ready(c)
+    continued_by = {f: c for c, f in enumerate(follows) if f is not None}
+
+    done = [False] * num_chains
+    contents = {} #(labware, well) -> set of sources dispensed into it so far
+    tip_state = {} #pipette -> [(labware, well) of the only source aspirated, or None if several; tip is still clean]
+    last_on_pip = {}
+    last = None
+    new_plan = []
+    while len(new_plan) < len(plan):
+        pick = None
+        if last is not None:
+            #Keep a user chain going on the same tip, if it is ready
+            nxt = continued_by.get(last)
+            if nxt is not None and indegree[nxt] == 0 and not done[nxt]:
+                pick = nxt
+            #Otherwise prefer a chain that can reuse the current tip
+            state = tip_state.get(chains[last][0].pipette_choice)
+            if pick is None and state is not None and state[0] is not None and state[1] == True:
+                heap = ready_by_source.get((chains[last][0].pipette_choice,) + state[0], [])
+                while heap and done[heap[0]]:
+                    heapq.heappop(heap)
+                if heap:
+                    pick = heap[0]
+        if pick is None:
+            while done[ready[0]]:
+                heapq.heappop(ready)
+            pick = ready[0]
+        done[pick] = True
+
+        head = chains[pick][0]
+        pip = head.pipette_choice
+        head_key = (head.source_labware, head.source_well)
+        state = tip_state.get(pip)
+        if follows[pick] is not None and last_on_pip.get(pip) == follows[pick]:
+            new_tip = False
+        else:
+            new_tip = not (state is not None and state[0] == head_key and state[1] == True)
+        if new_tip == True:
+            state = tip_state[pip] = [head_key, True]
+
+        for i, step in enumerate(chains[pick]):
+            source_key = (step.source_labware, step.source_well)
+            destination_key = (step.destination_labware, step.destination_well)
+            if state[0] != source_key:
+                state[0] = None
+            well_contents = contents.setdefault(destination_key, set())
+            if destination_key in initial_wells or len(well_contents - {source_key}) > 0:
+                state[1] = False
+            well_contents.add(source_key)
+            new_plan.append(TransferStep(
+                step.row, step.source_labware, step.source_well, step.source,
+                step.destination_labware, step.destination_well, step.destination,
+                step.volume, new_tip if i == 0 else False, step.pipette_choice))
+
+        last_on_pip[pip] = pick
+        last = pick
+        for s in successors[pick]:
+            indegree[s] -= 1
+            if indegree[s] == 0:
+                _make_ready(s)
+
+    tips_saved = countTips(plan) - countTips(new_plan)
+    if tips_saved <= 0:
+        return plan, 0, 0
+    return new_plan, tips_saved, tips_saved * TIP_CHANGE_SECONDS
+
+#Function that decides the Pick_Up_Tip of every step in place of the table, from what each tip has touched. A tip is kept
+#for the next step of its pipette only if that step aspirates from the same source and the tip has not been in any
+#other liquid: a dispense into a well touches its liquid unless it is at the top of the well (top_dispense), and a well
+#holding nothing but the source's liquid can't carry anything back into the source. initial_wells is the set of
+#(labware, well) names that hold liquid before the run starts. Returns (new_plan, tips_saved, seconds_saved) compared to
+#the Pick_Up_Tip column, tips_saved is below 0 when the table reused tips this rule would not.
+def planTipReuse(plan, initial_wells, top_dispense=False):
+    contents = {} #(labware, well) -> set of sources dispensed into it so far
+    tip_state = {} #pipette -> [(labware, well) of the source its tip aspirated from, tip touched no other liquid]
+    new_plan = []
+    for step in plan:
+        source_key = (step.source_labware, step.source_well)
+        destination_key = (step.destination_labware, step.destination_well)
+        state = tip_state.get(step.pipette_choice)
+        new_tip = not (state is not None and state[0] == source_key and state[1] == True)
+        if new_tip == True:
+            state = tip_state[step.pipette_choice] = [source_key, True]
+        well_contents = contents.setdefault(destination_key, set())
+        if top_dispense == False and (destination_key in initial_wells or len(well_contents - {source_key}) > 0):
+            state[1] = False
+        well_contents.add(source_key)
+        new_plan.append(TransferStep(
+            step.row, step.source_labware, step.source_well, step.source,
+            step.destination_labware, step.destination_well, step.destination,
+            step.volume, new_tip, step.pipette_choice))
+
+    tips_saved = countTips(plan) - countTips(new_plan)
+    return new_plan, tips_saved, tips_saved * TIP_CHANGE_SECONDS
+
+#Function that gets the gantry travel in mm of a list of steps: each step moves from the previous destination to its
+#source, then to its destination. Positions are the (x, y) deck coordinates of the loaded labware wells.
+def travelDistance(plan):
+    distance = 0
+    prev = None
+    for step in plan:
+        source = step.source.top().point
+        destination = step.destination.top().point
+        if prev is not None:
+            distance += math.hypot(source.x - prev.x, source.y - prev.y)
+        distance += math.hypot(destination.x - source.x, destination.y - source.y)
+        prev = destination
+    return distance
+
+#Reversals of the 2-opt tried per tip block at most, to keep protocol analysis fast on very large blocks
+TRAVEL_2OPT_CHECKS = 2000000
+
+#Function that orders the steps of one tip block to shorten the moves between them, keeping the first step first.
+#The move between two steps goes from the destination of one to the source of the next, so a nearest-neighbour
+#order is improved with 2-opt segment reversals whose cost is worked out from prefix sums of both directions. Full
+#passes run until no reversal shortens the block, or TRAVEL_2OPT_CHECKS reversals have been tried.
+def orderBlockByTravel(block):
+    n = len(block)
+    sources = [step.source.top().point for step in block]
+    destinations = [step.destination.top().point for step in block]
+    def cost(i, j):
+        return math.hypot(sources[j].x - destinations[i].x, sources[j].y - destinations[i].y)
+
+    #Nearest neighbour, starting from the first step
+    order = [0]
+    left = set(range(1, n))
+    while left:
+        nxt = min(left, key=lambda j: cost(order[-1], j))
+        order.append(nxt)
+        left.remove(nxt)
+
+    #Travel up to each position of the order, going forward and with every move reversed
+    def prefixSums():
+        forward = [0] * n
+        backward = [0] * n
+        for k in range(1, n):
+            forward[k] = forward[k - 1] + cost(order[k - 1], order[k])
+            backward[k] = backward[k - 1] + cost(order[k], order[k - 1])
+        return forward, backward
+
+    #2-opt
+    checks = 0
+    improved = True
+    while improved and checks < TRAVEL_2OPT_CHECKS:
+        improved = False
+        forward, backward = prefixSums()
+        for i in range(1, n - 1):
+            for j in range(i + 1, n):
+                checks += 1
+                old = cost(order[i - 1], order[i]) + forward[j] - forward[i]
+                new = cost(order[i - 1], order[j]) + backward[j] - backward[i]
+                if j < n - 1:
+                    old += cost(order[j], order[j + 1])
+                    new += cost(order[i], order[j + 1])
+                if new < old - 1e-6:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+                    forward, backward = prefixSums()
+            if checks >= TRAVEL_2OPT_CHECKS:
+                break
+    return [block[k] for k in order]
+
+#Function that reorders the steps inside each block of rows sharing a tip (a row that picks up a tip, plus the FALSE
+#rows after it for the same pipette) to shorten gantry travel. Only blocks aspirating from a single source that no row
+#of the block dispenses into are reordered: the tip then only ever carries that source's liquid, so every destination
+#sees the same liquids whatever the order. Returns (new_plan, distance_before, distance_after) in mm.
+def optimizeTravel(plan):
+    blocks = []
+    for step in plan:
+        if blocks and step.new_tip == False and blocks[-1][-1].pipette_choice == step.pipette_choice:
+            blocks[-1].append(step)
+        else:
+            blocks.append([step])
+
+    new_plan = []
+    for block in blocks:
+        sources = set((step.source_labware, step.source_well) for step in block)
+        destinations = set((step.destination_labware, step.destination_well) for step in block)
+        if len(block) > 2 and len(sources) == 1 and sources.isdisjoint(destinations):
+            block = orderBlockByTravel(block)
+        new_plan.extend(block)
+
+    return new_plan, travelDistance(plan), travelDistance(new_plan)
+
+#Liquid a pipette can't get back from the bottom of a well, by the capacity of the well in µL: PCR wells, 1.5-2 mL tubes
+#and deep wells, 15 mL tubes and reservoir columns, 50 mL tubes, then larger reservoirs
+DEAD_VOLUMES = [(300, 1), (2500, 3), (20000, 300), (60000, 1000), (float("inf"), 3000)]
+
+def deadVolume(well):
+    return next(dead for capacity, dead in DEAD_VOLUMES if well.max_volume <= capacity)
+
+#Function that writes CSV row numbers as ranges, ex. 3-7, 12
+def rowRanges(rows):
+    ranges = []
+    for row in sorted(set(rows)):
+        if ranges and row == ranges[-1][1] + 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return ", ".join(f'{first}-{last}' if first != last else f'{first}' for first, last in ranges)
+
+#Function that plays the whole plan on paper before any motion, packs being the aspirations in run order (a list of
+#steps each, a multi-dispense also aspirates the disposal volume and returns it to the source). Every aspiration must
+#leave the source's dead volume behind, and no well may go over its capacity. Wells start from the loaded volumes, or
+#empty. A source with no loaded volume that no earlier step fills can't be checked, its volume is unknown. Raises one
+#error listing every short or overflowing well with the CSV rows that take from or add to it, else returns the names
+#of the sources it couldn't check.
+def checkVolumes(packs, loaded_volumes, disposal_volume=0):
+    volumes = dict(loaded_volumes)
+    names = dict()
+    taken = dict() #source well -> [µL taken, rows taking from it, first row that comes up short]
+    unknown = [] #sources aspirated before anything declared or put liquid in them
+    added = dict() #destination well -> [highest µL, rows adding to it]
+    for pack in packs:
+        step = pack[0]
+        names[step.source] = f'{step.source_labware} {step.source_well}'
+        pack_volume = sum(s.volume for s in pack)
+        if step.source not in volumes and step.source not in unknown:
+            unknown.append(step.source)
+        source = taken.setdefault(step.source, [0, [], None])
+        if step.source not in unknown and source[2] is None and volumes.get(step.source, 0) < pack_volume + (disposal_volume if len(pack) > 1 else 0) + deadVolume(step.source):
+            source[2] = step.row
+        source[0] += pack_volume
+        source[1].extend(s.row for s in pack)
+        volumes[step.source] = volumes.get(step.source, 0) - pack_volume
+        for s in pack:
+            names[s.destination] = f'{s.destination_labware} {s.destination_well}'
+            volumes[s.destination] = volumes.get(s.destination, 0) + s.volume
+            destination = added.setdefault(s.destination, [0, []])
+            destination[0] = max(destination[0], volumes[s.destination])
+            destination[1].append(s.row)
+
+    problems = []
+    for well, (volume, rows, first_short) in taken.items():
+        if first_short is not None:
+            problems.append(f'{names[well]} runs short at CSV row {first_short}: {loaded_volumes.get(well, 0):g} µL loaded, {volume:g} µL '
+                            f'taken plus {deadVolume(well):g} µL dead volume (rows {rowRanges(rows)})')
+    for well, (volume, rows) in added.items():
+        if volume > well.max_volume:
+            problems.append(f'{names[well]} overflows: {volume:g} µL in a {well.max_volume:g} µL well (rows {rowRanges(rows)})')
+    if problems:
+        raise RuntimeError('Volume check failed, fix the CSV volumes before the run:\n' + '\n'.join(problems))
+    return [names[well] for well in unknown]
+
+#Tips left in a set of 96 tip racks, shared by every pipette (single or 8-channel) that picks up from them. Each tip is
+#one byte of a bytearray (free, used or reserved) in the racks' column order, and the free tips and full free columns
+#are counted as tips get used, so remaining() is O(1). Reserved tips, ex. columns kept for parking, are never handed
+#out and stay as they are on refill(). state() gives a JSON-friendly copy of the tracker that restore() reads back.
+class TipTracker:
+    __slots__ = ("racks", "_wells", "_state", "_column_free", "_free", "_free_columns")
+    FREE, USED, RESERVED = 0, 1, 2
+
+    def __init__(self, racks):
+        self.racks = list(racks)
+        #Every tip, A1, B1 ... H1, A2 ... of the first rack, then the next rack
+        self._wells = [well for rack in self.racks for well in rack.wells()]
+        self._state = bytearray(len(self._wells))
+        self._recount()
+
+    #Position of a tip well in the tracker
+    def _index(self, well):
+        rack_number = next((number for number, rack in enumerate(self.racks) if rack is well.parent), None)
+        if rack_number is None:
+            raise RuntimeError(f'{well} is not in the tip racks {", ".join(str(rack) for rack in self.racks)}')
+        return rack_number * 96 + (int(well.well_name[1:]) - 1) * 8 + ord(well.well_name[0]) - ord("A")
+
+    def _mark(self, index, tip_state):
+        if self._state[index] == self.FREE:
+            self._free -= 1
+            column = index // 8
+            if self._column_free[column] == 8:
+                self._free_columns -= 1
+            self._column_free[column] -= 1
+        self._state[index] = tip_state
+
+    def _recount(self):
+        self._column_free = bytearray(self._state[start:start + 8].count(self.FREE) for start in range(0, len(self._state), 8))
+        self._free = self._state.count(self.FREE)
+        self._free_columns = self._column_free.count(8)
+
+    #Keep tips out of the pick ups, with channels=8 each well reserves itself and the 7 wells below it
+    def reserve(self, wells, channels=1):
+        for well in wells:
+            first = self._index(well)
+            for index in range(first, first + channels):
+                self._mark(index, self.RESERVED)
+
+    #Start picking up at this tip, every free tip before it counts as used (like the pipette's starting_tip)
+    def skipTo(self, well):
+        for index in range(self._index(well)):
+            if self._state[index] == self.FREE:
+                self._mark(index, self.USED)
+
+    #Free tips, or full free columns for an 8-channel
+    def remaining(self, channels=1):
+        return self._free if channels == 1 else self._free_columns
+
+    #Tips (or columns) the racks without reserved tips hold when full, what refill() gives back
+    def refillable(self, channels=1):
+        racks = sum(1 for number in range(len(self.racks)) if self.RESERVED not in self._state[number * 96:(number + 1) * 96])
+        return racks * (96 if channels == 1 else 12)
+
+    #Next tip (or the top of the next full column for an 8-channel), marked as used, None if there is none left
+    def next(self, channels=1):
+        if self.remaining(channels) == 0:
+            return None
+        if channels == 1:
+            first = self._state.find(self.FREE)
+        else:
+            first = self._column_free.find(8) * 8
+        for index in range(first, first + channels):
+            self._mark(index, self.USED)
+        return self._wells[first]
+
+    #Pick up the next tip with the pipette, returns the tip well
+    def pickUp(self, pipette):
+        well = self.next(pipette.channels)
+        if well is None:
+            raise RuntimeError(f'Out of tips for the {pipette.name}, add more tip racks')
+        pipette.pick_up_tip(well)
+        return well
+
+    #The operator swapped the racks without reserved tips for full ones
+    def refill(self):
+        for number in range(len(self.racks)):
+            if self.RESERVED not in self._state[number * 96:(number + 1) * 96]:
+                self._state[number * 96:(number + 1) * 96] = bytes(96)
+        self._recount()
+
+    def state(self):
+        return {"racks": [f"{rack.load_name} in slot {rack.parent}" for rack in self.racks], "tips": self._state.hex()}
+
+    def restore(self, state):
+        if state["racks"] != self.state()["racks"]:
+            raise RuntimeError('The saved tip state is for other tip racks: ' + ", ".join(state["racks"]))
+        self._state = bytearray.fromhex(state["tips"])
+        self._recount()
+
+
+#Volume ledger of the wells the protocol pipettes from and into, to aspirate just under the meniscus instead of near the
+#bottom. A well starts with its load_liquid volume (or empty), and every aspirate and dispense moves it. The height is
+#the volume over the well's cross-section from the labware definition: tubes and wells that narrow to the bottom hold
+#the liquid higher than that, so the estimate errs on the deep side. The tip goes immersion mm under the level left
+#once the aspiration is done, never lower than the pipette's bottom clearance. Wells the ledger knows nothing about
+#(never loaded or dispensed into) are aspirated at the well's default height, like every well when disabled, where the
+#ledger is still kept.
+class LiquidTracker:
+    __slots__ = ("enabled", "immersion", "_volumes")
+
+    def __init__(self, enabled, immersion=2):
+        self.enabled = enabled
+        self.immersion = immersion
+        self._volumes = dict()
+
+    def load(self, well, volume):
+        self._volumes[well] = self._volumes.get(well, 0) + volume
+
+    def volume(self, well):
+        return self._volumes.get(well, 0)
+
+    #Height in mm of a volume in the well, capped at the well depth
+    def height(self, well, volume):
+        if well.diameter:
+            area = math.pi * (well.diameter / 2) ** 2
+        else:
+            area = well.length * well.width
+        return min(max(volume, 0) / area, well.depth)
+
+    #Location to aspirate the volume from the well, and take it out of the ledger
+    def aspirateFrom(self, pipette, well, volume):
+        known = well in self._volumes
+        self._volumes[well] = self.volume(well) - volume
+        if not self.enabled or not known:
+            return well
+        return well.bottom(z=max(self.height(well, self._volumes[well]) - self.immersion, pipette.well_bottom_clearance.aspirate))
+
+    def dispenseInto(self, well, volume):
+        self._volumes[well] = self.volume(well) + volume
+        return well
+
+    #Liquid that was moved without this run pipetting it, ex. the rows a resumed run already did
+    def moved(self, source, destination, volume):
+        self._volumes[source] = self.volume(source) - volume
+        self._volumes[destination] = self.volume(destination) + volume
+
+
+#Progress checkpoint of the pipetting steps, so a run stopped halfway (tip crash, empty source, e-stop) can be resumed
+#instead of starting over from the first row. After each finished step the file holds a hash of the CSV, the options
+#that change the order of the steps, how many steps are done, the last CSV row done and the state of the tip trackers.
+#Once the last step is done the checkpoint is marked finished, and resuming from it is refused.
+#On the robot it is kept in the user storage between runs. Simulations (and the App analysis) read the robot's
+#checkpoint but write their own to a temp folder, so analysing a protocol never moves the real checkpoint forward.
+class RunCheckpoint:
+    __slots__ = ("path", "csv_hash", "options", "saved", "done", "_protocol", "_last")
+
+    def __init__(self, protocol, name, csv_data_list, options, resume):
+        robot_path = os.path.join("/data/user_storage/botany_checkpoints", f'{name}.json')
+        self.path = os.path.join(tempfile.gettempdir(), "botany_checkpoints", f'{name}.json') if protocol.is_simulating() else robot_path
+        self.csv_hash = hashlib.sha256(json.dumps(csv_data_list).encode()).hexdigest()
+        self.options = dict(options)
+        #Checkpoint being resumed from, and the number of steps it already did
+        self.saved = None
+        self.done = 0
+        self._protocol = protocol
+        self._last = None
+        if not resume:
+            return
+        try:
+            with open(robot_path) as checkpoint_file:
+                saved = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            if protocol.is_simulating():
+                protocol.comment(f'No checkpoint at {robot_path} yet, the simulation starts from the first row')
+                return
+            raise RuntimeError(f'Resume is on but there is no checkpoint at {robot_path}, turn Resume off to start over')
+        if saved.get("finished") == True:
+            raise RuntimeError(f'The checkpoint is from a run that finished all its steps (last CSV row {saved["last_row"]}), '
+                               'turn Resume off to start over')
+        if saved["csv_hash"] != self.csv_hash:
+            raise RuntimeError('The checkpoint is from a run with another CSV file, turn Resume off to start over')
+        if saved["options"] != self.options:
+            options = ", ".join(f'{name}={value}' for name, value in saved["options"].items())
+            raise RuntimeError(f'The checkpoint is from a run with other step options ({options}), set them back or turn Resume off')
+        self.saved = saved
+        self.done = saved["steps_done"]
+        self._last = saved
+
+    #Record that the first steps_done steps are finished, tips is the state() of each tip tracker
+    def save(self, steps_done, last_row, tips, finished=False):
+        if self.path is None:
+            return
+        checkpoint = {"csv_hash": self.csv_hash, "options": self.options, "steps_done": steps_done,
+                      "last_row": last_row, "tips": tips, "finished": finished}
+        self._last = checkpoint
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file)
+            #Swap the whole file in at once, a run stopped while writing still leaves the previous checkpoint
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as error:
+            self._protocol.comment(f'Checkpoints disabled, cannot write {self.path}: {error}')
+            self.path = None
+
+    #Mark the checkpoint finished once every step is done, so a later run with Resume on doesn't skip them all
+    def finish(self):
+        if self._last is not None:
+            self.save(self._last["steps_done"], self._last["last_row"], self._last["tips"], finished=True)
+
+
+#Opt-in trace of the run: every pipette, module, delay and pause command is written to a JSON-lines file with
+#the phase (from the "~~~Phase~~~" comments), the CSV row being executed, its monotonic start/end time, the volume,
+#the tip on the pipette and the labware/well. Set row before the commands of each CSV row (an int, or a list of
+#rows for a multi-dispense). When disabled every method does nothing, so the protocol can always call it.
+class EventTrace:
+    def __init__(self, protocol, enabled, name="run"):
+        self.row = None
+        self.phase = "Setup"
+        #Loaded labware keyed by their CSV names, set it once the labware is loaded so events use the table's names
+        self.labware_dict = {}
+        self.path = None
+        self._file = None
+        self._stack = []
+        self._tips = {}
+        self._count = 0
+        if not enabled:
+            return
+        #On the robot traces go to the user storage, kept between runs. Simulations (and the App analysis) use a temp folder
+        folder = os.path.join(tempfile.gettempdir(), "botany_traces") if protocol.is_simulating() else "/data/user_storage/botany_traces"
+        self.path = os.path.join(folder, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.jsonl')
+        try:
+            os.makedirs(folder, exist_ok=True)
+            #Line buffered, so the trace is complete up to the last command even if the run is cancelled
+            self._file = open(self.path, "w", buffering=1)
+        except OSError as error:
+            protocol.comment(f'Event trace disabled, cannot write {self.path}: {error}')
+            return
+        self._unsubscribe = protocol.broker.subscribe("command", self._onMessage)
+        protocol.comment(f'Event trace: {self.path}')
+
+    #CSV name (or load name) and deck slot of a labware, labware on a module takes the module's slot
+    def _labware(self, labware):
+        labware_name = next((name for name, loaded in self.labware_dict.items() if loaded is labware), labware.load_name)
+        slot = labware.parent if isinstance(labware.parent, str) else getattr(labware.parent, "parent", None)
+        return labware_name, slot
+
+    #Labware name, slot and well of a command location (a Well, a Location or a disposal location like the trash)
+    def _place(self, location):
+        if location is None:
+            return None, None, None
+        labware_like = getattr(location, "labware", None)
+        well = labware_like.as_well() if labware_like is not None and labware_like.is_well else location
+        if hasattr(well, "well_name"):
+            return self._labware(well.parent) + (well.well_name,)
+        if labware_like is not None and labware_like.is_labware:
+            return self._labware(labware_like.object) + (None,)
+        return type(location).__name__, None, None
+
+    def _onMessage(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][2] = True
+            self._stack.append([message, time.monotonic(), False])
+            return
+        before, start, has_children = self._stack.pop()
+        name = before["name"].replace("command.", "")
+        payload = before["payload"]
+        text = payload.get("text", "")
+        if name == "COMMENT":
+            if text.strip().startswith("~") and text.strip().endswith("~"):
+                self.phase = text.strip().strip("~").strip()
+            return
+        #Commands made of other commands (transfer, distribute, mix...) are traced through their parts
+        if has_children:
+            return
+        instrument = payload.get("instrument")
+        mount = instrument.mount if instrument is not None else None
+        labware, slot, well = self._place(payload.get("location"))
+        if name == "PICK_UP_TIP":
+            self._tips[mount] = f"{slot}/{well}"
+        event = {"seq": self._count, "command": name, "phase": self.phase, "row": self.row,
+                 "start": round(start, 4), "end": round(time.monotonic(), 4),
+                 "volume": payload.get("volume"), "pipette": mount, "tip": self._tips.get(mount),
+                 "labware": labware, "slot": slot, "well": well, "text": text}
+        if message.get("error") is not None:
+            event["error"] = str(message["error"])
+        if name in ("DROP_TIP", "DROP_TIP_IN_DISPOSAL_LOCATION", "RETURN_TIP"):
+            self._tips.pop(mount, None)
+        self._file.write(json.dumps(event) + "\n")
+        self._count += 1
+
+    #Stop tracing and close the file, call at the end of the run
+    def close(self):
+        if self._file is not None:
+            self._unsubscribe()
+            self._file.close()
+            self._file = None
+
+#How a liquid is pipetted: aspirate, dispense and blow-out speeds as multiples of the pipette's default flow rates, the
+#seconds to wait after aspirating and dispensing, an air gap in µL carried on top of the liquid, and whether to blow out
+#and touch the tip after dispensing. LiquidClass() pipettes like a plain aspirate and dispense.
+class LiquidClass:
+    __slots__ = ("aspirate_rate", "dispense_rate", "blow_out_rate", "aspirate_delay", "dispense_delay", "air_gap",
+                 "blow_out", "touch_tip")
+
+    def __init__(self, aspirate_rate=1.0, dispense_rate=1.0, blow_out_rate=1.0, aspirate_delay=0, dispense_delay=0,
+                 air_gap=0, blow_out=False, touch_tip=False):
+        self.aspirate_rate = aspirate_rate
+        self.dispense_rate = dispense_rate
+        self.blow_out_rate = blow_out_rate
+        self.aspirate_delay = aspirate_delay
+        self.dispense_delay = dispense_delay
+        self.air_gap = air_gap
+        self.blow_out = blow_out
+        self.touch_tip = touch_tip
+
+    #Air gap that still fits in the tip on top of the volume
+    def _air_gap(self, pipette, volume):
+        return max(0, min(self.air_gap, pipette.max_volume - volume))
+
+    def aspirate(self, protocol, pipette, volume, location, air_gap=True):
+        pipette.aspirate(volume, location, rate=self.aspirate_rate)
+        if self.aspirate_delay > 0:
+            protocol.delay(seconds=self.aspirate_delay)
+        if air_gap and self._air_gap(pipette, volume) > 0:
+            pipette.air_gap(self._air_gap(pipette, volume))
+
+    #The air gap of the aspiration goes out with the liquid
+    def dispense(self, protocol, pipette, volume, location, air_gap=True):
+        pipette.dispense(volume + (self._air_gap(pipette, volume) if air_gap else 0), location, rate=self.dispense_rate)
+        if self.dispense_delay > 0:
+            protocol.delay(seconds=self.dispense_delay)
+
+    #Empty and wipe the tip in the well it dispensed into, when the tip holds nothing more to dispense
+    def finish(self, pipette):
+        if self.blow_out:
+            default_rate = pipette.flow_rate.blow_out
+            pipette.flow_rate.blow_out = default_rate * self.blow_out_rate
+            pipette.blow_out()
+            pipette.flow_rate.blow_out = default_rate
+        if self.touch_tip:
+            pipette.touch_tip()
+
+    def transfer(self, protocol, pipette, volume, source, destination):
+        self.aspirate(protocol, pipette, volume, source)
+        self.dispense(protocol, pipette, volume, destination)
+        self.finish(pipette)
+
+#Liquid classes the CSV can give a liquid. Water runs at twice the default speed, enzymes in glycerol slowly with pauses
+#for the viscous liquid to follow the plunger and a touch tip for the film left outside the tip, competent cells gently,
+#bead suspensions slowly in and a blow-out, and ethanol washes with an air gap against drips.
+LIQUID_CLASSES = {
+    "water": LiquidClass(aspirate_rate=2.0, dispense_rate=2.0, blow_out=True),
+    "enzyme-glycerol": LiquidClass(aspirate_rate=0.25, dispense_rate=0.25, blow_out_rate=0.5, aspirate_delay=2, dispense_delay=2, touch_tip=True),
+    "competent cells": LiquidClass(aspirate_rate=0.5, dispense_rate=0.5, aspirate_delay=1),
+    "bead suspension": LiquidClass(aspirate_rate=0.5, blow_out=True),
+    "ethanol wash": LiquidClass(air_gap=10, blow_out=True, touch_tip=True),
+}
+
+#Function that reads the optional liquid class table of the CSV, found by its Class_Liquid_Name header and followed by
+#the Liquid_Class column: each row gives one liquid of the Initial Liquid Definitions one of the LIQUID_CLASSES. Returns
+#the liquid name -> LiquidClass dict, empty if the CSV has no such table.
+def liquidClassesFromCsv(csv_data_list, liquid_names):
+    headers = [cell.strip() for cell in csv_data_list[1]] if len(csv_data_list) > 1 else []
+    if "Class_Liquid_Name" not in headers:
+        return dict()
+    first_col = headers.index("Class_Liquid_Name")
+
+    liquid_classes = dict()
+    for row_number, csv_row in enumerate(csv_data_list[2:], start=3):
+        cells = [cell.strip() for cell in csv_row[first_col:first_col + 2]]
+        cells += [""] * (2 - len(cells))
+        liquid_name, class_name = cells
+        #Check if the current row is empty, if it's empty then skip it
+        if liquid_name == "":
+            continue
+        if liquid_name not in liquid_names:
+            raise RuntimeError(f'CSV row {row_number}: liquid "{liquid_name}" is not in the Initial Liquid Definitions')
+        if class_name.lower() not in LIQUID_CLASSES:
+            raise RuntimeError(f'CSV row {row_number}: unknown liquid class "{class_name}", use one of {", ".join(LIQUID_CLASSES)}')
+        liquid_classes[liquid_name] = LIQUID_CLASSES[class_name.lower()]
+    return liquid_classes
+
 
 #Runtime parameter definitions
 def add_parameters(parameters):
@@ -139,6 +940,54 @@ def add_parameters(parameters):
         default="p300_single_gen2"
     )
 
+    #Allows user to let the protocol reorder the pipetting steps so that fewer tips are used
+    parameters.add_bool(
+        variable_name="optimize_tips",
+        display_name="Optimize Tip Use",
+        description="On = reorder steps so rows from one source share a tip, every well still gets the same volumes",
+        default=False
+    )
+
+    #Allows user to let the protocol decide when to change tips instead of the Pick_Up_Tip column
+    parameters.add_bool(
+        variable_name="auto_tips",
+        display_name="Automatic Tip Reuse",
+        description="On = ignore Pick_Up_Tip, keep a tip only for the same source while it touched no other liquid",
+        default=False
+    )
+
+    #Allows user to let the protocol reorder the rows that share a tip, to shorten the moves between labware
+    parameters.add_bool(
+        variable_name="optimize_travel",
+        display_name="Optimize Travel",
+        description="On = reorder rows that share a tip to shorten gantry moves between labware",
+        default=False
+    )
+
+    #Allows user to continue a stopped run from its last checkpoint instead of the first row of the CSV
+    parameters.add_bool(
+        variable_name="resume_run",
+        display_name="Resume From Checkpoint",
+        description="On = skip the rows a stopped run with this CSV finished and carry on with its tips",
+        default=False
+    )
+
+    #Allows user to aspirate just under the liquid level, tracked from the loaded volumes, instead of near the well bottom
+    parameters.add_bool(
+        variable_name="follow_liquid",
+        display_name="Follow Liquid Level",
+        description="On = aspirate just under the liquid surface, needs the loaded volumes to be right",
+        default=False
+    )
+
+    #Allows user to record every command of the run (phase, CSV row, timing, volume, tip, well) to a JSON-lines file
+    parameters.add_bool(
+        variable_name="event_trace",
+        display_name="Event Trace",
+        description="On = write a JSON-lines trace of every command to the robot's user storage",
+        default=False
+    )
+
 #Protocol context - https://docs.opentrons.com/v2/tutorial.html
 def run(protocol: protocol_api.ProtocolContext):
 
@@ -146,6 +995,9 @@ def run(protocol: protocol_api.ProtocolContext):
     #Each item in the child lists corresponds to a single cell within its row. Data is represented as string.
     csv_data_list = protocol.params.svt_csv.parse_as_csv()
 
+    #Opt-in JSON-lines trace of every command of the run (see EventTrace)
+    event_trace = EventTrace(protocol, protocol.params.event_trace, name=metadata["protocolName"])
+
     #Discard the first row of csv, since that's all the titles of the columns.
     csv_trunc_data = csv_data_list[2:]
 
@@ -156,7 +1008,7 @@ def run(protocol: protocol_api.ProtocolContext):
     #Create dictionary to store the loaded tip rack definitions
     tip_rack_dict = dict()
     #Create a dictionary to store the loaded labware definitions
-    labware_dict = dict()
+    labware_dict = LabwareRegistry()
 
     #Table for tip racks
     for csv_row in csv_trunc_data:
@@ -278,6 +1130,12 @@ def run(protocol: protocol_api.ProtocolContext):
             pipette_dict[right_pip_key] = protocol.load_instrument(instrument_name=str(protocol.params.pipette_right_choice), mount="right", tip_racks=p1000_rack_list)
             right_pip_obj = getLabwareObject(pipette_dict, right_pip_key)
 
+    #Wells that hold liquid before the run starts, and the volume in every well the steps touch
+    loaded_wells = set()
+    loaded_volumes = dict()
+    loaded_liquids = dict() #well -> liquid name
+    liquid_tracker = LiquidTracker(protocol.params.follow_liquid)
+
     for csv_row in csv_trunc_data:
         #Check if the current row is empty, if it's empty then skip it
         if csv_row[17] != "":
@@ -296,99 +1154,129 @@ def run(protocol: protocol_api.ProtocolContext):
                 display_color=liquid_color
             )
 
-            #Get object of current labware given the variable name
-            curr_labware = getLabwareObject(labware_dict, labware)
-            #Add the liquids to the current labware
-            curr_labware[liquid_well].load_liquid(liquid=current_liquid, volume=liquid_volume)
+            #Add the liquids to the current labware, given the variable name
+            labware_dict.well(labware, liquid_well).load_liquid(liquid=current_liquid, volume=liquid_volume)
+            loaded_liquids[labware_dict.well(labware, liquid_well)] = liquid_name
+            loaded_wells.add((labware, liquid_well))
+            loaded_volumes[labware_dict.well(labware, liquid_well)] = loaded_volumes.get(labware_dict.well(labware, liquid_well), 0) + liquid_volume
+            liquid_tracker.load(labware_dict.well(labware, liquid_well), liquid_volume)
+
+    #Liquid class of each loaded well, from the optional Class_Liquid_Name table of the CSV
+    liquid_classes = liquidClassesFromCsv(csv_data_list, set(loaded_liquids.values()))
+    well_classes = {well: liquid_classes[name] for well, name in loaded_liquids.items() if name in liquid_classes}
+
+    #Tips left in the tip racks of each tip size, pipettes of the same size share them
+    tip_trackers = {"p20": TipTracker(p20_rack_list), "p300": TipTracker(p300_rack_list), "p1000": TipTracker(p1000_rack_list)}
 
-    #Get the value, ex "A3" of the starting tip for the left/right pipette, and also tell the respective pipette to use that as the starting tip
+    #Get the value, ex "A3" of the starting tip for the left/right pipette, and skip the tips before it in the pipette's first tip rack
     if (protocol.params.pipette_left_choice != "none") and (protocol.params.pipette_left_choice != "20_unused" and protocol.params.pipette_left_choice != "300_unused"):
+        left_tips = tip_trackers[left_pip_name]
         if len(left_rack_list) > 0:
             left_starting_tip = str(protocol.params.left_starting_tip_let) + str(protocol.params.left_starting_tip_num)
             curr_tip_rack = left_rack_list[0]
-            pipette_dict[str(left_pip_key)].starting_tip = curr_tip_rack.well(left_starting_tip)
+            left_tips.skipTo(curr_tip_rack.well(left_starting_tip))
         else:
             protocol.pause(f'Please add an appropriate tip rack for the left pipette in the excel file')
     if (protocol.params.pipette_right_choice != "none") and (protocol.params.pipette_right_choice != "20_unused" and protocol.params.pipette_right_choice != "300_unused"):
+        right_tips = tip_trackers[right_pip_name]
         if len(right_rack_list) > 0:
             right_starting_tip = str(protocol.params.right_starting_tip_let) + str(protocol.params.right_starting_tip_num)
             curr_tip_rack = right_rack_list[0]
-            pipette_dict[str(right_pip_key)].starting_tip = curr_tip_rack.well(right_starting_tip)
+            right_tips.skipTo(curr_tip_rack.well(right_starting_tip))
         else:
             protocol.pause(f'Please add an appropriate tip rack for the left pipette in the excel file')
 
+    event_trace.labware_dict = labware_dict
+
+    #Compile the pipetting steps table (Source_Labware is column 24 of the CSV) once, before any liquid handling
+    transfer_plan = compileTransferPlan(protocol, csv_data_list, labware_dict, first_col=24, has_pipette_col=True)
+
+    #Optionally reorder the steps so rows from the same source share a tip
+    if protocol.params.optimize_tips == True:
+        transfer_plan, tips_saved, seconds_saved = optimizeTipUse(transfer_plan, loaded_wells)
+        protocol.comment(f'Tip optimizer: {tips_saved} tips and about {seconds_saved} seconds saved compared to the table order')
+
+    #Optionally decide the tip changes from what each tip touched, in place of the Pick_Up_Tip column
+    if protocol.params.auto_tips == True:
+        transfer_plan, tips_saved, seconds_saved = planTipReuse(transfer_plan, loaded_wells)
+        if tips_saved < 0:
+            protocol.comment(f'Automatic tips: {-tips_saved} more tips than the Pick_Up_Tip column, which reuses tips that touched other liquids')
+        else:
+            protocol.comment(f'Automatic tips: {tips_saved} tips and about {seconds_saved} seconds saved compared to the Pick_Up_Tip column')
+
+    #Optionally reorder the rows inside each tip block to shorten gantry travel
+    if protocol.params.optimize_travel == True:
+        transfer_plan, distance_before, distance_after = optimizeTravel(transfer_plan)
+        protocol.comment(f'Travel optimizer: {distance_before:.0f} mm -> {distance_after:.0f} mm of gantry travel')
+
+    #Check the sources hold enough liquid and no well overflows, before any motion
+    unchecked = checkVolumes([[step] for step in transfer_plan], loaded_volumes)
+    if unchecked:
+        protocol.comment(f'Volume check: no Initial_Volume for {", ".join(unchecked)}, these sources are not checked')
+
+    #Progress checkpoint after every row, to resume a stopped run with the same CSV and step options
+    checkpoint = RunCheckpoint(protocol, metadata["protocolName"], csv_data_list, resume=protocol.params.resume_run,
+                               options={"optimize_tips": protocol.params.optimize_tips, "auto_tips": protocol.params.auto_tips,
+                                        "optimize_travel": protocol.params.optimize_travel})
+    if checkpoint.saved is not None:
+        #Carry on with the tips the stopped run left, the starting tip parameters are ignored
+        for tips_name, tip_tracker in tip_trackers.items():
+            tip_tracker.restore(checkpoint.saved["tips"][tips_name])
+        protocol.comment(f'Resuming after CSV row {checkpoint.saved["last_row"]}: {checkpoint.done} of {len(transfer_plan)} rows already done')
+        #The liquid of the rows already done has moved
+        for step in transfer_plan[:checkpoint.done]:
+            liquid_tracker.moved(step.source, step.destination, step.volume)
+
+    protocol.comment('\n\n~~~~~~~~~~Liquid Transfers~~~~~~~~~~\n')
     first_transfer_left = True
     first_transfer_right = True
+    valid_pipette = False
+    plain_class = LiquidClass()
 
-    for csv_row in csv_trunc_data:
-        #Check if the current row is empty, if it's empty then skip it
-        if csv_row[24] != "":
-            # Define variables from CSV columns
-            source_labware = csv_row[24]
-            source_well = csv_row[25]
-            destination_labware = csv_row[26]
-            destination_well = csv_row[27]
-            transfer_volume = float(csv_row[28])
-            pick_up_tip = str(csv_row[29])
-            pipette_choice = str(csv_row[30])
-
-            curr_source_labware = getLabwareObject(labware_dict, source_labware)
-            curr_destination_labware = getLabwareObject(labware_dict, destination_labware)
-
-            valid_pipette = False
-
-            #Make sure the chosen pipette for this step from the CSV is valid, aka not a multichannel or none
-            if pipette_choice == "Left" and (protocol.params.pipette_left_choice == "none" or protocol.params.pipette_left_choice == "20_unused" or protocol.params.pipette_left_choice == "300_unused"):
-                protocol.pause("Please review the liquid transfer steps and choose a valid pipette")
-            elif pipette_choice == "Left":
-                curr_pip = left_pip_obj
-                valid_pipette = True
-            if pipette_choice == "Right" and (protocol.params.pipette_right_choice == "none" or protocol.params.pipette_right_choice == "20_unused" or protocol.params.pipette_right_choice == "300_unused"):
-                protocol.pause("Please review the liquid transfer steps and choose a valid pipette")
-            elif pipette_choice == "Right":
-                curr_pip = right_pip_obj
-                valid_pipette = True
-
-            if valid_pipette == True:
-                if pick_up_tip == 'TRUE':
-                    if pipette_choice == "Left" and first_transfer_left == True:
-                        #Pick up the first tip
-                        curr_pip.pick_up_tip()
-                        first_transfer_left = False
-                    elif pipette_choice == "Right" and first_transfer_right == True:
-                        #Pick up the first tip
-                        curr_pip.pick_up_tip()
-                        first_transfer_right = False
-                    else:
-                        #Discard the previous tip
-                        curr_pip.drop_tip()
-                        #Pick up the next tip, will always pick up the next available tip
-                        curr_pip.pick_up_tip()
-
-                    #Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                    curr_pip.aspirate(transfer_volume, curr_source_labware[source_well])
-                    #Dispense liquid, with this format (amount in microliters, well location)
-                    curr_pip.dispense(transfer_volume, curr_destination_labware[destination_well])
-
-                elif pick_up_tip == 'FALSE':
-                    if pipette_choice == "Left" and first_transfer_left == True:
-                        #Pick up the first tip
-                        curr_pip.pick_up_tip()
-                        first_transfer_left = False
-                    elif pipette_choice == "Right" and first_transfer_right == True:
-                        #Pick up the first tip
-                        curr_pip.pick_up_tip()
-                        first_transfer_right = False
-
-                    #Aspirate [take in] liquid, with this format (amount in microliters, well location)
-                    curr_pip.aspirate(transfer_volume, curr_source_labware[source_well])
-                    #Dispense liquid, with this format (amount in microliters, well location)
-                    curr_pip.dispense(transfer_volume, curr_destination_labware[destination_well])
-
-                else:
-
-                    protocol.comment('Please specify whether to use new or same tip')
-
-    if valid_pipette == True:
+    for step_number, step in enumerate(transfer_plan[checkpoint.done:], start=checkpoint.done + 1):
+        event_trace.row = step.row
+        valid_pipette = False
+
+        #Make sure the chosen pipette for this step from the CSV is valid, aka not a multichannel or none
+        if step.pipette_choice == "Left" and (protocol.params.pipette_left_choice == "none" or protocol.params.pipette_left_choice == "20_unused" or protocol.params.pipette_left_choice == "300_unused"):
+            protocol.pause("Please review the liquid transfer steps and choose a valid pipette")
+        elif step.pipette_choice == "Left":
+            curr_pip = left_pip_obj
+            curr_tips = left_tips
+            valid_pipette = True
+        if step.pipette_choice == "Right" and (protocol.params.pipette_right_choice == "none" or protocol.params.pipette_right_choice == "20_unused" or protocol.params.pipette_right_choice == "300_unused"):
+            protocol.pause("Please review the liquid transfer steps and choose a valid pipette")
+        elif step.pipette_choice == "Right":
+            curr_pip = right_pip_obj
+            curr_tips = right_tips
+            valid_pipette = True
+
+        if valid_pipette == True:
+            if step.pipette_choice == "Left" and first_transfer_left == True:
+                #Pick up the first tip
+                curr_tips.pickUp(curr_pip)
+                first_transfer_left = False
+            elif step.pipette_choice == "Right" and first_transfer_right == True:
+                #Pick up the first tip
+                curr_tips.pickUp(curr_pip)
+                first_transfer_right = False
+            elif step.new_tip == True:
+                #Discard the previous tip
+                curr_pip.drop_tip()
+                #Pick up the next tip, will always pick up the next available tip
+                curr_tips.pickUp(curr_pip)
+
+            #Aspirate [take in] liquid and dispense it, the way the source's liquid class says (a plain aspirate and
+            #dispense without one), with this format (amount in microliters, well location)
+            well_classes.get(step.source, plain_class).transfer(protocol, curr_pip, step.volume,
+                                                                liquid_tracker.aspirateFrom(curr_pip, step.source, step.volume),
+                                                                liquid_tracker.dispenseInto(step.destination, step.volume))
+            checkpoint.save(step_number, step.row, {tips_name: tip_tracker.state() for tips_name, tip_tracker in tip_trackers.items()})
+    checkpoint.finish()
+
+    if valid_pipette == True and curr_pip.has_tip:
         #Discard the previous tip
         curr_pip.drop_tip()
+
+    #Stop the event trace
+    event_trace.close()
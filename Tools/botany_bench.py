@@ -0,0 +1,253 @@
+#Benchmark suite for the BOTany protocols
+#Generates synthetic CSV tables with the same layout as Tables/*.xlsx at several sizes, runs every protocol through
+#the Opentrons simulator and records the analysis time, peak memory, command count, tips used and estimated robot time
+#
+#Usage:
+#   python Tools/botany_bench.py                                   (every protocol at 24, 96, 384 and 1000 rows)
+#   python Tools/botany_bench.py --protocols 2A 6 --sizes 96 1000 --pattern interleaved optimize_tips=true
+#   python Tools/botany_bench.py --output before.json ...  then compare the "results" of two reports
+import argparse
+import csv
+import datetime
+import json
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import opentrons
+
+import botany_estimate
+import botany_sim
+
+PROTOCOL_DIR = botany_sim.REPO_DIR / "OT-2 Protocols"
+DEFAULT_SIZES = [24, 96, 384, 1000]
+WELLS_96 = [row + str(col) for col in range(1, 13) for row in "ABCDEFGH"]
+WELLS_24 = [row + str(col) for col in range(1, 7) for row in "ABCD"]
+
+
+#Build a table of empty cells with the two title rows of the Excel sheets, then fill in the columns of each section
+def emptyTable(num_rows, num_cols, titles, headers):
+    table = [[""] * num_cols for _ in range(num_rows + 2)]
+    table[0][0] = "Instructions"
+    for col, title in titles.items():
+        table[0][col] = title
+    for col, header in enumerate(headers):
+        if header:
+            table[1][col] = header
+    return table
+
+
+#Write a list of rows starting at column first_col, one row of the table per item
+def fillSection(table, first_col, rows):
+    for index, values in enumerate(rows):
+        table[index + 2][first_col:first_col + len(values)] = [str(value) for value in values]
+
+
+#Source of each pipetting row. "grouped" keeps the rows of one source together (one tip per source),
+#"interleaved" cycles through the sources row by row (one tip per row, the worst case for tip use)
+def pickSource(sources, index, num_rows, pattern):
+    if pattern == "interleaved":
+        return sources[index % len(sources)]
+    return sources[index * len(sources) // num_rows]
+
+
+#Pipetting rows (source labware, source well, destination labware, destination well, volume, new tip) for a table,
+#the destinations go round the wells of the destination labware and a new tip is taken whenever the source changes
+def pipettingRows(num_rows, sources, destination_labware, destination_wells, volume, pattern):
+    rows = []
+    previous_source = None
+    for index in range(num_rows):
+        source = pickSource(sources, index, num_rows, pattern)
+        rows.append([source[0], source[1], destination_labware, destination_wells[index % len(destination_wells)],
+                     volume, "TRUE" if source != previous_source else "FALSE"])
+        previous_source = source
+    return rows
+
+
+#Liquid definition rows (labware, well, volume, name, description, color) for every source well
+def liquidRows(sources, volume):
+    return [[labware, well, volume, f"{labware} {well}", "synthetic benchmark liquid", "#CAE2F6"]
+            for labware, well in sources]
+
+
+#BOTany1: the pipetting steps start at column 1, water from the Falcon rack into the 100uM screw cap tubes
+def generatePrimersTable(num_rows, pattern):
+    table = emptyTable(num_rows, 7, {1: "Pipetting Steps"}, ["", "Source_Labware", "Source_Well", "Destination_Labware",
+                                                             "Destination_Well", "Transfer_Volume", "Pick_Up_Tip"])
+    sources = [("Falcon_Water_Rack", "A3"), ("Falcon_Water_Rack", "A4")]
+    fillSection(table, 1, pipettingRows(num_rows, sources, "100uM_ScrewCaps", WELLS_24, 100, pattern))
+    return table
+
+
+#BOTany2/3: liquid definitions in columns 1-6, pipetting steps with a pipette column in columns 8-14
+def pcrTableGenerator(destination_labware):
+    def generateTable(num_rows, pattern):
+        table = emptyTable(num_rows, 15, {1: "Initial Liquid Definitions", 8: "Pipetting Steps"},
+                           ["", "Labware", "Initial_Wells", "Initial_Volume", "Liquid_Name", "Description", "Color", "",
+                            "Source_Labware", "Source_Well", "Destination_Labware", "Destination_Well",
+                            "Transfer_Volume", "Pick_Up_Tip", "Pipette_Choice"])
+        sources = [("temp_tubes", "A1"), ("temp_tubes", "A2")] + [("tube_rack1", well) for well in WELLS_24[:6]]
+        fillSection(table, 1, liquidRows(sources, 1500))
+        fillSection(table, 8, [row + ["Left"] for row in
+                               pipettingRows(num_rows, sources, destination_labware, WELLS_96, 2, pattern)])
+        return table
+    return generateTable
+
+
+#BOTany4: liquid definitions in columns 1-6, then the cell, DNA and media transfer tables (7 columns each)
+def generateShockTable(num_rows, pattern):
+    step_headers = ["Source_Labware", "Source_Well", "Destination_Labware", "Destination_Well", "Transfer_Volume",
+                    "Pick_Up_Tip", "Pipette_Choice", ""]
+    table = emptyTable(num_rows, 31, {1: "Initial Liquid Definitions", 8: "Pipetting Steps (Cell Transfer)",
+                                      16: "Pipetting Steps (DNA Transfer)", 24: "Pipetting Steps (Media Transfer)"},
+                       ["", "Labware", "Initial_Wells", "Initial_Volume", "Liquid_Name", "Description", "Color", ""]
+                       + step_headers * 3)
+    cell_sources = [("cell_rack", well) for well in WELLS_24[:2]]
+    dna_sources = [("DNA_tube", well) for well in WELLS_96[:8]]
+    media_sources = [("media_rack", "A3"), ("media_rack", "A4")]
+    fillSection(table, 1, liquidRows(cell_sources, 2000) + liquidRows(dna_sources, 200)
+                + liquidRows(media_sources, 50000))
+    fillSection(table, 8, [row + ["Right"] for row in
+                           pipettingRows(num_rows, cell_sources, "pcr_strip", WELLS_96, 20, pattern)])
+    fillSection(table, 16, [row + ["Left"] for row in
+                            pipettingRows(num_rows, dna_sources, "pcr_strip", WELLS_96, 2, pattern)])
+    fillSection(table, 24, [row + ["Right"] for row in
+                            pipettingRows(num_rows, media_sources, "pcr_strip", WELLS_96, 150, pattern)])
+    return table
+
+
+#BOTany6: tip racks, labware, modules and on-module labware tables, liquids in columns 17-22, pipetting at 24-30
+#The first half of the sources go with the left P20, the second half with the right P300 (the default pipettes)
+def generateUniversalTable(num_rows, pattern):
+    table = emptyTable(num_rows, 31, {1: "Tip Rack Definition", 5: "On-Deck Labware Definition",
+                                      9: "Module Definition", 13: "On-Module Labware Definition",
+                                      17: "Initial Liquid Definitions", 24: "Pipetting Steps"},
+                       ["", "Rack_Name", "Rack_API", "Rack_Location", "", "Labware_Name", "Labware_API",
+                        "Labware_Location", "", "Module_Name", "Module_API", "Module_Location", "",
+                        "Base_Module_Name", "Top_Labware_Name", "Top_Labware_API", "", "Labware", "Initial_Wells",
+                        "Initial_Volume", "Liquid_Name", "Description", "Color", "", "Source_Labware", "Source_Well",
+                        "Destination_Labware", "Destination_Well", "Transfer_Volume", "Pick_Up_Tip",
+                        "Pipette_Choice"])
+    fillSection(table, 1, [["tip_rack_20", "opentrons_96_tiprack_20ul", 1],
+                           ["tip_rack_300", "opentrons_96_tiprack_300ul", 4]])
+    fillSection(table, 5, [["tube_rack", "opentrons_24_tuberack_nest_1.5ml_snapcap", 2],
+                           ["96-well plate", "nest_96_wellplate_2ml_deep", 5]])
+    sources = [("tube_rack", well) for well in WELLS_24[:8]]
+    fillSection(table, 17, liquidRows(sources, 1500))
+    rows = pipettingRows(num_rows, sources, "96-well plate", WELLS_96, 0, pattern)
+    for row in rows:
+        small = sources.index((row[0], row[1])) < len(sources) // 2
+        row[4] = 5 if small else 50
+        row.append("Left" if small else "Right")
+    fillSection(table, 24, rows)
+    return table
+
+
+#Every benchmark: protocol file, table generator (None for BOTany5 that has no CSV) and the runtime parameters
+#for a size (None when the size doesn't apply). BOTany5 scales with its number of samples instead of table rows,
+#so it only runs the sizes that fit on one plate
+BENCHMARKS = {
+    "1": ("BOTany1-Primers.py", generatePrimersTable, lambda size: {}),
+    "2A": ("BOTany2A-PCR.py", pcrTableGenerator("pcr_plate"), lambda size: {}),
+    "2B": ("BOTany2B-PCR.py", pcrTableGenerator("pcr_strip"), lambda size: {}),
+    "3A": ("BOTany3A-MoClo.py", pcrTableGenerator("pcr_plate"), lambda size: {}),
+    "3B": ("BOTany3B-MoClo.py", pcrTableGenerator("pcr_strip"), lambda size: {}),
+    "4": ("BOTany4-Shock&Go.py", generateShockTable, lambda size: {}),
+    "5": ("BOTany5-MagBead.py", None, lambda size: {"num_samp": size} if size <= 96 else None),
+    "6": ("BOTany6-Universal.py", generateUniversalTable, lambda size: {}),
+}
+
+
+def writeTable(table, csv_path):
+    with open(csv_path, "w", newline="") as csv_file:
+        csv.writer(csv_file).writerows(table)
+
+
+#Simulate one protocol once and measure it. The peak memory comes from a second, traced run, because
+#tracemalloc slows the simulation down too much to time it in the same run
+def runBenchmark(protocol_path, csv_path, parameter_overrides, measure_memory=True):
+    estimator = botany_estimate.RunTimeEstimator()
+    start = time.perf_counter()
+    protocol = botany_sim.simulateProtocol(protocol_path, csv_path, parameter_overrides, listeners=[estimator])
+    wall_seconds = time.perf_counter() - start
+    result = {
+        "wall_seconds": round(wall_seconds, 3),
+        "commands": len(protocol.commands()),
+        "tips_used": sum(1 for step in estimator.steps if step.name == "command.PICK_UP_TIP"),
+        "estimated_robot_seconds": round(estimator.total_seconds, 1),
+        "peak_memory_mb": None,
+    }
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            botany_sim.simulateProtocol(protocol_path, csv_path, parameter_overrides)
+            result["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the BOTany protocols on synthetic tables")
+    parser.add_argument("parameters", nargs="*",
+                        help="runtime parameters as name=value, only passed to the protocols that have them")
+    parser.add_argument("--protocols", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="pipetting rows per table")
+    parser.add_argument("--pattern", choices=["grouped", "interleaved"], default="grouped",
+                        help="grouped = rows of one source together, interleaved = sources alternate row by row")
+    parser.add_argument("--output", default="benchmark.json", help="JSON report file")
+    parser.add_argument("--tables", help="keep the generated CSV tables in this folder")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run that measures peak memory")
+    args = parser.parse_intermixed_args(argv)
+    extra_parameters = botany_sim.parseParameterOverrides(args.parameters)
+
+    table_dir = pathlib.Path(args.tables or tempfile.mkdtemp(prefix="botany_bench_"))
+    table_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    for key in args.protocols:
+        protocol_name, generator, size_parameters = BENCHMARKS[key]
+        protocol_path = PROTOCOL_DIR / protocol_name
+        accepted = botany_sim.protocolParameterNames(protocol_path)
+        for size in args.sizes:
+            parameter_overrides = size_parameters(size)
+            if parameter_overrides is None:
+                continue
+            parameter_overrides.update({name: value for name, value in extra_parameters.items() if name in accepted})
+            csv_path = None
+            if generator is not None:
+                csv_path = table_dir / f"BOTany{key}-{args.pattern}-{size}.csv"
+                writeTable(generator(size, args.pattern), csv_path)
+            result = {"protocol": protocol_name, "size": size, "pattern": args.pattern,
+                      "parameters": parameter_overrides}
+            try:
+                result.update(runBenchmark(protocol_path, csv_path, parameter_overrides, not args.no_memory))
+            except Exception as error:
+                #A size the deck can't hold (for example more tips than the racks have) is a result too
+                result["error"] = f"{type(error).__name__}: {error}"
+            results.append(result)
+            if "error" in result:
+                print(f"{protocol_name:<22} {size:>5} rows  failed: {result['error'][:100]}", flush=True)
+            else:
+                print(f"{protocol_name:<22} {size:>5} rows  {result['wall_seconds']:>7.2f}s  "
+                      f"{result['peak_memory_mb'] if result['peak_memory_mb'] is not None else '-':>7} MB  "
+                      f"{result['commands']:>6} commands  {result['tips_used']:>4} tips  "
+                      f"robot {botany_estimate.formatDuration(result['estimated_robot_seconds'])}", flush=True)
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "opentrons": opentrons.__version__,
+        "tables": str(table_dir),
+        "results": results,
+    }
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=1)
+    print(f"Report written to {args.output}")
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
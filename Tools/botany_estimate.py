@@ -0,0 +1,360 @@
+#Offline run-time estimator for the BOTany protocols
+#Runs a protocol file (with its CSV and runtime parameters) in the Opentrons simulator and adds up a predicted
+#duration for every command the robot would execute, grouped into the phases announced by the protocol comments
+#
+#Usage:
+#   python Tools/botany_estimate.py "OT-2 Protocols/BOTany2A-PCR.py" --csv my_table.csv tc_mod_cycles=30
+#   python Tools/botany_estimate.py "OT-2 Protocols/BOTany5-MagBead.py" dry_run=true --steps --json estimate.json
+import argparse
+import json
+import math
+import re
+import sys
+
+import botany_sim
+
+#Timings measured on hardware by Opentrons for their (legacy) duration estimator, in seconds
+#See opentrons/protocols/duration/estimator.py in the opentrons package
+PICK_UP_TIP_SECONDS = 4.0
+DROP_TIP_SECONDS = 10.0
+BLOW_OUT_SECONDS = 0.5
+TOUCH_TIP_SECONDS = 0.5
+TC_LID_SECONDS = 24.0
+TC_LID_TEMPERATURE_SECONDS = 60.0
+TC_DEACTIVATE_LID_SECONDS = 23.0
+
+#Temperature module ramp rates in degrees Celsius per second, depending on the target temperature
+TEMP_MOD_RATE_HIGH_AND_ABOVE = 0.3611111111
+TEMP_MOD_RATE_LOW_TO_HIGH = 0.2
+TEMP_MOD_RATE_ZERO_TO_LOW = 0.0875
+TEMP_MOD_LOW_THRESH = 25.0
+TEMP_MOD_HIGH_THRESH = 37.0
+
+#Thermocycler block ramp thresholds, the rates are in thermocyclerRampSeconds()
+THERMO_LOW_THRESH = 23.0
+THERMO_HIGH_THRESH = 70.0
+
+#Every module starts the run at room temperature
+START_MODULE_TEMPERATURE = 25.0
+
+#Our own approximations for what the Opentrons estimator doesn't cover
+#Heater-Shaker heating rate (about 8 minutes from room temperature to 75C), it cools passively when deactivated
+HS_RAMP_RATE = 0.1
+HS_SHAKE_RAMP_SECONDS = 3.0
+HS_LATCH_SECONDS = 2.0
+MAGDECK_SECONDS = 3.0
+HOME_SECONDS = 10.0
+GRIPPER_MOVE_SECONDS = 20.0
+
+#Gantry model: default OT-2 gantry speeds in mm/s, plus a fixed cost for accelerating/settling on every move
+XY_SPEED = 400.0
+Z_SPEED = 125.0
+MOVE_OVERHEAD_SECONDS = 0.3
+#Height the pipette rises above the higher of the two labware before travelling between wells, in mm
+ARC_CLEARANCE = 20.0
+#Centre of slot 12 (the OT-2 fixed trash) for drops in a trash bin, which has no well position
+TRASH_POINT = (330.0, 315.0, 82.0)
+
+FLOW_RATE_PATTERN = re.compile(r"at ([0-9.]+) uL/sec")
+REPETITIONS_PATTERN = re.compile(r"starting (\d+) repetitions")
+TEMPERATURE_PATTERN = re.compile(r"to (-?[0-9.]+) °C")
+
+#Command categories for the breakdown, everything else is "other"
+CATEGORIES = {
+    "command.ASPIRATE": "pipetting",
+    "command.DISPENSE": "pipetting",
+    "command.DISPENSE_IN_DISPOSAL_LOCATION": "pipetting",
+    "command.BLOW_OUT": "pipetting",
+    "command.BLOW_OUT_IN_DISPOSAL_LOCATION": "pipetting",
+    "command.TOUCH_TIP": "pipetting",
+    "command.PICK_UP_TIP": "tips",
+    "command.DROP_TIP": "tips",
+    "command.DROP_TIP_IN_DISPOSAL_LOCATION": "tips",
+    "command.RETURN_TIP": "tips",
+    "command.MOVE_TO": "moves",
+    "command.MOVE_TO_DISPOSAL_LOCATION": "moves",
+    "command.MOVE_LABWARE": "moves",
+    "command.HOME": "moves",
+    "command.DELAY": "delays",
+}
+
+
+#One command of the run and its predicted duration
+class EstimatedStep:
+    __slots__ = ("index", "phase", "name", "text", "seconds")
+
+    def __init__(self, index, phase, name, text, seconds):
+        self.index = index
+        self.phase = phase
+        self.name = name
+        self.text = text
+        self.seconds = seconds
+
+    def toDict(self):
+        return {"index": self.index, "phase": self.phase, "command": self.name.replace("command.", ""),
+                "text": self.text, "seconds": round(self.seconds, 3)}
+
+
+#One phase of the run, started by a "~~~Phase Name~~~" comment in the protocol
+class EstimatedPhase:
+    __slots__ = ("name", "seconds", "commands", "pauses")
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.commands = 0
+        self.pauses = 0
+
+    def toDict(self):
+        return {"phase": self.name, "seconds": round(self.seconds, 3), "commands": self.commands,
+                "pauses": self.pauses}
+
+
+#Format seconds as h:mm:ss for the report
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+#Thermocycler block ramp time between two temperatures (heats at 4C/s up to 70C and 2C/s above,
+#cools at 2C/s above 70C, 1C/s down to 23C and very slowly below room temperature)
+def thermocyclerRampSeconds(start, target):
+    if target > start:
+        if target > THERMO_HIGH_THRESH:
+            return (target - max(start, THERMO_HIGH_THRESH)) / 2 + max(THERMO_HIGH_THRESH - start, 0) / 4
+        return (target - start) / 4
+    if target < start:
+        if target >= THERMO_HIGH_THRESH:
+            return (start - target) / 2
+        if target >= THERMO_LOW_THRESH:
+            return (start - target) / 1
+        return max(start - THERMO_LOW_THRESH, 0) / 0.5 + (min(start, THERMO_LOW_THRESH) - target) / 0.1
+    return 0.0
+
+
+#Temperature module ramp time between two temperatures, the rate depends on the target temperature
+def temperatureModuleRampSeconds(start, target):
+    if target > TEMP_MOD_HIGH_THRESH:
+        rate = TEMP_MOD_RATE_HIGH_AND_ABOVE
+    elif target >= TEMP_MOD_LOW_THRESH:
+        rate = TEMP_MOD_RATE_LOW_TO_HIGH
+    else:
+        rate = TEMP_MOD_RATE_ZERO_TO_LOW
+    return abs(target - start) / rate
+
+
+#Gets the x, y, z deck coordinates of a command location (a well, a Location or a disposal location)
+def locationPoint(location):
+    if location is None:
+        return None
+    point = getattr(location, "point", None)
+    if point is None and hasattr(location, "top"):
+        point = getattr(location.top(), "point", None)
+    if point is None:
+        return TRASH_POINT
+    return (point.x, point.y, point.z)
+
+
+#Predicts the duration of every command of a run. Subscribe an instance to the protocol "command" messages
+#(botany_sim.simulateProtocol does it) and it keeps the steps, the phases and the running total
+class RunTimeEstimator:
+    def __init__(self):
+        self.steps = []
+        self.phases = [EstimatedPhase("Setup")]
+        self.categories = {}
+        self.total_seconds = 0.0
+        self.pauses = []
+        self._stack = []
+        self._position = None
+        self._temperature_module = START_MODULE_TEMPERATURE
+        self._thermocycler = START_MODULE_TEMPERATURE
+        self._heater_shaker = START_MODULE_TEMPERATURE
+        self._heater_shaker_ready_at = 0.0
+
+    #Broker listener: only commands without nested commands are timed, so a transfer() or mix() is
+    #counted once through the aspirates/dispenses/tip commands it is made of
+    def __call__(self, message):
+        if message["$"] == "before":
+            if self._stack:
+                self._stack[-1][1] = True
+            self._stack.append([message, False])
+            return
+        before, has_children = self._stack.pop()
+        if message.get("error") is None and not has_children:
+            self._addStep(before["name"], before["payload"])
+
+    def _addStep(self, name, payload):
+        text = payload.get("text", "")
+        if name == "command.COMMENT" and text.strip().startswith("~") and text.strip().endswith("~"):
+            self.phases.append(EstimatedPhase(text.strip().strip("~").strip()))
+            return
+        phase = self.phases[-1]
+        if name == "command.PAUSE" or (name == "command.MOVE_LABWARE" and not text.endswith("with gripper")):
+            phase.pauses += 1
+            self.pauses.append(f"{phase.name}: {text}")
+        seconds = self.estimate(name, payload)
+        self.steps.append(EstimatedStep(len(self.steps), phase.name, name, text, seconds))
+        phase.seconds += seconds
+        phase.commands += 1
+        category = CATEGORIES.get(name, "modules" if "MODULE" in name or "DECK" in name or "THERMOCYCLER" in name
+                                  or "HEATER_SHAKER" in name else "other")
+        self.categories[category] = self.categories.get(category, 0.0) + seconds
+        self.total_seconds += seconds
+
+    #Time to move the gantry to a location: straight up/down within a well, else an arc over the labware
+    def _moveSeconds(self, location):
+        target = locationPoint(location)
+        if target is None:
+            return 0.0
+        start, self._position = self._position, target
+        if start is None:
+            return MOVE_OVERHEAD_SECONDS
+        xy_distance = math.hypot(target[0] - start[0], target[1] - start[1])
+        if xy_distance < 0.1:
+            return abs(target[2] - start[2]) / Z_SPEED
+        safe_height = max(start[2], target[2]) + ARC_CLEARANCE
+        z_distance = (safe_height - start[2]) + (safe_height - target[2])
+        return MOVE_OVERHEAD_SECONDS + xy_distance / XY_SPEED + z_distance / Z_SPEED
+
+    #Predicted duration of one command, in seconds
+    def estimate(self, name, payload):
+        text = payload.get("text", "")
+        if name in ("command.ASPIRATE", "command.DISPENSE", "command.DISPENSE_IN_DISPOSAL_LOCATION"):
+            seconds = self._moveSeconds(payload.get("location"))
+            flow_rate = FLOW_RATE_PATTERN.search(text)
+            if flow_rate and float(flow_rate.group(1)) > 0:
+                seconds += payload.get("volume", 0) / float(flow_rate.group(1))
+            return seconds
+        if name in ("command.BLOW_OUT", "command.BLOW_OUT_IN_DISPOSAL_LOCATION"):
+            return self._moveSeconds(payload.get("location")) + BLOW_OUT_SECONDS
+        if name == "command.TOUCH_TIP":
+            return TOUCH_TIP_SECONDS
+        if name == "command.PICK_UP_TIP":
+            return self._moveSeconds(payload.get("location")) + PICK_UP_TIP_SECONDS
+        if name in ("command.DROP_TIP", "command.DROP_TIP_IN_DISPOSAL_LOCATION", "command.RETURN_TIP"):
+            return self._moveSeconds(payload.get("location", TRASH_POINT)) + DROP_TIP_SECONDS
+        if name in ("command.MOVE_TO", "command.MOVE_TO_DISPOSAL_LOCATION"):
+            return self._moveSeconds(payload.get("location"))
+        if name == "command.HOME":
+            self._position = None
+            return HOME_SECONDS
+        if name == "command.MOVE_LABWARE":
+            #A manual move is a pause for the user, only the gripper takes robot time
+            return GRIPPER_MOVE_SECONDS if text.endswith("with gripper") else 0.0
+        if name == "command.DELAY":
+            return float(payload.get("minutes") or 0) * 60 + float(payload.get("seconds") or 0)
+
+        #Temperature module, set_temperature() waits for the target
+        if name == "command.TEMPDECK_SET_TEMP":
+            target = float(payload["celsius"])
+            seconds = temperatureModuleRampSeconds(self._temperature_module, target)
+            self._temperature_module = target
+            return seconds
+        if name == "command.TEMPDECK_DEACTIVATE":
+            self._temperature_module = START_MODULE_TEMPERATURE
+            return 0.0
+
+        #Thermocycler
+        if name == "command.THERMOCYCLER_SET_BLOCK_TEMP":
+            target = float(payload["temperature"])
+            seconds = thermocyclerRampSeconds(self._thermocycler, target) + float(payload.get("hold_time") or 0)
+            self._thermocycler = target
+            return seconds
+        if name == "command.THERMOCYCLER_EXECUTE_PROFILE":
+            repetitions = REPETITIONS_PATTERN.search(text)
+            repetitions = int(repetitions.group(1)) if repetitions else 1
+            seconds = 0.0
+            for _ in range(repetitions):
+                for step in payload["steps"]:
+                    target = float(step["temperature"])
+                    hold = float(step.get("hold_time_seconds") or 0) + float(step.get("hold_time_minutes") or 0) * 60
+                    seconds += thermocyclerRampSeconds(self._thermocycler, target) + hold
+                    self._thermocycler = target
+            return seconds
+        if name in ("command.THERMOCYCLER_OPEN", "command.THERMOCYCLER_CLOSE"):
+            return TC_LID_SECONDS
+        if name == "command.THERMOCYCLER_SET_LID_TEMP":
+            return TC_LID_TEMPERATURE_SECONDS
+        if name == "command.THERMOCYCLER_DEACTIVATE_LID":
+            return TC_DEACTIVATE_LID_SECONDS
+        if name in ("command.THERMOCYCLER_DEACTIVATE_BLOCK", "command.THERMOCYCLER_DEACTIVATE"):
+            self._thermocycler = START_MODULE_TEMPERATURE
+            return TC_DEACTIVATE_LID_SECONDS if name == "command.THERMOCYCLER_DEACTIVATE" else 0.0
+
+        #Heater-Shaker, heating runs in the background until wait_for_temperature()
+        if name == "command.HEATER_SHAKER_SET_TARGET_TEMPERATURE":
+            target = TEMPERATURE_PATTERN.search(text)
+            target = float(target.group(1)) if target else START_MODULE_TEMPERATURE
+            ramp = max(target - self._heater_shaker, 0) / HS_RAMP_RATE
+            self._heater_shaker = target
+            self._heater_shaker_ready_at = self.total_seconds + ramp
+            return 0.0
+        if name == "command.HEATER_SHAKER_WAIT_FOR_TEMPERATURE":
+            return max(self._heater_shaker_ready_at - self.total_seconds, 0.0)
+        if name == "command.HEATER_SHAKER_DEACTIVATE_HEATER":
+            self._heater_shaker = START_MODULE_TEMPERATURE
+            return 0.0
+        if name in ("command.HEATER_SHAKER_SET_AND_WAIT_FOR_SHAKE_SPEED", "command.HEATER_SHAKER_DEACTIVATE_SHAKER"):
+            return HS_SHAKE_RAMP_SECONDS
+        if name in ("command.HEATER_SHAKER_OPEN_LABWARE_LATCH", "command.HEATER_SHAKER_CLOSE_LABWARE_LATCH"):
+            return HS_LATCH_SECONDS
+
+        #Magnetic module
+        if name in ("command.MAGDECK_ENGAGE", "command.MAGDECK_DISENGAGE"):
+            return MAGDECK_SECONDS
+        return 0.0
+
+    def toDict(self):
+        return {
+            "total_seconds": round(self.total_seconds, 3),
+            "manual_pauses": len(self.pauses),
+            "phases": [phase.toDict() for phase in self.phases if phase.commands],
+            "categories": {name: round(seconds, 3) for name, seconds in sorted(self.categories.items())},
+            "steps": [step.toDict() for step in self.steps],
+        }
+
+    #Human readable report: total, then one line per phase and per command category
+    def report(self, title="", show_steps=False):
+        lines = [f"{title} estimated robot time {formatDuration(self.total_seconds)} "
+                 f"({self.total_seconds / 60:.1f} min), {len(self.pauses)} manual pauses"]
+        lines.append(f"  {'Phase':<60} {'Time':>9} {'Commands':>9} {'Pauses':>7}")
+        for phase in self.phases:
+            if phase.commands:
+                lines.append(f"  {phase.name[:60]:<60} {formatDuration(phase.seconds):>9} "
+                             f"{phase.commands:>9} {phase.pauses:>7}")
+        lines.append("  " + ", ".join(f"{name} {formatDuration(seconds)}"
+                                      for name, seconds in sorted(self.categories.items()) if seconds))
+        if show_steps:
+            for step in self.steps:
+                lines.append(f"  {step.index:>6} {step.seconds:>9.1f}s  {step.text}")
+        return "\n".join(lines)
+
+
+#Simulate a protocol and return the estimator holding the prediction for the run
+def estimateProtocol(protocol_path, csv_path=None, parameter_overrides=None):
+    estimator = RunTimeEstimator()
+    botany_sim.simulateProtocol(protocol_path, csv_path, parameter_overrides, listeners=[estimator])
+    return estimator
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate how long a BOTany protocol takes on the robot")
+    parser.add_argument("protocol", help="protocol .py file")
+    parser.add_argument("parameters", nargs="*", help="runtime parameters as name=value")
+    parser.add_argument("--csv", help="CSV file for the protocol's CSV runtime parameter")
+    parser.add_argument("--json", help="also write the estimate (phases and every step) to this JSON file, - for stdout")
+    parser.add_argument("--steps", action="store_true", help="list the predicted duration of every command")
+    args = parser.parse_intermixed_args(argv)
+
+    estimator = estimateProtocol(args.protocol, args.csv, botany_sim.parseParameterOverrides(args.parameters))
+    if args.json == "-":
+        json.dump(estimator.toDict(), sys.stdout, indent=1)
+        return
+    print(estimator.report(args.protocol, args.steps))
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(estimator.toDict(), json_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
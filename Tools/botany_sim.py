@@ -0,0 +1,89 @@
+#Shared helpers to run a BOTany protocol file through the Opentrons simulator, with its CSV and runtime parameters
+#Requires the opentrons python package (pip install opentrons), the same version as the robot if possible
+import importlib.util
+import json
+import pathlib
+
+from opentrons import simulate
+from opentrons.protocol_api._parameter_context import ParameterContext
+from opentrons.protocols.api_support.types import APIVersion
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+CUSTOM_LABWARE_DIR = REPO_DIR / "Custom Labware"
+
+
+#Import a protocol file as a module, the file names have dashes and "&" so they can't be imported normally
+def loadProtocol(protocol_path):
+    protocol_path = pathlib.Path(protocol_path)
+    spec = importlib.util.spec_from_file_location(protocol_path.stem.replace("-", "_").replace("&", "_"), protocol_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#Read every custom labware definition of the repo, keyed by load name like the Opentrons App does
+def loadCustomLabware(labware_dir=CUSTOM_LABWARE_DIR):
+    custom_labware = {}
+    for definition_path in sorted(pathlib.Path(labware_dir).glob("*.json")):
+        with open(definition_path) as definition_file:
+            definition = json.load(definition_file)
+        custom_labware[definition["parameters"]["loadName"]] = definition
+    return custom_labware
+
+
+#Turn "name=value" command line arguments into runtime parameter overrides, values are parsed as JSON when possible
+#so that "tc_mod_cycles=30", "dry_run=true" and "pipette_right_choice=p300_single_gen2" all get the right type
+def parseParameterOverrides(arguments):
+    overrides = {}
+    for argument in arguments:
+        if "=" not in argument:
+            raise ValueError(f'Runtime parameter "{argument}" must be given as name=value')
+        name, value = argument.split("=", 1)
+        try:
+            overrides[name] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[name] = value
+    return overrides
+
+
+#Names of the runtime parameters a protocol file defines
+def protocolParameterNames(protocol_path):
+    module = loadProtocol(protocol_path)
+    major, minor = (int(part) for part in module.metadata.get("apiLevel", "2.20").split("."))
+    parameter_context = ParameterContext(APIVersion(major, minor))
+    if hasattr(module, "add_parameters"):
+        module.add_parameters(parameter_context)
+    return set(parameter_context._parameters)
+
+
+#Build a simulated protocol context for the protocol module, with the runtime parameters (and CSV file) set up
+def createContext(module, csv_path=None, parameter_overrides=None):
+    api_level = module.metadata.get("apiLevel", "2.20")
+    robot_type = getattr(module, "requirements", {}).get("robotType", "OT-2")
+    protocol = simulate.get_protocol_api(api_level, extra_labware=loadCustomLabware(), robot_type=robot_type)
+
+    major, minor = (int(part) for part in api_level.split("."))
+    parameter_context = ParameterContext(APIVersion(major, minor))
+    if hasattr(module, "add_parameters"):
+        module.add_parameters(parameter_context)
+    if parameter_overrides:
+        parameter_context.set_parameters(parameter_overrides)
+    if csv_path is not None:
+        csv_names = [name for name, parameter in parameter_context._parameters.items()
+                     if type(parameter).__name__ == "CSVParameterDefinition"]
+        if not csv_names:
+            raise ValueError(f"{module.__name__} has no CSV runtime parameter")
+        parameter_context.initialize_csv_files({csv_names[0]: pathlib.Path(csv_path)})
+    protocol._params = parameter_context.export_parameters_for_protocol()
+    return protocol
+
+
+#Run a protocol file in the simulator. Every listener is subscribed to the "command" messages of the run before it
+#starts, and gets the same messages the Opentrons App shows in the run log (with their structured payloads)
+def simulateProtocol(protocol_path, csv_path=None, parameter_overrides=None, listeners=()):
+    module = loadProtocol(protocol_path)
+    protocol = createContext(module, csv_path, parameter_overrides)
+    for listener in listeners:
+        protocol.broker.subscribe("command", listener)
+    module.run(protocol)
+    return protocol